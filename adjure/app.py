@@ -1,13 +1,43 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
 import sys
 
 import staticconf
+from flask import current_app
 from flask import Flask
 from logstash_formatter import LogstashFormatterV1
 
+from adjure.models.base import query_stats
+from adjure.models.base import remove_sessions
 from adjure.routes.auth import auth_page
 from adjure.routes.healthcheck import healthcheck_page
+from adjure.routes.metrics import metrics_page
+
+DB_HOST_ENV_VAR = 'ADJURE_DB_HOST'
+DB_REPLICA_HOSTS_ENV_VAR = 'ADJURE_DB_REPLICA_HOSTS'
+
+
+def get_database_url():
+    if not os.environ.get(DB_HOST_ENV_VAR, None):
+        raise ValueError(
+            '{} is required for Adjure to connect to a database.'.format(DB_HOST_ENV_VAR)
+        )
+    return os.environ[DB_HOST_ENV_VAR]
+
+
+def get_replica_database_urls():
+    """Comma separated read replica URLs, which may be empty"""
+    return [
+        url.strip()
+        for url in os.environ.get(DB_REPLICA_HOSTS_ENV_VAR, '').split(',')
+        if url.strip()
+    ]
+
+
+def get_shard_configs(config):
+    """Databases besides ADJURE_DB_HOST that users are sharded across"""
+    return config.read_list('database.shards', default=[])
 
 
 def register_app_config(config_path):
@@ -19,10 +49,30 @@ def setup_logging(app, config):
     handler = logging.StreamHandler(sys.stdout)
     handler.setFormatter(LogstashFormatterV1())
     app.logger.addHandler(handler)
+    # Loggers of adjure's modules, such as slow queries. Flask's logger
+    # doesn't propagate, so nothing is logged twice.
+    logging.getLogger('adjure').addHandler(handler)
+
+
+def reset_query_stats():
+    query_stats.reset()
+
+
+def add_query_headers(response):
+    """Report the statements run for this request, outside of production"""
+    config = staticconf.NamespaceReaders('adjure')
+    if current_app.debug or config.read_bool('database.query_headers', default=False):
+        response.headers['X-Adjure-Query-Count'] = str(query_stats.count)
+        response.headers['X-Adjure-Query-Duration'] = '{:.6f}'.format(query_stats.duration)
+    return response
 
 
 def build_app():
     app = Flask(__name__)
     app.register_blueprint(auth_page)
     app.register_blueprint(healthcheck_page)
+    app.register_blueprint(metrics_page)
+    app.before_request(reset_query_stats)
+    app.after_request(add_query_headers)
+    app.teardown_appcontext(remove_sessions)
     return app
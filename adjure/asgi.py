@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Serve adjure from an ASGI server.
+
+Requests are accepted on the event loop, and each is run through the Flask
+app on a bounded thread pool, so the blocking database and CPU-bound work
+(HMAC, QR rendering) never stalls the loop. The number of threads, not
+the number of open connections, bounds concurrency on the database.
+"""
+import asyncio
+import json
+import sys
+import threading
+from io import BytesIO
+
+
+_END = object()
+
+
+def build_environ(scope, body):
+    """A PEP 3333 environ for an ASGI http scope"""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_{}'.format(name)
+        if key in environ:
+            value = '{},{}'.format(environ[key], value)
+        environ[key] = value
+
+    # The body is already buffered, and requests without a content-length
+    # (chunked, or HTTP/2) would otherwise be read as empty
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+class ClientDisconnected(IOError):
+    """Raised in the worker thread when the response can't be sent, because
+    the client has gone away
+    """
+
+
+class WSGIToASGI(object):
+    """Adapt a WSGI app to ASGI, running it on an executor.
+
+    Response bodies are streamed back through a bounded queue, so a slow
+    client holds back the worker thread instead of buffering without limit.
+    Request bodies are buffered, up to max_body_size bytes.
+    """
+
+    def __init__(self, wsgi_app, executor, queue_size=16, max_body_size=10 * 1024 * 1024):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.queue_size = queue_size
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type {}'.format(scope['type']))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = await self.read_body(scope, receive)
+        if body is None:
+            await send_too_large(send, self.max_body_size)
+            return
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        disconnected = threading.Event()
+        environ = build_environ(scope, body)
+        future = loop.run_in_executor(self.executor, self.run_wsgi, environ, loop, queue, disconnected)
+
+        started = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, tuple):
+                    status, headers = item
+                    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                    started = True
+                else:
+                    await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+        except BaseException:
+            # Nothing will read the queue again, so stop the worker thread
+            # before its next put, and unblock the one it may be stuck in
+            disconnected.set()
+            while not queue.empty():
+                queue.get_nowait()
+            future.add_done_callback(lambda future: future.cancelled() or future.exception())
+            raise
+
+        try:
+            await future
+        except Exception:
+            if started:
+                raise
+            await send({'type': 'http.response.start', 'status': 500, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def read_body(self, scope, receive):
+        """:returns: the request body, or None if it's over max_body_size"""
+        for name, value in scope.get('headers', []):
+            if name.lower() == b'content-length' and value.isdigit() and int(value) > self.max_body_size:
+                return None
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            body.extend(message.get('body', b''))
+            if len(body) > self.max_body_size:
+                return None
+            if not message.get('more_body'):
+                return bytes(body)
+
+    def run_wsgi(self, environ, loop, queue, disconnected):
+        """Run the app in a worker thread, handing the status, headers and
+        body chunks to the event loop through queue. The status and headers
+        are held back until the first chunk, so an app can still replace
+        them with an error response until then, as PEP 3333 allows.
+        """
+        response_start = None
+        headers_sent = False
+
+        def put(item):
+            if disconnected.is_set():
+                raise ClientDisconnected()
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def send_headers():
+            nonlocal headers_sent
+            if not headers_sent:
+                put(response_start)
+                headers_sent = True
+
+        def write(chunk):
+            if response_start is None:
+                raise AssertionError('write() called before start_response()')
+            send_headers()
+            if chunk:
+                put(chunk)
+
+        def start_response(status, headers, exc_info=None):
+            nonlocal response_start
+            if exc_info:
+                try:
+                    if headers_sent:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            elif response_start is not None:
+                raise AssertionError('start_response() called again without exc_info')
+
+            response_start = (
+                int(status.split(' ', 1)[0]),
+                [
+                    (name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers
+                ],
+            )
+            return write
+
+        try:
+            response = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in response:
+                    if chunk:
+                        write(chunk)
+                if response_start is not None:
+                    send_headers()
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+        finally:
+            if not disconnected.is_set():
+                put(_END)
+
+
+async def send_too_large(send, max_body_size):
+    body = json.dumps({
+        'error_message': 'Request bodies can be at most {} bytes'.format(max_body_size),
+        'error_code': 'REQUEST_TOO_LARGE',
+    }).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': 413,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('ascii'))],
+    })
+    await send({'type': 'http.response.body', 'body': body, 'more_body': False})
@@ -1,18 +1,41 @@
 # -*- coding: utf-8 -*-
+import binascii
+import collections
+import itertools
 import math
-import os
+import struct
 import time
-import uuid
+from collections import namedtuple
 
 import staticconf
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import constant_time
+from cryptography.hazmat.primitives import hmac
 from cryptography.hazmat.primitives.hashes import SHA1
 from cryptography.hazmat.primitives.hashes import SHA256
 from cryptography.hazmat.primitives.hashes import SHA512
-from cryptography.hazmat.primitives.twofactor import InvalidToken
 from cryptography.hazmat.primitives.twofactor.totp import TOTP
+from flask import g
+from flask import has_app_context
+from sqlalchemy import bindparam
+from sqlalchemy import select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
 
-from adjure.models.base import session
+from adjure.lib import encryption
+from adjure.lib import entropy
+from adjure.lib import metrics
+from adjure.lib.cache import LRUCache
+from adjure.lib.cache import zero_bytes
+from adjure.lib.replay import build_replay_ledger
+from adjure.models.base import group_by_shard
+from adjure.models.base import lookup_shards
+from adjure.models.base import shard_for
+from adjure.models.base import shards
+from adjure.models.base import user_shards
+from adjure.models.auth_device import AuthDevice
 from adjure.models.auth_user import AuthUser
 from adjure.models.recovery_code import RecoveryCode
 
@@ -27,22 +50,392 @@ TOTP_HASH_ALGORITHMS = {
     'SHA512': SHA512
 }
 RECOVERY_CODE_COUNT = 10
+RECOVERY_CODE_BYTES = 16
+PROVISION_FIELDS = frozenset(['user_id', 'key_length', 'key_valid_duration', 'hash_algorithm'])
+# The name reported for the credential created by provision_user
+DEFAULT_DEVICE = 'default'
+MAX_DEVICE_NAME_LENGTH = 64
+
+# The subset of an AuthUser row needed to generate and verify codes. Only
+# key rotation changes it, and old keys stay usable, so it is safe to cache
+# per worker. secret is as stored, so encrypted when secret_key_version is set.
+UserParams = namedtuple(
+    'UserParams',
+    ['user_id', 'secret', 'secret_key_version', 'key_length', 'key_valid_duration', 'hash_algorithm', 'devices'],
+)
+
+# The same for each of a user's AuthDevices, with the user's key_valid_duration
+DeviceParams = namedtuple(
+    'DeviceParams',
+    ['user_id', 'name', 'secret', 'secret_key_version', 'key_length', 'key_valid_duration', 'hash_algorithm'],
+)
+
+# One entry per attempt given to authorize_users. device is the name of the
+# credential that matched on success, otherwise error is the
+# ValidationException explaining the failure.
+AuthorizeResult = namedtuple(
+    'AuthorizeResult',
+    ['device', 'error'],
+)
+
+# One entry per user given to bulk_provision_users. error is None on success,
+# otherwise the UserCreationException explaining why the user was skipped.
+BulkProvisionResult = namedtuple(
+    'BulkProvisionResult',
+    ['user_id', 'recovery_codes', 'error'],
+)
+
+_user_cache = None
+_recent_writes = None
+_verifier_cache = None
+_replay_ledger = None
+_MISSING = object()
 
 
 class ValidationException(ValueError):
     """Raised for invalid auth attempt"""
 
 
+class UnknownUserException(ValidationException):
+    """Raised for an auth attempt against a user that isn't provisioned"""
+
+
+class ReplayedCodeException(ValidationException):
+    """Raised when a code from an already used time step is given again"""
+
+
 class UserCreationException(ValueError):
     """Raised when invalid user is created"""
 
 
+class UserAlreadyProvisionedException(UserCreationException):
+    """Raised when creating a user_id that already exists"""
+
+
+class DeviceCreationException(ValueError):
+    """Raised when a device can't be added to a user"""
+
+
 class RecoveryCodeConsumptionError(ValueError):
     """Raised when trying to consume a recovery code that cannot be consumed"""
 
 
+class RecoveryCodeRegenerationError(RuntimeError):
+    """Raised when a user's new recovery codes weren't all stored"""
+
+
+class TOTPVerifier(object):
+    """Generates and checks TOTP codes for a single secret.
+
+    The keyed HMAC context is set up once, and copied for each time step, so
+    the key schedule isn't redone for every window of every verify.
+    """
+
+    def __init__(self, secret, key_length, hash_algorithm, key_valid_duration):
+        self.key_length = key_length
+        self.key_valid_duration = key_valid_duration
+        self._candidates = None
+        self._hmac = hmac.HMAC(
+            secret,
+            TOTP_HASH_ALGORITHMS[hash_algorithm](),
+            backend=default_backend(),
+        )
+
+    def time_step(self, timestamp):
+        return int(timestamp / self.key_valid_duration)
+
+    def generate_for_step(self, time_step):
+        """RFC 4226 HOTP for the given counter, as ASCII encoded bytes"""
+        ctx = self._hmac.copy()
+        ctx.update(struct.pack('>Q', time_step))
+        digest = ctx.finalize()
+
+        offset = digest[-1] & 0b1111
+        truncated = struct.unpack('>I', digest[offset:offset + 4])[0] & 0x7fffffff
+        code = truncated % (10 ** self.key_length)
+        return '{:0{}d}'.format(code, self.key_length).encode('ASCII')
+
+    def generate(self, timestamp):
+        return self.generate_for_step(self.time_step(timestamp))
+
+    def candidate_steps(self, current_time, sliding_windows):
+        return [
+            self.time_step(window_time)
+            for window_time in sliding_time_window(
+                current_time, self.key_valid_duration, sliding_windows,
+            )
+        ]
+
+    def candidates(self, current_time, sliding_windows):
+        """(time step, code) for every window around current_time. They only
+        change when the windows move on, so the last set is kept for reuse.
+        """
+        steps = tuple(self.candidate_steps(current_time, sliding_windows))
+        candidates = self._candidates
+        if candidates is None or candidates[0] != steps:
+            candidates = (steps, [(step, self.generate_for_step(step)) for step in steps])
+            self._candidates = candidates
+        return candidates[1]
+
+    def verify(self, code_to_verify, current_time, sliding_windows):
+        """Check a code against every window around current_time.
+        Every candidate is compared, so timing doesn't reveal which window
+        (if any) matched.
+        :returns: the matching time step, or None
+        """
+        match = match_code([(None, self)], code_to_verify, current_time, sliding_windows)
+        return None if match is None else match[1]
+
+
+def match_code(verifiers, code_to_verify, current_time, sliding_windows):
+    """Check a code against every window of several credentials, in one pass
+    over their candidate codes. Every candidate is compared, so timing
+    doesn't reveal which credential or window (if any) matched.
+    :param verifiers: list of (device name, TOTPVerifier)
+    :returns: (device name, time step) of the first match, or None
+    """
+    match = None
+    with metrics.VERIFY_DURATION.time():
+        candidates = [
+            (device, time_step, code)
+            for device, verifier in verifiers
+            for time_step, code in verifier.candidates(current_time, sliding_windows)
+        ]
+        for device, time_step, code in candidates:
+            if constant_time.bytes_eq(code, code_to_verify) and match is None:
+                match = (device, time_step)
+    return match
+
+
+def request_users():
+    """Users loaded from the primary so far in this request, by str user_id,
+    or None outside of a request
+    """
+    if not has_app_context():
+        return None
+    if not hasattr(g, 'adjure_users'):
+        g.adjure_users = {}
+    return g.adjure_users
+
+
+def remember_user(user_id, user):
+    users = request_users()
+    if users is not None:
+        users[str(user_id)] = user
+
+
 def load_user(user_id):
-    return session.query(AuthUser).filter(AuthUser.user_id == user_id).first()
+    """Load a user from the primary of its shard, for anything that goes on
+    to write. Within a request each user is only queried for once.
+    """
+    users = request_users()
+    if users is not None and str(user_id) in users:
+        return users[str(user_id)]
+
+    user = None
+    with metrics.LOAD_USER_DURATION.time():
+        for shard in user_shards(user_id):
+            user = shard.session.query(AuthUser).filter(AuthUser.user_id == user_id).first()
+            if user:
+                break
+    remember_user(user_id, user)
+    return user
+
+
+def load_users_for_read(user_ids):
+    """Load users from a read replica of their shard if there are any,
+    falling back to the shard's primary for users the replica doesn't have,
+    such as users provisioned moments ago. Users this worker wrote within
+    database.replica_lag seconds are read from the primary, as the replica
+    may still have their old rows.
+    :param user_ids: list of str
+    :returns: dict of user_id to AuthUser, without unknown users
+    """
+    users = {}
+    recent_writes = get_recent_writes()
+    for shard, shard_user_ids in group_by_shard(user_ids):
+        replica_user_ids = [
+            user_id for user_id in shard_user_ids
+            if recent_writes.get(user_id) is None
+        ]
+        if shard.replica_engines and replica_user_ids:
+            try:
+                # Revoked devices have to stop working at once, so users
+                # with devices are always read from the primary
+                users.update(
+                    (user_id, user)
+                    for user_id, user in _query_users(shard.replica_session, replica_user_ids)
+                    if not user.devices
+                )
+            finally:
+                # Users from the replica are detached, with their columns loaded
+                shard.replica_session.remove()
+
+        for other_shard in lookup_shards(shard):
+            missing = [user_id for user_id in shard_user_ids if user_id not in users]
+            if not missing:
+                break
+            users.update(_query_users(other_shard.session, missing))
+    return users
+
+
+def _query_users(session, user_ids):
+    """Query users along with their devices, in one query"""
+    users = collections.OrderedDict()
+    with metrics.LOAD_USER_DURATION.time():
+        rows = session.query(AuthUser, AuthDevice).outerjoin(
+            AuthDevice, AuthDevice.user_id == AuthUser.user_id,
+        ).filter(AuthUser.user_id.in_(user_ids))
+        for user, device in rows:
+            devices = users.setdefault(user, [])
+            if device is not None:
+                devices.append(device)
+
+    for user, devices in users.items():
+        set_committed_value(user, 'devices', sorted(devices, key=lambda device: device.name))
+    return [(user.user_id, user) for user in users]
+
+
+def get_user_cache():
+    global _user_cache
+    if _user_cache is None:
+        config = staticconf.NamespaceReaders('adjure')
+        _user_cache = LRUCache(
+            max_size=config.read_int('auth.user_cache.max_size', default=10000),
+            ttl=config.read_int('auth.user_cache.ttl', default=300),
+        )
+        metrics.registry.track_cache('user', _user_cache)
+    return _user_cache
+
+
+def get_recent_writes():
+    """User ids this worker has written in the last database.replica_lag
+    seconds, which replicas may not have caught up with
+    """
+    global _recent_writes
+    if _recent_writes is None:
+        config = staticconf.NamespaceReaders('adjure')
+        _recent_writes = LRUCache(
+            max_size=config.read_int('auth.user_cache.max_size', default=10000),
+            ttl=config.read_float('database.replica_lag', default=10),
+        )
+    return _recent_writes
+
+
+def get_verifier_cache():
+    global _verifier_cache
+    if _verifier_cache is None:
+        config = staticconf.NamespaceReaders('adjure')
+        # Verifiers hold keyed HMAC contexts, which can't be zeroed, so they
+        # mustn't outlive the decrypted secrets they were made from
+        _verifier_cache = LRUCache(
+            max_size=config.read_int('auth.verifier_cache.max_size', default=10000),
+            ttl=min(
+                config.read_int('auth.verifier_cache.ttl', default=300),
+                config.read_int('auth.secret_encryption.cache.ttl', default=300),
+            ),
+        )
+        metrics.registry.track_cache('verifier', _verifier_cache)
+    return _verifier_cache
+
+
+def get_replay_ledger():
+    global _replay_ledger
+    if _replay_ledger is None:
+        _replay_ledger = build_replay_ledger(staticconf.NamespaceReaders('adjure'))
+    return _replay_ledger
+
+
+def invalidate_user_cache(user_id):
+    """Drop any cached params for user_id, and read it from the primary for
+    a while. Must be called by anything that creates, deletes or rotates an
+    AuthUser row, or changes its devices.
+    """
+    get_recent_writes().set(str(user_id), True)
+    get_user_cache().invalidate(str(user_id))
+
+
+def load_user_params(user_id):
+    """Load the TOTP parameters for a user, going through the per-worker
+    user cache. Unknown users are cached too, for a shorter time, so that
+    repeated attempts against them don't each cost a query. Users with
+    devices aren't cached, so a removed device is rejected by every worker
+    straight away.
+    :param user_id: str
+    :returns: UserParams or None if the user doesn't exist
+    """
+    cache = get_user_cache()
+    params = cache.get(str(user_id), _MISSING)
+    if params is not _MISSING:
+        return params
+
+    return _cache_user_params(user_id, load_users_for_read([str(user_id)]).get(str(user_id)))
+
+
+def load_users_params(user_ids):
+    """Batch version of load_user_params. Cache misses are loaded with a
+    single IN query.
+    :param user_ids: iterable of str
+    :returns: dict of str user_id to UserParams or None
+    """
+    cache = get_user_cache()
+    users_params = {}
+    for user_id in set(str(user_id) for user_id in user_ids):
+        users_params[user_id] = cache.get(user_id, _MISSING)
+
+    missing = [
+        user_id for user_id, params in users_params.items()
+        if params is _MISSING
+    ]
+    if missing:
+        users = load_users_for_read(missing)
+        for user_id in missing:
+            users_params[user_id] = _cache_user_params(user_id, users.get(user_id))
+
+    return users_params
+
+
+def _cache_user_params(user_id, user):
+    cache = get_user_cache()
+    if not user:
+        config = staticconf.NamespaceReaders('adjure')
+        cache.set(
+            str(user_id),
+            None,
+            ttl=config.read_int('auth.user_cache.negative_ttl', default=5),
+        )
+        return None
+
+    params = user_params(user)
+    if not params.devices:
+        cache.set(str(user_id), params)
+    return params
+
+
+def user_params(user):
+    """:param user: AuthUser, with its devices loaded
+    :returns: UserParams
+    """
+    return UserParams(
+        user_id=user.user_id,
+        secret=user.secret,
+        secret_key_version=user.secret_key_version,
+        key_length=user.key_length,
+        key_valid_duration=user.key_valid_duration,
+        hash_algorithm=user.hash_algorithm,
+        devices=tuple(
+            DeviceParams(
+                user_id=user.user_id,
+                name=device.name,
+                secret=device.secret,
+                secret_key_version=device.secret_key_version,
+                key_length=device.key_length,
+                key_valid_duration=user.key_valid_duration,
+                hash_algorithm=device.hash_algorithm,
+            )
+            for device in user.devices
+        ),
+    )
 
 
 def validate_key_length(key_length):
@@ -53,8 +446,15 @@ def validate_key_length(key_length):
         ))
 
 
+def validate_key_valid_duration(key_valid_duration):
+    if not isinstance(key_valid_duration, int) or key_valid_duration < 1:
+        raise UserCreationException('{} is not a valid key_valid_duration. Must be a positive number of seconds'.format(
+            key_valid_duration,
+        ))
+
+
 def validate_hash_algorithm(hash_algorithm):
-    if hash_algorithm not in TOTP_HASH_ALGORITHMS:
+    if not isinstance(hash_algorithm, str) or hash_algorithm not in TOTP_HASH_ALGORITHMS:
         raise UserCreationException('{} is not a valid TOTP hash algorithm. Must be one of {}'.format(
             hash_algorithm,
             list(TOTP_HASH_ALGORITHMS.values())
@@ -66,68 +466,480 @@ def provision_user(user_id, key_length=None, key_valid_duration=None, hash_algor
     :param user_id: int
     :param key_length: int in SUPPORTED_KEY_LENGTHS
     """
-    config = staticconf.NamespaceReaders('adjure')
-    key_length = key_length or config.read('auth.key_length', default=6)
-    key_valid_duration = key_valid_duration or config.read('auth.key_valid_duration', default=30)
-    hash_algorithm = hash_algorithm or config.read('auth.hash_algorithm', default='SHA256')
-
-    validate_key_length(key_length)
-    validate_hash_algorithm(hash_algorithm)
+    key_length, key_valid_duration, hash_algorithm = provision_params(
+        key_length, key_valid_duration, hash_algorithm,
+    )
 
     if load_user(user_id):
-        raise UserCreationException('User id {} already provisioned.'.format(user_id))
+        raise UserAlreadyProvisionedException('User id {} already provisioned.'.format(user_id))
 
+    secret, secret_key_version = encryption.encrypt_secret(
+        user_id, entropy.random_bytes(SECRET_KEY_BYTES),
+    )
     auth_user = AuthUser(
         user_id=user_id,
-        secret=os.urandom(SECRET_KEY_BYTES),
+        secret=secret,
+        secret_key_version=secret_key_version,
         key_length=key_length,
         key_valid_duration=key_valid_duration,
         hash_algorithm=hash_algorithm
     )
 
-    session.add(auth_user)
-    session.commit()
-    generate_recovery_codes_for_user(auth_user)
+    shard_session = shard_for(user_id).session
+    shard_session.add(auth_user)
+    recovery_codes = generate_recovery_codes_for_user(auth_user).recovery_codes
+    shard_session.commit()
+    invalidate_user_cache(user_id)
+    # Committing expires the codes, and reloading them would lose the plaintext
+    set_committed_value(auth_user, 'recovery_codes', recovery_codes)
+    remember_user(user_id, auth_user)
 
     return auth_user
 
 
+def add_user_device(user_id, name, key_length=None, hash_algorithm=None):
+    """Enroll another TOTP device for a provisioned user, up to
+    auth.max_devices of them. It gets a secret of its own and the user's
+    key_valid_duration. Workers that have the user cached from before its
+    first device see it once that expires, after auth.user_cache.ttl.
+    :param name: str naming the device, unique per user
+    :returns: the AuthDevice, or None if the user doesn't exist
+    """
+    if not name or len(name) > MAX_DEVICE_NAME_LENGTH or name == DEFAULT_DEVICE:
+        raise DeviceCreationException(
+            'Device names must be 1 to {} characters, and not {}.'.format(
+                MAX_DEVICE_NAME_LENGTH,
+                DEFAULT_DEVICE,
+            )
+        )
+    key_length, _, hash_algorithm = provision_params(key_length, None, hash_algorithm)
+
+    user = load_user(user_id)
+    if not user:
+        return None
+
+    # Every device is checked on every verify, so there's a limit. The
+    # user's row is locked first, so concurrent adds can't both fit under it.
+    config = staticconf.NamespaceReaders('adjure')
+    max_devices = config.read_int('auth.max_devices', default=5)
+    session = object_session(user)
+    user_table = AuthUser.__table__
+    session.execute(
+        user_table.update().where(
+            user_table.c.user_id == user.user_id
+        ).values(user_id=user_table.c.user_id)
+    )
+    device_count = session.query(AuthDevice).filter(AuthDevice.user_id == user.user_id).count()
+    if device_count >= max_devices:
+        session.rollback()
+        raise DeviceCreationException(
+            'User {} already has {} devices, the most allowed.'.format(user_id, max_devices)
+        )
+
+    secret, secret_key_version = encryption.encrypt_secret(
+        user_id, entropy.random_bytes(SECRET_KEY_BYTES),
+    )
+    device = AuthDevice(
+        user_id=user.user_id,
+        name=name,
+        secret=secret,
+        secret_key_version=secret_key_version,
+        key_length=key_length,
+        hash_algorithm=hash_algorithm,
+    )
+    session.add(device)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise DeviceCreationException(
+            'User {} already has a device named {}.'.format(user_id, name)
+        )
+    invalidate_user_cache(user_id)
+    return device
+
+
+def remove_user_device(user_id, name):
+    """:returns: True if the device was removed, False if there wasn't one"""
+    for shard in user_shards(user_id):
+        removed = shard.session.query(AuthDevice).filter(
+            AuthDevice.user_id == user_id,
+            AuthDevice.name == name,
+        ).delete(synchronize_session=False)
+        if removed:
+            shard.session.commit()
+            invalidate_user_cache(user_id)
+            return True
+        shard.session.rollback()
+    return False
+
+
+def provision_params(key_length=None, key_valid_duration=None, hash_algorithm=None):
+    """Fill in configured defaults for, and validate, new user parameters"""
+    config = staticconf.NamespaceReaders('adjure')
+    key_length = key_length or config.read('auth.key_length', default=6)
+    key_valid_duration = key_valid_duration or config.read('auth.key_valid_duration', default=30)
+    hash_algorithm = hash_algorithm or config.read('auth.hash_algorithm', default='SHA256')
+
+    validate_key_length(key_length)
+    validate_key_valid_duration(key_valid_duration)
+    validate_hash_algorithm(hash_algorithm)
+
+    return key_length, key_valid_duration, hash_algorithm
+
+
+def bulk_provision_users(users, chunk_size=None, validate=None):
+    """Provision users from a (possibly very long) iterable, a chunk at a time.
+
+    Each chunk costs one query for existing users and one multi-row insert
+    each for users and recovery codes, inside a single transaction. Users that
+    are invalid or already exist are reported and skipped, without affecting
+    the rest of the chunk.
+    :param users: iterable of dicts of provision_user kwargs
+    :param chunk_size: users per transaction, defaults to config
+    :param validate: optional callable given each user, returning why it's
+        invalid or None, such as a check against the provision route's schema
+    :returns: generator of BulkProvisionResult, in input order
+    """
+    if chunk_size is None:
+        config = staticconf.NamespaceReaders('adjure')
+        chunk_size = config.read_int('auth.bulk_provision.chunk_size', default=500)
+
+    users = iter(users)
+    while True:
+        chunk = list(itertools.islice(users, chunk_size))
+        if not chunk:
+            return
+        for result in _bulk_provision_chunk(chunk, validate):
+            yield result
+
+
+def _bulk_provision_chunk(chunk, validate):
+    results = [None] * len(chunk)
+    rows = {}
+    for index, user in enumerate(chunk):
+        try:
+            row = _bulk_user_row(user, validate)
+        except UserCreationException as e:
+            user_id = user.get('user_id') if isinstance(user, dict) else None
+            results[index] = BulkProvisionResult(user_id, None, e)
+            continue
+
+        if row['user_id'] in rows:
+            results[index] = BulkProvisionResult(
+                row['user_id'],
+                None,
+                UserAlreadyProvisionedException(
+                    'User id {} is repeated in this batch.'.format(row['user_id'])
+                ),
+            )
+            continue
+        rows[row['user_id']] = (index, row)
+
+    for shard, user_ids in group_by_shard(rows):
+        shard_rows = [rows[user_id][1] for user_id in user_ids]
+        try:
+            _insert_users(shard, shard_rows)
+        except DBAPIError:
+            # Someone else provisioned one of these users between our existence
+            # check and our insert, or the database refused one of the rows
+            # (such as a DataError for an over-long user_id). One at a time,
+            # only the users at fault fail.
+            _rollback_insert(shard, shard_rows)
+            for row in shard_rows:
+                _insert_user(shard, row)
+
+    for user_id, (index, row) in rows.items():
+        invalidate_user_cache(user_id)
+        results[index] = BulkProvisionResult(
+            user_id,
+            row.get('recovery_codes'),
+            row.get('error'),
+        )
+
+    return results
+
+
+def _bulk_user_row(user, validate=None):
+    if not isinstance(user, dict) or not isinstance(user.get('user_id'), str):
+        raise UserCreationException('Each user must be an object with a string user_id.')
+
+    unknown_fields = set(user) - PROVISION_FIELDS
+    if unknown_fields:
+        raise UserCreationException('Unknown fields {} for user {}.'.format(
+            sorted(unknown_fields),
+            user['user_id'],
+        ))
+
+    error = validate and validate(user)
+    if error:
+        raise UserCreationException('Invalid user {}: {}'.format(user['user_id'], error))
+
+    key_length, key_valid_duration, hash_algorithm = provision_params(
+        user.get('key_length'),
+        user.get('key_valid_duration'),
+        user.get('hash_algorithm'),
+    )
+    return {
+        'user_id': user['user_id'],
+        'key_length': key_length,
+        'key_valid_duration': key_valid_duration,
+        'hash_algorithm': hash_algorithm,
+    }
+
+
+def _insert_users(shard, rows):
+    """Insert and commit every row in rows, which all belong on shard, that
+    doesn't already exist, marking existing users with an error.
+    """
+    pending = [row for row in rows if 'error' not in row]
+    if not pending:
+        return
+
+    existing = set()
+    for lookup_shard in lookup_shards(shard):
+        existing.update(
+            user_id for user_id, in lookup_shard.session.query(AuthUser.user_id).filter(
+                AuthUser.user_id.in_([row['user_id'] for row in pending])
+            )
+        )
+    new_rows = []
+    for row in pending:
+        if row['user_id'] in existing:
+            row['error'] = UserAlreadyProvisionedException(
+                'User id {} already provisioned.'.format(row['user_id'])
+            )
+        else:
+            new_rows.append(row)
+
+    secrets = _random_chunks(SECRET_KEY_BYTES, len(new_rows))
+    codes = _random_chunks(RECOVERY_CODE_BYTES, len(new_rows) * RECOVERY_CODE_COUNT)
+    recovery_code_rows = []
+    for row, secret in zip(new_rows, secrets):
+        row['secret'], row['secret_key_version'] = encryption.encrypt_secret(row['user_id'], secret)
+        row['recovery_codes'] = [
+            binascii.hexlify(next(codes)).decode('ASCII')
+            for _ in range(RECOVERY_CODE_COUNT)
+        ]
+        recovery_code_rows.extend(
+            {'user_id': row['user_id'], 'code_hash': hash_recovery_code(code), 'used': False}
+            for code in row['recovery_codes']
+        )
+
+    shard.session.bulk_insert_mappings(AuthUser, [
+        {
+            'user_id': row['user_id'],
+            'secret': row['secret'],
+            'secret_key_version': row['secret_key_version'],
+            'key_length': row['key_length'],
+            'key_valid_duration': row['key_valid_duration'],
+            'hash_algorithm': row['hash_algorithm'],
+        }
+        for row in new_rows
+    ])
+    shard.session.bulk_insert_mappings(RecoveryCode, recovery_code_rows)
+    shard.session.commit()
+
+
+def _insert_user(shard, row):
+    """Insert a single row, marking it with an error if the database
+    refuses it
+    """
+    try:
+        _insert_users(shard, [row])
+    except IntegrityError:
+        # The existence check would have caught an earlier user, so this is
+        # another racing provision
+        _rollback_insert(shard, [row])
+        row['error'] = UserCreationException(
+            'User id {} could not be provisioned, try again.'.format(row['user_id'])
+        )
+    except DBAPIError:
+        _rollback_insert(shard, [row])
+        row['error'] = UserCreationException(
+            'User id {} was refused by the database.'.format(row['user_id'])
+        )
+
+
+def _rollback_insert(shard, rows):
+    """Roll back a failed _insert_users, forgetting the recovery codes it
+    generated for rows
+    """
+    shard.session.rollback()
+    for row in rows:
+        row.pop('recovery_codes', None)
+
+
+def _random_chunks(size, count):
+    """Read count * size random bytes in one go, and slice them up"""
+    block = entropy.random_bytes(size * count)
+    return (block[i:i + size] for i in range(0, size * count, size))
+
+
 def authorize_user(user_id, code_to_verify):
-    """Authorize the user given a code entry.
+    """Authorize the user given a code entry from any of their devices.
     :param user_id: int
     :param code_to_verify: ASCII encoded bytes
+    :returns: the name of the device that matched
     """
     config = staticconf.NamespaceReaders('adjure')
     sliding_windows = config.read_int('sliding_windows', default=1)
-    user = load_user(user_id)
+    now = current_time()
+    check_not_replayed(user_id, now, sliding_windows)
+    user = load_user_params(user_id)
 
     if not user:
-        raise ValidationException('{} is not a known user.'.format(user_id))
+        raise UnknownUserException('{} is not a known user.'.format(user_id))
 
-    return totp_verify(
-        user.secret,
-        user.key_length,
-        user.hash_algorithm,
-        user.key_valid_duration,
+    return verify_user_code(user, code_to_verify, now, sliding_windows)
+
+
+def authorize_users(attempts):
+    """Authorize many users at once, loading them all up front.
+    :param attempts: list of (user_id, code_to_verify) tuples, where
+        code_to_verify is ASCII encoded bytes
+    :returns: list of AuthorizeResult, in the same order as attempts
+    """
+    config = staticconf.NamespaceReaders('adjure')
+    sliding_windows = config.read_int('sliding_windows', default=1)
+    now = current_time()
+
+    results = [None] * len(attempts)
+    for index, (user_id, _) in enumerate(attempts):
+        try:
+            check_not_replayed(user_id, now, sliding_windows)
+        except ReplayedCodeException as e:
+            results[index] = AuthorizeResult(None, e)
+
+    users_params = load_users_params(
+        user_id for index, (user_id, _) in enumerate(attempts)
+        if results[index] is None
+    )
+    for index, (user_id, code_to_verify) in enumerate(attempts):
+        if results[index] is not None:
+            continue
+
+        user = users_params[str(user_id)]
+        try:
+            if not user:
+                raise UnknownUserException('{} is not a known user.'.format(user_id))
+            results[index] = AuthorizeResult(
+                verify_user_code(user, code_to_verify, now, sliding_windows),
+                None,
+            )
+        except ValidationException as e:
+            results[index] = AuthorizeResult(None, e)
+
+    return results
+
+
+def check_not_replayed(user_id, now, sliding_windows):
+    """Cheaply reject users whose last accepted time step is at or past the
+    newest step that could still be accepted, without loading the user.
+    """
+    last = get_replay_ledger().last_step(str(user_id), now)
+    if last is None:
+        return
+
+    last_step, key_valid_duration = last
+    newest_step = int((now + key_valid_duration * sliding_windows) / key_valid_duration)
+    if newest_step <= last_step:
+        raise ReplayedCodeException('That code has already been used.')
+
+
+def verify_user_code(user, code_to_verify, now, sliding_windows):
+    """Verify a code against every device of a loaded user, and record the
+    time step it matched so it can't be used again, from any device.
+    :param user: UserParams
+    :returns: the name of the device that matched
+    """
+    match = match_code(
+        [
+            (device, get_user_verifier(credential))
+            for device, credential in user_credentials(user)
+        ],
         code_to_verify,
-        current_time(),
+        now,
         sliding_windows,
     )
+    if match is None:
+        raise ValidationException('Invalid code was given.')
+    device, time_step = match
+
+    # After this the step has slid out of every window, so the verifier
+    # would reject it anyway and the ledger can forget it.
+    expires_at = (time_step + sliding_windows + 1) * user.key_valid_duration
+    if not get_replay_ledger().record(
+        str(user.user_id), time_step, user.key_valid_duration, expires_at, now,
+    ):
+        raise ReplayedCodeException('That code has already been used.')
+
+    return device
+
+
+def user_credentials(user):
+    """:returns: list of (device name, UserParams or DeviceParams) for every
+    credential of a user, their own first
+    """
+    return [(DEFAULT_DEVICE, user)] + [(device.name, device) for device in user.devices]
+
+
+def user_credential(user, device=None):
+    """:returns: UserParams or DeviceParams for the named device of a user,
+    or None if the user has no such device
+    """
+    return dict(user_credentials(user)).get(device or DEFAULT_DEVICE)
 
 
 def current_time():
     return math.floor(time.time())
 
 
-def get_auth_code_for_user(user):
-    totp = get_totp(
+def get_auth_code_for_user(user, device=None):
+    """:param user: UserParams, or AuthUser for the user's own credential
+    :param device: name of the device to get a code for, defaults to the
+        user's own credential
+    """
+    credential = user_credential(user, device) if device else user
+    if credential is None:
+        return None
+    return get_user_verifier(credential).generate(current_time()).decode('ASCII')
+
+
+def get_user_verifier(user):
+    """Get a TOTPVerifier for a user's stored secret. The secret is only
+    decrypted when there's no verifier cached for it.
+    :param user: UserParams or AuthUser
+    """
+    cache = get_verifier_cache()
+    key = (
+        str(user.user_id),
         user.secret,
+        user.secret_key_version,
         user.key_length,
         user.hash_algorithm,
-        user.key_valid_duration
+        user.key_valid_duration,
     )
+    verifier = cache.get(key)
+    if verifier is None:
+        with encryption.decrypted_secret(user.user_id, user.secret, user.secret_key_version) as secret:
+            verifier = TOTPVerifier(secret, user.key_length, user.hash_algorithm, user.key_valid_duration)
+        cache.set(key, verifier)
+    return verifier
 
-    return totp.generate(current_time()).decode('ASCII')
+
+def get_verifier(secret, key_length, hash_algorithm, key_valid_duration):
+    """Get a TOTPVerifier, reusing a cached one for the same parameters.
+    The secret is part of the key, so a rotated secret never hits a stale
+    verifier.
+    """
+    cache = get_verifier_cache()
+    key = (secret, key_length, hash_algorithm, key_valid_duration)
+    verifier = cache.get(key)
+    if verifier is None:
+        verifier = TOTPVerifier(secret, key_length, hash_algorithm, key_valid_duration)
+        cache.set(key, verifier)
+    return verifier
 
 
 def get_totp(secret, key_length, hash_algorithm, key_valid_duration):
@@ -166,24 +978,17 @@ def totp_verify(
     :param current_time: When to consider 'now' as a unix timestamp
     :param sliding_windows: number of time windows on each side to consider
     """
-    totp = get_totp(
+    verifier = get_verifier(
         secret,
         key_length,
         hash_algorithm,
         key_valid_duration,
     )
 
-    for window_time in sliding_time_window(
-        current_time, key_valid_duration, sliding_windows,
-    ):
-        try:
-            totp.verify(code_to_verify, window_time)
-        except InvalidToken:
-            pass
-        else:
-            return True
+    if verifier.verify(code_to_verify, current_time, sliding_windows) is None:
+        raise ValidationException('Invalid code was given.')
 
-    raise ValidationException('Invalid code was given.')
+    return True
 
 
 def sliding_time_window(current_time, key_valid_duration, sliding_windows):
@@ -194,56 +999,332 @@ def sliding_time_window(current_time, key_valid_duration, sliding_windows):
     )
 
 
-def user_auth_uri(user_id, username, issuer):
+def user_auth_uri(user_id, username, issuer, device=None):
     """
     :param username: The username that should show up on the user's auth app
+    :param device: name of the device to enroll, defaults to the user's own
+        credential
+    :returns: the otpauth URI, or None if the user or device doesn't exist
     """
-    user = load_user(user_id)
+    user = load_user_params(user_id)
+    user = user and user_credential(user, device)
     if not user:
         return None
 
-    totp = get_totp(
-        user.secret,
-        user.key_length,
-        user.hash_algorithm,
-        user.key_valid_duration,
-    )
+    with encryption.decrypted_secret(user.user_id, user.secret, user.secret_key_version) as secret:
+        totp = get_totp(
+            secret,
+            user.key_length,
+            user.hash_algorithm,
+            user.key_valid_duration,
+        )
+        # The handler keeps a reference to the secret, so use it before
+        # the secret is zeroed
+        return totp.get_provisioning_uri(username, issuer)
+
+
+def read_recovery_code_pepper():
+    """:returns: auth.recovery_code_pepper, as bytes
+    :raises ValueError: if it isn't set, since hashing with an empty key
+        would leave codes effectively unkeyed
+    """
+    config = staticconf.NamespaceReaders('adjure')
+    pepper = config.read_string('auth.recovery_code_pepper', default='')
+    if not pepper:
+        raise ValueError('auth.recovery_code_pepper must be set to hash recovery codes')
+    return pepper.encode('utf-8')
 
-    return totp.get_provisioning_uri(username, issuer)
+
+def hash_recovery_code(recovery_code):
+    """HMAC-SHA256 of a recovery code, keyed with the server's pepper.
+    Codes are long and random, so a fast keyed hash is enough to make a
+    database dump useless without the pepper.
+    :returns: hex digest
+    """
+    digest = hmac.HMAC(read_recovery_code_pepper(), SHA256(), backend=default_backend())
+    digest.update(recovery_code.encode('utf-8'))
+    return binascii.hexlify(digest.finalize()).decode('ASCII')
+
+
+def new_recovery_code(code):
+    recovery_code = RecoveryCode(code_hash=hash_recovery_code(code))
+    recovery_code.code = code
+    return recovery_code
 
 
 def generate_recovery_codes_for_user(user, count=RECOVERY_CODE_COUNT):
     user.recovery_codes = [
-        RecoveryCode(code=str(uuid.uuid4()).replace('-', ''))
+        new_recovery_code(entropy.random_hex(RECOVERY_CODE_BYTES))
         for _ in range(count)
     ]
-    session.flush()
+    object_session(user).flush()
     return user
 
 
 def clear_current_recovery_codes(user_id):
-    return session.query(RecoveryCode).filter(
+    return shard_for(user_id).session.query(RecoveryCode).filter(
         RecoveryCode.user_id == user_id
     ).delete()
 
 
-def regenerate_user_recovery_codes(user_id):
-    clear_current_recovery_codes(user_id)
-    return generate_recovery_codes_for_user(load_user(user_id))
+def regenerate_user_recovery_codes(user_id, count=RECOVERY_CODE_COUNT):
+    """Replace all of a user's recovery codes, in one transaction of a
+    single DELETE and a single multi-row INSERT.
+    :returns: the AuthUser, with the new codes (including plaintext) as its
+        recovery_codes, or None if the user doesn't exist
+    """
+    user_table = AuthUser.__table__
+    code_table = RecoveryCode.__table__
+
+    # Lock the user's row first, so concurrent regenerations are serialized
+    # instead of each adding a set of codes. It's a write even on databases
+    # without row locks, which takes their write lock.
+    for shard in user_shards(user_id):
+        session = shard.session
+        locked = session.execute(
+            user_table.update().where(
+                user_table.c.user_id == user_id
+            ).values(user_id=user_table.c.user_id)
+        ).rowcount
+        if locked == 1:
+            break
+        session.rollback()
+    else:
+        return None
+
+    recovery_codes = [
+        new_recovery_code(entropy.random_hex(RECOVERY_CODE_BYTES))
+        for _ in range(count)
+    ]
+    session.execute(code_table.delete().where(code_table.c.user_id == user_id))
+    inserted = session.execute(code_table.insert().values([
+        {'user_id': user_id, 'code_hash': recovery_code.code_hash, 'used': False}
+        for recovery_code in recovery_codes
+    ])).rowcount
+    if inserted != count:
+        session.rollback()
+        raise RecoveryCodeRegenerationError(
+            'Inserted {} recovery codes, expected {}'.format(inserted, count)
+        )
+    session.commit()
+
+    user = load_user(user_id)
+    for recovery_code in recovery_codes:
+        recovery_code.user_id = user.user_id
+    # The codes were written without the ORM, so tell it what they are
+    set_committed_value(user, 'recovery_codes', recovery_codes)
+    return user
 
 
 def consume_recovery_code(user_id, recovery_code):
-    code = session.query(RecoveryCode).filter(
-        RecoveryCode.user_id == user_id,
-        RecoveryCode.code == recovery_code,
-        RecoveryCode.used.is_(False)
-    ).first()
+    """Mark a recovery code used, and commit, with a single conditional
+    UPDATE. Whichever of several concurrent requests for the same code
+    updates the row wins, and the rest see a row count of 0.
+    """
+    code_hash = hash_recovery_code(recovery_code)
+    for shard in user_shards(user_id):
+        consumed = shard.session.query(RecoveryCode).filter(
+            RecoveryCode.user_id == user_id,
+            RecoveryCode.code_hash == code_hash,
+            RecoveryCode.used.is_(False)
+        ).update({'used': True}, synchronize_session='evaluate')
 
-    if not code:
-        raise RecoveryCodeConsumptionError(
-            'That recovery code has already been used, '
-            'or doesn\'t exist for this user'
+        if consumed == 1:
+            shard.session.commit()
+            return
+        shard.session.rollback()
+
+    raise RecoveryCodeConsumptionError(
+        'That recovery code has already been used, '
+        'or doesn\'t exist for this user'
+    )
+
+
+def migrate_plaintext_recovery_codes(batch_size=1000):
+    """Hash recovery codes stored before codes were hashed, on every shard,
+    a batch per transaction, clearing the plaintext as it goes.
+    :returns: the number of codes hashed
+    """
+    return sum(
+        _migrate_shard_plaintext_recovery_codes(shard.session, batch_size)
+        for shard in shards
+    )
+
+
+def _migrate_shard_plaintext_recovery_codes(session, batch_size):
+    table = RecoveryCode.__table__
+    migrated = 0
+    while True:
+        rows = session.query(RecoveryCode.id, RecoveryCode.plaintext_code).filter(
+            RecoveryCode.code_hash.is_(None),
+            RecoveryCode.plaintext_code.isnot(None),
+        ).limit(batch_size).all()
+        if not rows:
+            return migrated
+
+        session.execute(
+            table.update().where(table.c.id == bindparam('row_id')).values(
+                code_hash=bindparam('code_hash'),
+                code=None,
+            ),
+            [
+                {'row_id': row_id, 'code_hash': hash_recovery_code(plaintext_code)}
+                for row_id, plaintext_code in rows
+            ],
+        )
+        session.commit()
+        migrated += len(rows)
+
+
+def rotate_secret_keys(batch_size=1000):
+    """Re-encrypt every secret not encrypted with the current key version
+    (including unencrypted ones) with it, on every shard, a batch per
+    transaction. Safe to run while serving requests, as long as the old keys
+    stay configured until it's done and user caches have expired.
+    :returns: the number of secrets re-encrypted
+    """
+    key_version = encryption.current_key_version()
+    if key_version is None:
+        raise ValueError('auth.secret_encryption.current_version must be set to rotate secrets')
+
+    return sum(
+        _rotate_shard_secret_keys(shard.session, model, key_version, batch_size)
+        for shard in shards
+        for model in (AuthUser, AuthDevice)
+    )
+
+
+def _rotate_shard_secret_keys(session, model, key_version, batch_size):
+    table = model.__table__
+    rotated = 0
+    while True:
+        rows = session.query(
+            model.id,
+            model.user_id,
+            model.secret,
+            model.secret_key_version,
+        ).filter(
+            (model.secret_key_version.is_(None)) |
+            (model.secret_key_version != key_version)
+        ).limit(batch_size).all()
+        if not rows:
+            return rotated
+
+        updates = []
+        for row_id, user_id, stored_secret, old_key_version in rows:
+            secret = encryption.decrypt_secret(user_id, stored_secret, old_key_version)
+            try:
+                new_secret, _ = encryption.encrypt_secret(user_id, secret, key_version)
+            finally:
+                zero_bytes(secret)
+            updates.append({
+                'row_id': row_id,
+                'new_secret': new_secret,
+                'new_key_version': key_version,
+            })
+
+        session.execute(
+            table.update().where(table.c.id == bindparam('row_id')).values(
+                secret=bindparam('new_secret'),
+                secret_key_version=bindparam('new_key_version'),
+            ),
+            updates,
         )
+        session.commit()
+        rotated += len(rows)
+
+
+def rebalance_shards(batch_size=1000):
+    """Move every user that isn't on the shard it belongs on there, such as
+    after a shard is added or set to draining. Safe to run while serving
+    requests with database.rebalancing set, and to run again if interrupted.
+    :returns: the number of users moved
+    """
+    moved = 0
+    for source in shards:
+        last_user_id = ''
+        while True:
+            user_ids = [
+                user_id for user_id, in source.session.query(AuthUser.user_id).filter(
+                    AuthUser.user_id > last_user_id,
+                ).order_by(AuthUser.user_id).limit(batch_size)
+            ]
+            source.session.rollback()
+            if not user_ids:
+                break
+            last_user_id = user_ids[-1]
+
+            for user_id in user_ids:
+                target = shard_for(user_id)
+                if target is not source and move_user(user_id, source, target):
+                    moved += 1
+    return moved
+
+
+def move_user(user_id, source, target):
+    """Copy a user, its recovery codes and its devices from the source shard to
+    the target shard, then delete them from source. The user's rows on source stay
+    locked until then, so nothing changes underneath the copy.
+
+    If target already has the user, from a move that was interrupted, its
+    copy is kept: while rebalancing, lookups try target first, so that's the
+    one that has been in use since.
+    :returns: True if the user was moved, False if it wasn't on source
+    """
+    user_table = AuthUser.__table__
+    # Tables of rows belonging to the user
+    child_tables = [RecoveryCode.__table__, AuthDevice.__table__]
+
+    locked = source.session.execute(
+        user_table.update().where(
+            user_table.c.user_id == user_id
+        ).values(user_id=user_table.c.user_id)
+    ).rowcount
+    if locked != 1:
+        source.session.rollback()
+        return False
+
+    user_row = source.session.execute(
+        select([user_table]).where(user_table.c.user_id == user_id)
+    ).first()
+    child_rows = [
+        (table, source.session.execute(
+            select([table]).where(table.c.user_id == user_id).with_for_update()
+        ).fetchall())
+        for table in child_tables
+    ]
+
+    try:
+        target.session.execute(user_table.insert().values(_shard_row(user_table, user_row)))
+        for table, rows in child_rows:
+            if rows:
+                target.session.execute(table.insert().values([
+                    _shard_row(table, row) for row in rows
+                ]))
+        target.session.commit()
+    except IntegrityError:
+        target.session.rollback()
+        already_moved = target.session.execute(
+            select([user_table.c.user_id]).where(user_table.c.user_id == user_id)
+        ).first()
+        target.session.rollback()
+        if not already_moved:
+            # Some other constraint failed, so nothing was copied and the
+            # user has to stay on source
+            source.session.rollback()
+            raise
+
+    for table in child_tables:
+        source.session.execute(table.delete().where(table.c.user_id == user_id))
+    source.session.execute(user_table.delete().where(user_table.c.user_id == user_id))
+    source.session.commit()
+    return True
+
 
-    code.used = True
-    session.flush()
+def _shard_row(table, row):
+    # Primary keys are per shard, and rows reference users by user_id
+    return {
+        column.name: row[column]
+        for column in table.columns
+        if not column.primary_key
+    }
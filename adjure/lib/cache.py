@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A bounded, thread-safe LRU cache whose entries expire after a TTL.
+
+    Each uWSGI worker gets its own instance, so this is only suitable for data
+    that is cheap to be stale for up to `ttl` seconds.
+    """
+
+    def __init__(self, max_size, ttl, clock=time.monotonic, weigher=None):
+        """
+        :param max_size: maximum total weight of entries, 0 disables caching
+        :param ttl: default number of seconds an entry stays valid for
+        :param clock: callable returning the current time in seconds
+        :param weigher: callable giving the weight of a value, by default
+            every entry weighs 1 so max_size is an entry count
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._clock = clock
+        self._weigher = weigher or (lambda value: 1)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value, _ = entry
+            if expires_at <= self._clock():
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        weight = self._weigher(value)
+        if weight > self.max_size:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (self._clock() + ttl, value, weight)
+            self.size += weight
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def zero_bytes(buffer):
+    """Overwrite a bytearray with zeros, in place"""
+    buffer[:] = bytes(len(buffer))
+
+
+class SecretCache(LRUCache):
+    """An LRUCache of bytearrays, such as decrypted secrets, which are zeroed
+    as soon as they leave the cache. The cache keeps its own copy of each
+    value set, and get returns a new copy, made under the lock so an eviction
+    can't zero it halfway. Callers should zero their copies when done.
+    """
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = super(SecretCache, self).get(key)
+            return default if value is None else bytearray(value)
+
+    def set(self, key, value, ttl=None):
+        if self._weigher(value) > self.max_size:
+            return
+        super(SecretCache, self).set(key, bytearray(value), ttl=ttl)
+
+    def clear(self):
+        with self._lock:
+            for _, value, _ in self._entries.values():
+                zero_bytes(value)
+            super(SecretCache, self).clear()
+
+    def _remove(self, key):
+        entry = self._entries.get(key)
+        super(SecretCache, self)._remove(key)
+        if entry is not None:
+            zero_bytes(entry[1])
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Encryption of TOTP secrets at rest, with AES-GCM.
+
+Keys are configured by version in auth.secret_encryption.keys, and each user
+row records the version its secret was encrypted with. Keys are rotated by
+adding a version, making it current, and re-encrypting rows with
+`manage.py rotate-secret-keys`. The user_id is bound into each ciphertext as
+associated data, so a secret can't be copied to another user's row.
+
+Decrypted secrets are handed out as bytearrays, which are zeroed once used,
+and kept in a per-worker SecretCache so most requests don't decrypt at all.
+That narrows, but doesn't close, the window plaintext spends in memory:
+cryptography returns it as immutable bytes first, and the keyed HMAC contexts
+in auth's verifier cache hold key material derived from it until they expire.
+"""
+import base64
+import contextlib
+
+import staticconf
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import algorithms
+from cryptography.hazmat.primitives.ciphers import Cipher
+from cryptography.hazmat.primitives.ciphers import modes
+
+from adjure.lib import entropy
+from adjure.lib import metrics
+from adjure.lib.cache import SecretCache
+from adjure.lib.cache import zero_bytes
+
+
+NONCE_BYTES = 12
+TAG_BYTES = 16
+KEY_SIZES = (16, 24, 32)
+
+_secret_cache = None
+
+
+class SecretDecryptionException(ValueError):
+    """Raised when a stored secret can't be decrypted"""
+
+
+def read_keys():
+    """:returns: dict of key version to AES key bytes"""
+    config = staticconf.NamespaceReaders('adjure')
+    keys = {}
+    for key_config in config.read_list('auth.secret_encryption.keys', default=[]):
+        key = base64.b64decode(key_config['key'])
+        if len(key) not in KEY_SIZES:
+            raise ValueError('Secret encryption key version {} must be one of {} bytes'.format(
+                key_config['version'],
+                KEY_SIZES,
+            ))
+        keys[int(key_config['version'])] = key
+    return keys
+
+
+def current_key_version():
+    """The key version new secrets are encrypted with, or None to store them
+    unencrypted
+    """
+    config = staticconf.NamespaceReaders('adjure')
+    return config.read_int('auth.secret_encryption.current_version', default=0) or None
+
+
+def read_key(key_version):
+    keys = read_keys()
+    if key_version not in keys:
+        raise SecretDecryptionException(
+            'Secret encryption key version {} is not configured'.format(key_version)
+        )
+    return keys[key_version]
+
+
+def get_secret_cache():
+    global _secret_cache
+    if _secret_cache is None:
+        config = staticconf.NamespaceReaders('adjure')
+        _secret_cache = SecretCache(
+            max_size=config.read_int('auth.secret_encryption.cache.max_size', default=10000),
+            ttl=config.read_int('auth.secret_encryption.cache.ttl', default=300),
+        )
+        metrics.registry.track_cache('secret', _secret_cache)
+    return _secret_cache
+
+
+def encrypt_secret(user_id, secret, key_version=None):
+    """Encrypt a secret for storage in user_id's row.
+    :param key_version: defaults to the current version
+    :returns: (stored secret, key version), where the key version is None and
+        the secret is stored as is if there is no current key
+    """
+    if key_version is None:
+        key_version = current_key_version()
+    if key_version is None:
+        return bytes(secret), None
+
+    nonce = entropy.random_bytes(NONCE_BYTES)
+    encryptor = Cipher(
+        algorithms.AES(read_key(key_version)),
+        modes.GCM(nonce),
+        backend=default_backend(),
+    ).encryptor()
+    encryptor.authenticate_additional_data(str(user_id).encode('utf-8'))
+    ciphertext = encryptor.update(bytes(secret)) + encryptor.finalize()
+    return nonce + ciphertext + encryptor.tag, key_version
+
+
+def decrypt_secret(user_id, stored_secret, key_version):
+    """Decrypt a stored secret into a bytearray. The plaintext comes back
+    from cryptography as bytes, which can't be zeroed, so it is copied and
+    dropped straight away.
+    :returns: bytearray, which the caller should zero when done
+    """
+    if key_version is None:
+        return bytearray(stored_secret)
+
+    stored_secret = bytes(stored_secret)
+    nonce = stored_secret[:NONCE_BYTES]
+    ciphertext = stored_secret[NONCE_BYTES:-TAG_BYTES]
+    decryptor = Cipher(
+        algorithms.AES(read_key(key_version)),
+        modes.GCM(nonce, stored_secret[-TAG_BYTES:]),
+        backend=default_backend(),
+    ).decryptor()
+    decryptor.authenticate_additional_data(str(user_id).encode('utf-8'))
+
+    secret = bytearray(decryptor.update(ciphertext))
+    try:
+        decryptor.finalize()
+    except InvalidTag:
+        zero_bytes(secret)
+        raise SecretDecryptionException(
+            'Secret of user {} does not decrypt with key version {}'.format(user_id, key_version)
+        )
+    return secret
+
+
+@contextlib.contextmanager
+def decrypted_secret(user_id, stored_secret, key_version):
+    """The plaintext of a stored secret, as a bytearray that is zeroed when
+    the block exits. Decrypted secrets are cached, so this decrypts at most
+    once per auth.secret_encryption.cache.ttl per worker.
+    """
+    if key_version is None:
+        secret = bytearray(stored_secret)
+    else:
+        cache = get_secret_cache()
+        cache_key = (str(user_id), key_version, bytes(stored_secret))
+        secret = cache.get(cache_key)
+        if secret is None:
+            secret = decrypt_secret(user_id, stored_secret, key_version)
+            cache.set(cache_key, secret)
+
+    try:
+        yield secret
+    finally:
+        zero_bytes(secret)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Random bytes for secrets and recovery codes, read from os.urandom in large
+blocks instead of a syscall per value.
+
+Buffered bytes are thrown away in forked children, so uWSGI workers forked
+from the same master never hand out the same secrets. The buffer is zeroed
+as it's handed out, and when it's thrown away, so it doesn't keep copies of
+issued secrets.
+"""
+import binascii
+import os
+import threading
+
+import staticconf
+
+from adjure.lib.cache import zero_bytes
+
+
+_pool = None
+
+
+class EntropyPool(object):
+
+    def __init__(self, block_size):
+        """
+        :param block_size: bytes read from os.urandom at a time. Reads larger
+            than this go straight to os.urandom.
+        """
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._discard()
+
+    def _discard(self):
+        if getattr(self, '_buffer', None):
+            zero_bytes(self._buffer)
+        self._buffer = bytearray()
+        self._offset = 0
+        self._pid = os.getpid()
+
+    def after_fork(self):
+        # The parent may have been holding the lock when it forked
+        self._lock = threading.Lock()
+        self._discard()
+
+    def read(self, size):
+        if size > self.block_size:
+            return os.urandom(size)
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._discard()
+            if len(self._buffer) - self._offset < size:
+                zero_bytes(self._buffer)
+                self._buffer = bytearray(os.urandom(self.block_size))
+                self._offset = 0
+            end = self._offset + size
+            data = bytes(self._buffer[self._offset:end])
+            self._buffer[self._offset:end] = bytes(size)
+            self._offset = end
+            return data
+
+
+def get_entropy_pool():
+    global _pool
+    if _pool is None:
+        config = staticconf.NamespaceReaders('adjure')
+        _pool = EntropyPool(config.read_int('auth.entropy_block_size', default=65536))
+    return _pool
+
+
+def _after_fork_in_child():
+    if _pool is not None:
+        _pool.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def random_bytes(size):
+    return get_entropy_pool().read(size)
+
+
+def random_hex(size):
+    """size random bytes, as 2 * size lowercase hex characters"""
+    return binascii.hexlify(random_bytes(size)).decode('ASCII')
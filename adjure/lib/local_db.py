@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class ThreadLocalConnection(object):
+    """SQLite connections to a local file, one per thread and per process.
+
+    sqlite3 connections can't be shared across threads, or survive a fork, so
+    this is how state is shared between the uWSGI workers on a host.
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                isolation_level=None,
+            )
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def execute(self, *args):
+        return self.get().execute(*args)
+
+    @contextmanager
+    def transaction(self):
+        """Take the database write lock up front, so read-modify-write
+        sequences are atomic across processes.
+        """
+        connection = self.get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""Prometheus style metrics.
+
+Each process keeps its own counters and histograms. When
+metrics.multiprocess_dir is set, every process also writes its samples to
+<dir>/<pid>.json (at most once per metrics.flush_interval seconds), and
+/metrics sums the files of every process, so a scrape of any one uWSGI
+worker covers them all. When a worker exits, or is found to have died, its
+counters and histograms are folded into <dir>/archive.json and its file is
+removed, so totals never go backwards.
+"""
+import atexit
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+import staticconf
+
+
+# Prometheus' default buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+# For work that takes microseconds, like an HMAC
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+_INF = float('inf')
+
+ARCHIVE_NAME = 'archive'
+
+_flush_lock = threading.Lock()
+_next_flush = 0
+# The process that last flushed, so a new one (after a fork, or a reused
+# pid) can archive a file left under its pid first
+_flushed_pid = None
+
+
+class Registry(object):
+    """Every metric of this process, and their current values"""
+
+    def __init__(self):
+        self.metrics = []
+        self._caches = {}
+        self._values = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def track_cache(self, name, cache):
+        """Report the hits and misses of an LRUCache through every
+        CacheCounter
+        """
+        self._caches[name] = cache
+
+    def add(self, key, amount):
+        """Add amount to the sample at key, a (sample name, labels) tuple"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked, and the parent's values aren't ours to report
+                self._values.clear()
+                self._pid = os.getpid()
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """:returns: dict of (sample name, labels) to value for this process"""
+        with self._lock:
+            samples = dict(self._values) if self._pid == os.getpid() else {}
+
+        for metric in self.metrics:
+            if isinstance(metric, CacheCounter):
+                samples.update(metric.cache_samples(self._caches))
+        return samples
+
+    def cumulative_names(self):
+        """:returns: set of the sample names of every counter and histogram,
+        whose values are kept after their process exits
+        """
+        names = set()
+        for metric in self.metrics:
+            if metric.type == 'histogram':
+                names.update(metric.name + suffix for suffix in ('_bucket', '_sum', '_count'))
+            elif metric.type == 'counter':
+                names.add(metric.name)
+        return names
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._caches.clear()
+
+
+registry = Registry()
+
+
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def labels_key(self, labels):
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        registry.add((self.name, self.labels_key(labels)), amount)
+
+
+class CacheCounter(Counter):
+    """A count kept by each cache given to Registry.track_cache, in the
+    attribute named by attribute, rather than incremented here
+    """
+
+    def __init__(self, name, documentation, attribute):
+        super(CacheCounter, self).__init__(name, documentation, ['cache'])
+        self.attribute = attribute
+
+    def inc(self, amount=1, **labels):
+        raise TypeError('{} is read from its caches'.format(self.name))
+
+    def cache_samples(self, caches):
+        return {
+            (self.name, self.labels_key({'cache': name})): getattr(cache, self.attribute)
+            for name, cache in caches.items()
+        }
+
+
+class Histogram(Counter):
+    """Observations counted into buckets. Buckets are stored per bucket and
+    only made cumulative when rendered, which keeps merging simple.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (_INF,)
+
+    def observe(self, value, **labels):
+        labels_key = self.labels_key(labels)
+        for bound in self.buckets:
+            if value <= bound:
+                break
+        registry.add(('{}_bucket'.format(self.name), labels_key + (('le', bound),)), 1)
+        registry.add(('{}_sum'.format(self.name), labels_key), value)
+        registry.add(('{}_count'.format(self.name), labels_key), 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+REQUESTS = Counter(
+    'adjure_http_requests_total',
+    'HTTP requests handled',
+    ['endpoint', 'method', 'status'],
+)
+REQUEST_DURATION = Histogram(
+    'adjure_http_request_duration_seconds',
+    'Time to handle an HTTP request',
+    ['endpoint'],
+)
+LOAD_USER_DURATION = Histogram(
+    'adjure_load_user_duration_seconds',
+    'Time spent querying the database for users',
+)
+VERIFY_DURATION = Histogram(
+    'adjure_totp_verify_duration_seconds',
+    'Time spent computing and comparing TOTP codes',
+    buckets=FAST_BUCKETS,
+)
+QR_RENDER_DURATION = Histogram(
+    'adjure_qr_render_duration_seconds',
+    'Time to render a QR code image, on a cache miss',
+    ['format'],
+)
+VERIFICATIONS = Counter(
+    'adjure_verifications_total',
+    'Authentication attempts by outcome',
+    ['outcome'],
+)
+CACHE_HITS = CacheCounter(
+    'adjure_cache_hits_total',
+    'Cache lookups that found a live entry',
+    'hits',
+)
+CACHE_MISSES = CacheCounter(
+    'adjure_cache_misses_total',
+    'Cache lookups that found nothing, or an expired entry',
+    'misses',
+)
+
+
+def multiprocess_dir():
+    config = staticconf.NamespaceReaders('adjure')
+    return config.read_string('metrics.multiprocess_dir', default='')
+
+
+def encode_samples(samples):
+    return [
+        [name, [list(label) for label in labels], value]
+        for (name, labels), value in samples.items()
+    ]
+
+
+def decode_samples(encoded):
+    return {
+        (name, tuple(tuple(label) for label in labels)): value
+        for name, labels, value in encoded
+    }
+
+
+def process_path(directory, pid):
+    return os.path.join(directory, '{}.json'.format(pid))
+
+
+def read_samples(path):
+    """:returns: the samples in path, or None if it's gone or half written"""
+    try:
+        with open(path) as f:
+            return decode_samples(json.load(f))
+    except (IOError, ValueError):
+        return None
+
+
+def write_samples(path, samples):
+    temp_path = '{}.tmp'.format(path)
+    with open(temp_path, 'w') as f:
+        json.dump(encode_samples(samples), f)
+    os.replace(temp_path, path)
+
+
+@contextlib.contextmanager
+def archive_lock(directory):
+    """Held while folding a process's file into the archive, so two workers
+    never fold the same one
+    """
+    with open(os.path.join(directory, '{}.lock'.format(ARCHIVE_NAME)), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def archive_process(directory, pid):
+    """Add the counters and histograms in pid's file to the archive, and
+    remove the file. Anything else, like a gauge, dies with its process.
+    """
+    path = process_path(directory, pid)
+    with archive_lock(directory):
+        process_samples = read_samples(path)
+        if process_samples is None:
+            return
+
+        archive_path = os.path.join(directory, '{}.json'.format(ARCHIVE_NAME))
+        archive = read_samples(archive_path) or {}
+        cumulative_names = registry.cumulative_names()
+        for key, value in process_samples.items():
+            if key[0] in cumulative_names:
+                archive[key] = archive.get(key, 0) + value
+        write_samples(archive_path, archive)
+        os.remove(path)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists, but belongs to someone else
+        return True
+    return True
+
+
+def flush(force=False):
+    """Write this process's samples to the multiprocess directory, if there
+    is one and it hasn't been done within metrics.flush_interval.
+    """
+    global _next_flush, _flushed_pid
+    directory = multiprocess_dir()
+    now = time.monotonic()
+    pid = os.getpid()
+    if not directory or (not force and now < _next_flush and _flushed_pid == pid):
+        return
+
+    config = staticconf.NamespaceReaders('adjure')
+    _next_flush = now + config.read_float('metrics.flush_interval', default=1.0)
+
+    with _flush_lock:
+        if _flushed_pid != pid:
+            # A file already under our pid is a dead process's, which reused it
+            archive_process(directory, pid)
+            _flushed_pid = pid
+        write_samples(process_path(directory, pid), registry.samples())
+
+
+def shutdown():
+    """Flush this process's last samples, and fold them into the archive.
+    Run when a worker exits, including when uWSGI reloads it.
+    """
+    directory = multiprocess_dir()
+    if directory and _flushed_pid == os.getpid():
+        flush(force=True)
+        archive_process(directory, os.getpid())
+
+
+def install_exit_hook():
+    """Run shutdown when this process, or any forked from it, exits"""
+    atexit.register(shutdown)
+
+
+def clear_multiprocess_dir():
+    """Remove the files of a previous run. Run before workers are forked."""
+    directory = multiprocess_dir()
+    if directory:
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(path)
+
+
+def collect():
+    """:returns: dict of (sample name, labels) to value, summed over every
+    process when running in multiprocess mode
+    """
+    directory = multiprocess_dir()
+    if not directory:
+        return registry.samples()
+
+    flush(force=True)
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name.isdigit() and not is_alive(int(name)):
+            # Exited without running shutdown, e.g. killed
+            archive_process(directory, int(name))
+
+    samples = {}
+    # Without the lock, a file being archived could be counted twice or not
+    # at all
+    with archive_lock(directory):
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            process_samples = read_samples(path)
+            if process_samples is None:
+                # Removed or rewritten since the glob
+                continue
+            for key, value in process_samples.items():
+                samples[key] = samples.get(key, 0) + value
+    return samples
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, format_value(value) if name == 'le' else escape_label_value(value))
+        for name, value in labels
+    ))
+
+
+def format_value(value):
+    if value == _INF:
+        return '+Inf'
+    return repr(float(value))
+
+
+def render_text(samples):
+    """Render samples in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry.metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        if metric.type == 'histogram':
+            lines.extend(render_histogram(metric, samples))
+            continue
+        for (name, labels), value in sorted(samples.items()):
+            if name == metric.name:
+                lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def render_histogram(metric, samples):
+    bucket_name = '{}_bucket'.format(metric.name)
+    label_sets = sorted(
+        labels for name, labels in samples
+        if name == '{}_count'.format(metric.name)
+    )
+    lines = []
+    for labels in label_sets:
+        cumulative = 0
+        for bound in metric.buckets:
+            cumulative += samples.get((bucket_name, labels + (('le', bound),)), 0)
+            lines.append('{}{} {}'.format(
+                bucket_name,
+                format_labels(labels + (('le', bound),)),
+                format_value(cumulative),
+            ))
+        for suffix in ('_sum', '_count'):
+            lines.append('{}{}{} {}'.format(
+                metric.name,
+                suffix,
+                format_labels(labels),
+                format_value(samples[(metric.name + suffix, labels)]),
+            ))
+    return lines
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import threading
+from collections import namedtuple
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import staticconf
+
+from adjure.lib import metrics
+from adjure.lib.cache import LRUCache
+
+
+# Names of the qrcode.constants, which aren't imported until a QR code is made
+ERROR_CORRECTION_LEVELS = {
+    'L': 'ERROR_CORRECT_L',
+    'M': 'ERROR_CORRECT_M',
+    'Q': 'ERROR_CORRECT_Q',
+    'H': 'ERROR_CORRECT_H',
+}
+MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'json': 'application/json',
+}
+
+# Everything that affects the rendered output besides the data itself
+RenderOptions = namedtuple(
+    'RenderOptions',
+    ['format', 'box_size', 'border', 'error_correction'],
+)
+
+_image_cache = None
+_renderer = None
+
+
+class RendererBusyException(Exception):
+    """Raised when a QR code can't be rendered right now, either because the
+    render queue is full or because rendering took too long.
+    """
+
+
+def get_image_cache():
+    global _image_cache
+    if _image_cache is None:
+        config = staticconf.NamespaceReaders('adjure')
+        _image_cache = LRUCache(
+            max_size=config.read_int('qrcode.cache.max_bytes', default=8 * 1024 * 1024),
+            ttl=config.read_int('qrcode.cache.ttl', default=3600),
+            weigher=len,
+        )
+        metrics.registry.track_cache('qrcode', _image_cache)
+    return _image_cache
+
+
+def render_options(format=None, box_size=None, border=None, error_correction=None):
+    """Fill in RenderOptions from config for anything not given"""
+    config = staticconf.NamespaceReaders('adjure')
+    return RenderOptions(
+        format=format or config.read_string('qrcode.format', default='png'),
+        box_size=int(box_size or config.read_int('qrcode.box_size', default=10)),
+        border=int(border if border is not None else config.read_int('qrcode.border', default=4)),
+        error_correction=error_correction or config.read_string('qrcode.error_correction', default='L'),
+    )
+
+
+def make_qr_code(auth_uri, options):
+    # qrcode (and Pillow, which it imports) are slow to import, and most
+    # workers never render a QR code
+    import qrcode
+
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=getattr(qrcode.constants, ERROR_CORRECTION_LEVELS[options.error_correction]),
+        box_size=options.box_size,
+        border=options.border,
+    )
+    qr.add_data(auth_uri)
+    qr.make(fit=True)
+    return qr
+
+
+def render_png(qr, options):
+    # Pillow is slow to import, and only needed for PNGs
+    from qrcode.image.pil import PilImage
+
+    data = BytesIO()
+    qr.make_image(image_factory=PilImage).save(data)
+    return data.getvalue()
+
+
+def render_svg(qr, options):
+    """A single path with one subpath per horizontal run of dark modules, in
+    module units scaled up by the viewBox.
+    """
+    matrix = qr.get_matrix()
+    size = len(matrix)
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if not row[x]:
+                x += 1
+                continue
+            run_start = x
+            while x < size and row[x]:
+                x += 1
+            path.append('M{},{}h{}v1h-{}z'.format(run_start, y, x - run_start, x - run_start))
+
+    pixels = size * options.box_size
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{pixels}" height="{pixels}" '
+        'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        '<rect width="{size}" height="{size}" fill="#fff"/>'
+        '<path d="{path}" fill="#000"/></svg>'
+    ).format(pixels=pixels, size=size, path=''.join(path)).encode('utf-8')
+
+
+def render_json(qr, options):
+    """The raw module matrix, including the border, one list of 0/1 per row"""
+    return json.dumps({
+        'border': options.border,
+        'modules': [[int(module) for module in row] for row in qr.get_matrix()],
+    }, separators=(',', ':')).encode('utf-8')
+
+
+RENDERERS = {
+    'png': render_png,
+    'svg': render_svg,
+    'json': render_json,
+}
+
+
+def render_qr_code(auth_uri, options):
+    """:returns: the QR code for auth_uri as bytes, in options.format"""
+    return RENDERERS[options.format](make_qr_code(auth_uri, options), options)
+
+
+class InlineRenderer(object):
+    """Render in the calling thread"""
+
+    def render(self, auth_uri, options):
+        return render_qr_code(auth_uri, options)
+
+
+class ProcessPoolRenderer(object):
+    """Render in a pool of subprocesses, so rendering doesn't hold the GIL of
+    the worker serving auth requests.
+
+    At most processes + max_queue renders are in flight at once. Renders past
+    that are refused rather than queued, as are renders that don't finish
+    within timeout seconds. If a subprocess dies (e.g. it's killed for using
+    too much memory) the pool is replaced, and the renders it had are refused.
+    """
+
+    def __init__(self, processes, max_queue, timeout):
+        self.timeout = timeout
+        self.processes = processes
+        self._executor = futures.ProcessPoolExecutor(max_workers=processes)
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(processes + max_queue)
+
+    def render(self, auth_uri, options):
+        if not self._slots.acquire(False):
+            raise RendererBusyException('QR code render queue is full')
+
+        executor = self._executor
+        try:
+            future = executor.submit(render_qr_code, auth_uri, options)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._replace_executor(executor)
+            raise RendererBusyException('QR code render process died')
+        except Exception:
+            self._slots.release()
+            raise
+        # A render that times out still holds its slot until it finishes
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise RendererBusyException('QR code render timed out')
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+            raise RendererBusyException('QR code render process died')
+
+    def _replace_executor(self, broken):
+        """Start a new pool in place of broken, unless another thread
+        already has
+        """
+        with self._executor_lock:
+            if self._executor is broken:
+                self._executor = futures.ProcessPoolExecutor(max_workers=self.processes)
+        broken.shutdown(wait=False)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def build_renderer(config):
+    """Build the renderer configured under qrcode.render"""
+    mode = config.read_string('qrcode.render.mode', default='inline')
+    if mode == 'inline':
+        return InlineRenderer()
+    if mode == 'process':
+        return ProcessPoolRenderer(
+            processes=config.read_int('qrcode.render.processes', default=2),
+            max_queue=config.read_int('qrcode.render.max_queue', default=8),
+            timeout=config.read_float('qrcode.render.timeout', default=2.0),
+        )
+    raise ValueError('Unknown QR code render mode {}'.format(mode))
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = build_renderer(staticconf.NamespaceReaders('adjure'))
+    return _renderer
+
+
+def image_cache_key(auth_uri, options):
+    """A stable digest of everything that goes into a rendered image, used
+    both as the cache key and as the image's ETag.
+    """
+    digest = hashlib.sha256(auth_uri.encode('utf-8'))
+    for name, value in sorted(options._asdict().items()):
+        digest.update('\0{}={}'.format(name, value).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cached_qr_code_image(auth_uri, options):
+    """Render a QR code for auth_uri, going through the per-worker image
+    cache.
+    :returns: bytes in options.format
+    :raises RendererBusyException: if the renderer can't take the work
+    """
+    cache = get_image_cache()
+    key = image_cache_key(auth_uri, options)
+    image = cache.get(key)
+    if image is None:
+        with metrics.QR_RENDER_DURATION.time(format=options.format):
+            image = get_renderer().render(auth_uri, options)
+        cache.set(key, image)
+    return image
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Token bucket rate limiting of auth attempts.
+
+Each key (e.g. a user_id or a client IP) gets a bucket of `capacity` tokens
+that refills at `refill_rate` tokens per second. Every attempt takes a token,
+and attempts against an empty bucket are refused until it refills. A batch of
+attempts takes a token for each, or is refused as a whole.
+"""
+import abc
+import threading
+import time
+from collections import namedtuple
+
+import staticconf
+
+from adjure.lib.local_db import ThreadLocalConnection
+
+
+RateLimit = namedtuple('RateLimit', ['capacity', 'refill_rate'])
+
+_rate_limiter = None
+
+
+class RateLimiter(abc.ABC):
+    """Interface for rate limiter backends"""
+
+    @abc.abstractmethod
+    def acquire(self, key, limit, now, cost=1):
+        """Take cost tokens from key's bucket, or none if it has fewer.
+        :param limit: RateLimit
+        :param now: the current unix time
+        :param cost: tokens to take. More than limit.capacity is never granted.
+        :returns: 0 if the tokens were taken, otherwise the number of seconds
+            until they will be available
+        """
+
+
+def refill(tokens, updated_at, limit, now):
+    return min(limit.capacity, tokens + (now - updated_at) * limit.refill_rate)
+
+
+def take_tokens(tokens, limit, cost):
+    """:returns: (tokens left, seconds to wait)"""
+    if tokens >= cost:
+        return tokens - cost, 0
+    return tokens, (cost - tokens) / limit.refill_rate
+
+
+class InMemoryRateLimiter(RateLimiter):
+    """Rate limiter for a single process. With several uWSGI workers each has
+    its own buckets, so the effective limit is multiplied by the worker count.
+    """
+
+    def __init__(self, purge_interval=60):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._purge_interval = purge_interval
+        self._next_purge = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, key, limit, now, cost=1):
+        with self._lock:
+            tokens, updated_at, _ = self._buckets.get(key, (limit.capacity, now, limit))
+            tokens, wait = take_tokens(refill(tokens, updated_at, limit, now), limit, cost)
+            self._buckets[key] = (tokens, now, limit)
+
+            if now >= self._next_purge:
+                self._purge(now)
+            return wait
+
+    def _purge(self, now):
+        # Buckets that have refilled completely are the same as new ones
+        self._buckets = {
+            key: bucket
+            for key, bucket in self._buckets.items()
+            if refill(bucket[0], bucket[1], bucket[2], now) < bucket[2].capacity
+        }
+        self._next_purge = now + self._purge_interval
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """Rate limiter with buckets in a local SQLite file, shared by every
+    worker on the host.
+    """
+
+    def __init__(self, path, purge_interval=60):
+        self._purge_interval = purge_interval
+        self._next_purge = 0
+        self._connection = ThreadLocalConnection(path)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS adjure_rate_limit ('
+            'key TEXT PRIMARY KEY, '
+            'tokens REAL NOT NULL, '
+            'updated_at REAL NOT NULL, '
+            'full_at REAL NOT NULL)'
+        )
+
+    def acquire(self, key, limit, now, cost=1):
+        with self._connection.transaction() as connection:
+            row = connection.execute(
+                'SELECT tokens, updated_at FROM adjure_rate_limit WHERE key = ?',
+                (key,),
+            ).fetchone()
+            tokens, updated_at = row if row else (limit.capacity, now)
+            tokens, wait = take_tokens(refill(tokens, updated_at, limit, now), limit, cost)
+
+            connection.execute(
+                'INSERT OR REPLACE INTO adjure_rate_limit '
+                '(key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)',
+                (key, tokens, now, now + (limit.capacity - tokens) / limit.refill_rate),
+            )
+            if now >= self._next_purge:
+                connection.execute(
+                    'DELETE FROM adjure_rate_limit WHERE full_at <= ?',
+                    (now,),
+                )
+                self._next_purge = now + self._purge_interval
+            return wait
+
+
+class NullRateLimiter(RateLimiter):
+
+    def acquire(self, key, limit, now, cost=1):
+        return 0
+
+
+def build_rate_limiter(config):
+    """Build the rate limiter configured under auth.rate_limit"""
+    backend = config.read_string('auth.rate_limit.backend', default='memory')
+    if backend == 'memory':
+        return InMemoryRateLimiter()
+    if backend == 'sqlite':
+        return SQLiteRateLimiter(
+            config.read_string('auth.rate_limit.sqlite_path', default='/tmp/adjure-rate-limit.db'),
+        )
+    if backend == 'none':
+        return NullRateLimiter()
+    raise ValueError('Unknown rate limit backend {}'.format(backend))
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = build_rate_limiter(staticconf.NamespaceReaders('adjure'))
+    return _rate_limiter
+
+
+def configured_limit(config, name, capacity, refill_rate):
+    return RateLimit(
+        capacity=config.read_float('auth.rate_limit.{}.capacity'.format(name), default=capacity),
+        refill_rate=config.read_float('auth.rate_limit.{}.refill_rate'.format(name), default=refill_rate),
+    )
+
+
+def client_ip(remote_addr, forwarded_for):
+    """The client's address, for the per-IP bucket. Behind a load balancer or
+    gateway, remote_addr is the proxy's address, so with
+    auth.rate_limit.trusted_proxies set it's read from X-Forwarded-For
+    instead. Each proxy appends the address it got the request from, so the
+    entry that many from the right was added by the outermost trusted proxy.
+    Entries further left come from the client, and can't be trusted.
+    :param forwarded_for: the X-Forwarded-For header, or None
+    """
+    config = staticconf.NamespaceReaders('adjure')
+    trusted_proxies = config.read_int('auth.rate_limit.trusted_proxies', default=0)
+    if not trusted_proxies or not forwarded_for:
+        return remote_addr
+
+    addresses = [address.strip() for address in forwarded_for.split(',') if address.strip()]
+    if len(addresses) < trusted_proxies:
+        return remote_addr
+    return addresses[-trusted_proxies]
+
+
+def check_ip_rate_limit(remote_addr, attempts=1):
+    """Take a token per attempt from the client IP's bucket.
+    :returns: 0 if the attempts may go ahead, otherwise the number of seconds
+        to wait before retrying
+    """
+    config = staticconf.NamespaceReaders('adjure')
+    return get_rate_limiter().acquire(
+        'ip:{}'.format(remote_addr),
+        configured_limit(config, 'per_ip', 100, 10),
+        time.time(),
+        cost=attempts,
+    )
+
+
+def check_user_rate_limit(user_id):
+    """Take a token from the user's bucket.
+    :returns: 0 if the attempt may go ahead, otherwise the number of seconds
+        to wait before retrying
+    """
+    config = staticconf.NamespaceReaders('adjure')
+    return get_rate_limiter().acquire(
+        'user:{}'.format(user_id),
+        configured_limit(config, 'per_user', 10, 0.2),
+        time.time(),
+    )
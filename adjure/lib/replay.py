@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Ledgers of the last accepted TOTP time step per user, so that a code can't
+be used twice.
+
+Only one small entry is kept per user, and it expires once its time step has
+slid out of every verification window, since codes from it are rejected by
+the verifier anyway from then on.
+"""
+import abc
+import threading
+
+from adjure.lib.local_db import ThreadLocalConnection
+
+
+class ReplayLedger(abc.ABC):
+    """Interface for replay ledgers. Implementations must make `record`
+    atomic with respect to every process that shares the ledger.
+    """
+
+    @abc.abstractmethod
+    def last_step(self, user_id, now):
+        """:param now: the current unix time
+        :returns: (time_step, key_valid_duration) of the last accepted
+        code for user_id, or None if nothing unexpired is recorded
+        """
+
+    @abc.abstractmethod
+    def record(self, user_id, time_step, key_valid_duration, expires_at, now):
+        """Record time_step as accepted for user_id, unless the same or a
+        later step was already accepted.
+        :param expires_at: unix time after which the entry can be dropped
+        :param now: the current unix time
+        :returns: True if recorded, False if this is a replay
+        """
+
+
+class InMemoryReplayLedger(ReplayLedger):
+    """Ledger for a single process. With several uWSGI workers each has its
+    own, so a code could be replayed once per worker.
+    """
+
+    def __init__(self, purge_interval=60):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._purge_interval = purge_interval
+        self._next_purge = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def last_step(self, user_id, now):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[2] <= now:
+            return None
+        return entry[0], entry[1]
+
+    def record(self, user_id, time_step, key_valid_duration, expires_at, now):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[2] > now and entry[0] >= time_step:
+                return False
+
+            self._entries[user_id] = (time_step, key_valid_duration, expires_at)
+            if now >= self._next_purge:
+                self._purge(now)
+            return True
+
+    def _purge(self, now):
+        self._entries = {
+            user_id: entry
+            for user_id, entry in self._entries.items()
+            if entry[2] > now
+        }
+        self._next_purge = now + self._purge_interval
+
+
+class SQLiteReplayLedger(ReplayLedger):
+    """Ledger in a local SQLite file, shared by every worker on the host"""
+
+    def __init__(self, path, purge_interval=60):
+        self._purge_interval = purge_interval
+        self._next_purge = 0
+        self._connection = ThreadLocalConnection(path)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS adjure_replay_ledger ('
+            'user_id TEXT PRIMARY KEY, '
+            'time_step INTEGER NOT NULL, '
+            'key_valid_duration INTEGER NOT NULL, '
+            'expires_at REAL NOT NULL)'
+        )
+
+    def last_step(self, user_id, now):
+        row = self._connection.execute(
+            'SELECT time_step, key_valid_duration FROM adjure_replay_ledger '
+            'WHERE user_id = ? AND expires_at > ?',
+            (user_id, now),
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def record(self, user_id, time_step, key_valid_duration, expires_at, now):
+        with self._connection.transaction() as connection:
+            row = connection.execute(
+                'SELECT 1 FROM adjure_replay_ledger '
+                'WHERE user_id = ? AND expires_at > ? AND time_step >= ?',
+                (user_id, now, time_step),
+            ).fetchone()
+            if row:
+                return False
+
+            connection.execute(
+                'INSERT OR REPLACE INTO adjure_replay_ledger '
+                '(user_id, time_step, key_valid_duration, expires_at) '
+                'VALUES (?, ?, ?, ?)',
+                (user_id, time_step, key_valid_duration, expires_at),
+            )
+            if now >= self._next_purge:
+                connection.execute(
+                    'DELETE FROM adjure_replay_ledger WHERE expires_at <= ?',
+                    (now,),
+                )
+                self._next_purge = now + self._purge_interval
+            return True
+
+
+class NullReplayLedger(ReplayLedger):
+    """Accepts everything, for deployments that opt out of replay protection"""
+
+    def last_step(self, user_id, now):
+        return None
+
+    def record(self, user_id, time_step, key_valid_duration, expires_at, now):
+        return True
+
+
+def build_replay_ledger(config):
+    """Build the ledger configured under auth.replay_protection"""
+    backend = config.read_string('auth.replay_protection.backend', default='memory')
+    if backend == 'memory':
+        return InMemoryReplayLedger()
+    if backend == 'sqlite':
+        return SQLiteReplayLedger(
+            config.read_string('auth.replay_protection.sqlite_path', default='/tmp/adjure-replay.db'),
+        )
+    if backend == 'none':
+        return NullReplayLedger()
+    raise ValueError('Unknown replay protection backend {}'.format(backend))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import UniqueConstraint
+from sqlalchemy.types import Binary
+
+from adjure.models.base import Base
+
+
+class AuthDevice(Base):
+    """A TOTP credential enrolled in addition to the user's own, such as a
+    backup hardware token. Devices use their user's key_valid_duration, so
+    every credential of a user shares one sequence of time steps.
+    """
+    __tablename__ = 'adjure_auth_device'
+    __table_args__ = (
+        # Also the index for loading a user's devices
+        UniqueConstraint('user_id', 'name', name='uq_adjure_auth_device_user_id_name'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(
+        String(128),
+        ForeignKey('adjure_auth_user.user_id'),
+        nullable=False,
+    )
+    name = Column(String(64), nullable=False)
+    # Encrypted like AuthUser.secret
+    secret = Column(Binary(64), nullable=False)
+    secret_key_version = Column(Integer, nullable=True)
+    key_length = Column(Integer, nullable=False)
+    hash_algorithm = Column(String(8), nullable=False)
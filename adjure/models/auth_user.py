@@ -5,6 +5,7 @@ from sqlalchemy import String
 from sqlalchemy.types import Binary
 from sqlalchemy.orm import relationship
 
+from adjure.models.auth_device import AuthDevice
 from adjure.models.base import Base
 from adjure.models.recovery_code import RecoveryCode
 
@@ -14,9 +15,13 @@ class AuthUser(Base):
 
     id = Column(Integer, primary_key=True)
     user_id = Column(String(128), unique=True, nullable=False)
-    secret = Column(Binary(32), nullable=False)
+    # The TOTP secret, encrypted with secret_key_version's key, or as is when
+    # that's null. See adjure.lib.encryption.
+    secret = Column(Binary(64), nullable=False)
+    secret_key_version = Column(Integer, nullable=True)
     key_length = Column(Integer, nullable=False)
     key_valid_duration = Column(Integer, nullable=False)
     hash_algorithm = Column(String(8), nullable=False)
 
     recovery_codes = relationship(RecoveryCode)
+    devices = relationship(AuthDevice, order_by=AuthDevice.name)
@@ -1,16 +1,345 @@
 # -*- coding: utf-8 -*-
+import collections
+import hashlib
+import logging
+import random
+import struct
+import threading
+import time
+
+import staticconf
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 
+log = logging.getLogger(__name__)
+
 Base = declarative_base()
 session = scoped_session(sessionmaker(autocommit=False, autoflush=False))
 
+# Every engine bound by this process, so they can all be disposed of after a
+# fork and reported on.
+engines = []
+replica_engines = []
+
+
+class ReplicaSession(Session):
+    """Session for reads that can tolerate replication lag. Each statement
+    goes to a random one of replicas, or to primary's bind if there are none.
+    """
+
+    def __init__(self, primary=None, replicas=(), **kwargs):
+        super(ReplicaSession, self).__init__(**kwargs)
+        self.primary = primary
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replicas:
+            return random.choice(self.replicas)
+        return self.primary.session_factory.kw['bind']
+
+
+replica_session = scoped_session(sessionmaker(
+    class_=ReplicaSession,
+    primary=session,
+    replicas=replica_engines,
+    autocommit=False,
+    autoflush=False,
+))
+
+
+class Shard(object):
+    """One of the databases users are spread across: a primary, which takes
+    every write, and its read replicas
+    """
+
+    def __init__(self, name, session, replica_session, draining=False):
+        self.name = name
+        self.session = session
+        self.replica_session = replica_session
+        # Draining shards get no new users, and rebalancing moves theirs off
+        self.draining = draining
+
+    @property
+    def engine(self):
+        return self.session.session_factory.kw['bind']
+
+    @property
+    def replica_engines(self):
+        return self.replica_session.session_factory.kw['replicas']
+
+    def remove_sessions(self):
+        self.session.remove()
+        self.replica_session.remove()
+
+    def __repr__(self):
+        return '<Shard {}>'.format(self.name)
+
+
+# The database in ADJURE_DB_HOST, which is always a shard
+DEFAULT_SHARD_NAME = 'default'
+shards = [Shard(DEFAULT_SHARD_NAME, session, replica_session)]
+
+
+def shard_weight(shard, user_id):
+    digest = hashlib.sha256('{}\n{}'.format(shard.name, user_id).encode('utf-8')).digest()
+    return struct.unpack('>Q', digest[:8])[0]
+
+
+def shard_for(user_id):
+    """The shard user_id belongs on, by rendezvous hashing: the user goes to
+    the shard whose hash with the user_id is highest. Adding or draining a
+    shard only moves the users that belong on it.
+    """
+    if len(shards) == 1:
+        return shards[0]
+    return max(
+        (shard for shard in shards if not shard.draining),
+        key=lambda shard: shard_weight(shard, str(user_id)),
+    )
+
+
+def lookup_shards(shard):
+    """Shards to look for a user on, given the shard it belongs on. While
+    database.rebalancing is set, users may not have been moved to their
+    shard yet, so every other shard is looked on after it.
+    """
+    config = staticconf.NamespaceReaders('adjure')
+    if len(shards) == 1 or not config.read_bool('database.rebalancing', default=False):
+        return [shard]
+    return [shard] + [other for other in shards if other is not shard]
+
+
+def user_shards(user_id):
+    return lookup_shards(shard_for(user_id))
+
+
+def group_by_shard(user_ids):
+    """:returns: list of (shard, list of the user_ids belonging on it)"""
+    groups = collections.OrderedDict()
+    for user_id in user_ids:
+        groups.setdefault(shard_for(user_id), []).append(user_id)
+    return list(groups.items())
+
+
+def engine_options(connection_string, config):
+    """create_engine kwargs for a connection string, from the database
+    section of config. SQLite doesn't use a QueuePool, so pool sizing doesn't
+    apply to it.
+    """
+    options = {'convert_unicode': True}
+    if make_url(connection_string).drivername.startswith('sqlite'):
+        return options
+
+    options.update(
+        pool_size=config.read_int('database.pool_size', default=5),
+        max_overflow=config.read_int('database.max_overflow', default=10),
+        pool_timeout=config.read_int('database.pool_timeout', default=30),
+        pool_recycle=config.read_int('database.pool_recycle', default=3600),
+    )
+    return options
+
+
+def install_pre_ping(engine):
+    """Test connections as they're checked out of the pool, so connections
+    the database has dropped are replaced instead of failing a request.
+    """
+    @event.listens_for(engine, 'engine_connect')
+    def ping_connection(connection, branch):
+        if branch:
+            return
+
+        # Connectionless execution would close the connection after our ping
+        should_close_with_result = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            ping(connection)
+        except exc.DBAPIError as e:
+            if not e.connection_invalidated:
+                raise
+            # The pool has been invalidated, so this reconnects
+            ping(connection)
+        finally:
+            connection.should_close_with_result = should_close_with_result
+
+
+def ping(connection):
+    """SELECT 1, flagged so that query_stats leaves it out"""
+    connection.info['pre_ping'] = True
+    try:
+        connection.scalar('SELECT 1')
+    finally:
+        connection.info.pop('pre_ping', None)
+
+
+class QueryStats(threading.local):
+    """Statements this thread has run since the last reset, which is done at
+    the start of every request
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+query_stats = QueryStats()
+
+
+def install_query_stats(engine, slow_query_threshold):
+    """Count and time every statement run on engine into query_stats, and
+    log the ones taking at least slow_query_threshold seconds. Parameters
+    are left out of the log, as they hold secrets and recovery code hashes.
+    Pre-ping SELECT 1s aren't the request's own statements, and are skipped.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+        connection.info['query_started_at'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def record_query(connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info.pop('query_started_at')
+        if connection.info.get('pre_ping'):
+            return
+        query_stats.count += 1
+        query_stats.duration += duration
+        if slow_query_threshold and duration >= slow_query_threshold:
+            log.warning(
+                'Slow query took %.3fs: %s',
+                duration,
+                statement,
+                extra={'query_duration': duration, 'database': repr(engine.url)},
+            )
+
+
+def create_pooled_engine(connection_string):
+    config = staticconf.NamespaceReaders('adjure')
+    engine = create_engine(connection_string, **engine_options(connection_string, config))
+    if config.read_bool('database.pool_pre_ping', default=True):
+        install_pre_ping(engine)
+    install_query_stats(engine, config.read_float('database.slow_query_threshold', default=0.5))
+
+    engines.append(engine)
+    return engine
+
 
 def bind_database_engine(connection_string):
-    engine = create_engine(connection_string, convert_unicode=True)
+    """Bind the primary database, which takes every write"""
+    engine = create_pooled_engine(connection_string)
     session.configure(bind=engine)
-    Base.metadata.create_all(engine)
     return engine
+
+
+def bind_replica_engines(connection_strings):
+    """Bind read replicas for replica_session. Without any, replica_session
+    reads from the primary.
+    """
+    replica_session.remove()
+    replica_engines[:] = [
+        create_pooled_engine(connection_string)
+        for connection_string in connection_strings
+    ]
+    return list(replica_engines)
+
+
+def bind_shard_engines(shard_configs):
+    """Bind the shards besides the default one, replacing any bound before.
+    :param shard_configs: list of dicts of name, url, and optionally a list
+        of replica urls and draining
+    """
+    for shard in shards[1:]:
+        shard.remove_sessions()
+
+    names = set([DEFAULT_SHARD_NAME])
+    new_shards = []
+    for shard_config in shard_configs:
+        if shard_config['name'] in names:
+            raise ValueError('Shard name {} is used more than once'.format(shard_config['name']))
+        names.add(shard_config['name'])
+
+        shard_session = scoped_session(sessionmaker(
+            bind=create_pooled_engine(shard_config['url']),
+            autocommit=False,
+            autoflush=False,
+        ))
+        new_shards.append(Shard(
+            shard_config['name'],
+            shard_session,
+            scoped_session(sessionmaker(
+                class_=ReplicaSession,
+                primary=shard_session,
+                replicas=[create_pooled_engine(url) for url in shard_config.get('replicas', [])],
+                autocommit=False,
+                autoflush=False,
+            )),
+            draining=shard_config.get('draining', False),
+        ))
+
+    shards[1:] = new_shards
+    return list(shards)
+
+
+def remove_sessions(exception=None):
+    """Close this thread's sessions, returning their connections to the
+    pool. Run at the end of every request.
+    """
+    for shard in shards:
+        shard.remove_sessions()
+
+
+def dispose_engines():
+    """Drop every pooled connection. uWSGI forks workers from a master that
+    may have already connected, and forked processes must not share
+    connections, so this is run in the master before forking and in each
+    worker after.
+    """
+    remove_sessions()
+    for engine in engines:
+        engine.dispose()
+
+
+def ping_database():
+    """Run a SELECT 1 on each shard's primary, on a connection of its own
+    outside of any session transaction. Raises if one can't be reached.
+    """
+    for shard in shards:
+        connection = shard.engine.connect()
+        try:
+            connection.scalar('SELECT 1')
+        finally:
+            connection.close()
+
+
+def pool_status():
+    """Utilization of each engine's connection pool, for sizing workers
+    against the database's connection limit.
+    """
+    statuses = []
+    for engine in engines:
+        pool = engine.pool
+        status = {
+            'url': repr(engine.url),
+            'pool': type(pool).__name__,
+        }
+        if isinstance(pool, QueuePool):
+            status.update(
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                overflow=max(0, pool.overflow()),
+                max_overflow=pool._max_overflow,
+            )
+            # Share of every connection the pool may open that is in use
+            capacity = pool.size() + max(0, pool._max_overflow)
+            status['saturation'] = pool.checkedout() / capacity if capacity else 1.0
+        statuses.append(status)
+    return statuses
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Schema management, run explicitly with `manage.py migrate` rather than on
+every process start
+"""
+from sqlalchemy import inspect
+from sqlalchemy import Index
+
+from adjure.models.auth_user import AuthUser
+from adjure.models.base import Base
+from adjure.models.recovery_code import RecoveryCode
+
+
+RECOVERY_CODE_HASH_INDEX = 'uq_adjure_recovery_code_user_id_code_hash'
+
+
+def migrate_schema(engine):
+    """Create any missing tables, then make the changes create_all can't make
+    to tables that already exist. Safe to run repeatedly.
+    """
+    Base.metadata.create_all(engine)
+    upgrade_auth_user_table(engine)
+    upgrade_recovery_code_table(engine)
+
+
+def upgrade_auth_user_table(engine):
+    """Bring an adjure_auth_user table from before secrets were encrypted up
+    to date: add secret_key_version, and make room in secret for the nonce
+    and tag. Secrets stay unencrypted until rotate-secret-keys is run.
+    """
+    inspector = inspect(engine)
+    columns = set(
+        column['name'] for column in inspector.get_columns(AuthUser.__tablename__)
+    )
+
+    with engine.begin() as connection:
+        if 'secret_key_version' not in columns:
+            connection.execute(
+                'ALTER TABLE adjure_auth_user ADD COLUMN secret_key_version INTEGER'
+            )
+            # PostgreSQL's bytea and SQLite's BLOB aren't sized
+            if engine.dialect.name == 'mysql':
+                connection.execute(
+                    'ALTER TABLE adjure_auth_user MODIFY secret VARBINARY(64) NOT NULL'
+                )
+
+
+def upgrade_recovery_code_table(engine):
+    """Bring an adjure_recovery_code table from before codes were hashed up
+    to date: add code_hash and its index, let the plaintext column be null,
+    and drop the index on the plaintext column.
+    """
+    inspector = inspect(engine)
+    columns = {
+        column['name']: column
+        for column in inspector.get_columns(RecoveryCode.__tablename__)
+    }
+    index_names = set(
+        index['name'] for index in inspector.get_indexes(RecoveryCode.__tablename__)
+    ) | set(
+        constraint['name']
+        for constraint in inspector.get_unique_constraints(RecoveryCode.__tablename__)
+    )
+
+    if not columns['code']['nullable'] and engine.dialect.name == 'sqlite':
+        raise ValueError(
+            'SQLite can\'t make adjure_recovery_code.code nullable. '
+            'Recreate the table instead.'
+        )
+
+    with engine.begin() as connection:
+        if 'code_hash' not in columns:
+            connection.execute(
+                'ALTER TABLE adjure_recovery_code ADD COLUMN code_hash VARCHAR(64)'
+            )
+        if not columns['code']['nullable']:
+            connection.execute(
+                'ALTER TABLE adjure_recovery_code ALTER COLUMN code DROP NOT NULL'
+            )
+        if 'ix_adjure_recovery_code_code' in index_names:
+            connection.execute('DROP INDEX ix_adjure_recovery_code_code')
+        if RECOVERY_CODE_HASH_INDEX not in index_names:
+            Index(
+                RECOVERY_CODE_HASH_INDEX,
+                RecoveryCode.__table__.c.user_id,
+                RecoveryCode.__table__.c.code_hash,
+                unique=True,
+            ).create(connection)
@@ -4,12 +4,17 @@ from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import UniqueConstraint
 
 from adjure.models.base import Base
 
 
 class RecoveryCode(Base):
     __tablename__ = 'adjure_recovery_code'
+    __table_args__ = (
+        # Also the index for consuming a code
+        UniqueConstraint('user_id', 'code_hash', name='uq_adjure_recovery_code_user_id_code_hash'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(
@@ -17,5 +22,11 @@ class RecoveryCode(Base):
         ForeignKey('adjure_auth_user.user_id'),
         nullable=False,
     )
-    code = Column(String(32), unique=False, nullable=False, index=True)
+    # Keyed hash of the code, see adjure.lib.auth.hash_recovery_code
+    code_hash = Column(String(64), nullable=True)
+    # Codes from before they were hashed, until hash-recovery-codes is run
+    plaintext_code = Column('code', String(32), nullable=True)
     used = Column(Boolean, nullable=False, default=False)
+
+    # The plaintext code is only known right after it is generated
+    code = None
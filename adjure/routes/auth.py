@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
-from io import BytesIO
+import json
+import math
 
-import qrcode
+import staticconf
 from flask import Blueprint
 from flask import jsonify
 from flask import request
 from flask import Response
-from jsonschema import validate
-from jsonschema import ValidationError
+from flask import stream_with_context
 
 from adjure.lib import auth
+from adjure.lib import metrics
+from adjure.lib import qr
+from adjure.lib import rate_limit
+from adjure.routes.validation import schema_error
+from adjure.routes.validation import validate_request
 
 auth_page = Blueprint('auth', __name__)
 
@@ -21,6 +26,47 @@ def user_not_provisioned_response(user_id):
     ), 400
 
 
+def rate_limited_response(retry_after):
+    response = jsonify(
+        error_message='Too many attempts, try again in {} seconds'.format(int(math.ceil(retry_after))),
+        error_code='RATE_LIMITED'
+    )
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
+
+def verification_outcome(error):
+    """The adjure_verifications_total outcome for an authorize_user(s) error"""
+    if error is None:
+        return 'success'
+    if isinstance(error, auth.UnknownUserException):
+        return 'unknown_user'
+    if isinstance(error, auth.ReplayedCodeException):
+        return 'replayed'
+    return 'invalid_code'
+
+
+def check_ip_rate_limit(attempts=1):
+    return rate_limit.check_ip_rate_limit(
+        rate_limit.client_ip(request.remote_addr, request.headers.get('X-Forwarded-For')),
+        attempts,
+    )
+
+
+def check_rate_limits(user_id):
+    """Check the client IP's, then the user's, rate limit
+    :returns: a 429 response if either is exceeded, else None
+    """
+    retry_after = (
+        check_ip_rate_limit() or
+        rate_limit.check_user_rate_limit(user_id)
+    )
+    if retry_after:
+        return rate_limited_response(retry_after)
+    return None
+
+
 def format_auth_user_response(auth_user):
     return jsonify(
         user_id=auth_user.user_id,
@@ -36,6 +82,8 @@ USER_PROVISION_SCHEMA = {
     'properties': {
         'user_id': {
             'type': 'string',
+            # The length of AuthUser.user_id
+            'maxLength': 128,
         },
         'key_length': {
             'type': 'number',
@@ -43,7 +91,8 @@ USER_PROVISION_SCHEMA = {
             'default': 6,
         },
         'key_valid_duration': {
-            'type': 'number',
+            'type': 'integer',
+            'minimum': 1,
             'description': 'The length of time each code is valid for, seconds',
             'default': 30,
         },
@@ -59,13 +108,8 @@ USER_PROVISION_SCHEMA = {
 
 
 @auth_page.route('/user/provision', methods=['POST'])
-def user_provision():
-    data = request.get_json(force=True)
-    try:
-        validate(data, USER_PROVISION_SCHEMA)
-    except ValidationError as e:
-        return jsonify(error_message=str(e), error_code='INVALID_PARAMS'), 400
-
+@validate_request(USER_PROVISION_SCHEMA)
+def user_provision(data):
     try:
         auth_user = auth.provision_user(**data)
     except auth.UserCreationException as e:
@@ -77,30 +121,159 @@ def user_provision():
     return format_auth_user_response(auth_user)
 
 
+def parse_json_lines(lines):
+    """Parse a stream of JSON lines lazily, yielding None for unparseable
+    lines so that errors can be reported in place.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def bulk_provision_error(user):
+    """Why a line of a bulk provision doesn't match USER_PROVISION_SCHEMA, or
+    None, so it's checked just as /user/provision would check it
+    """
+    error = schema_error(USER_PROVISION_SCHEMA, user)
+    return None if error is None else error.message
+
+
+def format_bulk_provision_result(result):
+    if result.error is None:
+        return {
+            'user_id': result.user_id,
+            'recovery_codes': result.recovery_codes,
+        }
+
+    if isinstance(result.error, auth.UserAlreadyProvisionedException):
+        error_code = 'USER_ALREADY_PROVISIONED'
+    else:
+        error_code = 'USER_PROVISION_FAILURE'
+    return {
+        'user_id': result.user_id,
+        'error_message': str(result.error),
+        'error_code': error_code,
+    }
+
+
+@auth_page.route('/user/provision/bulk', methods=['POST'])
+def user_provision_bulk():
+    """Provision users from a JSON lines body, one USER_PROVISION_SCHEMA
+    object per line. Results are streamed back as JSON lines, in input order.
+    """
+    results = auth.bulk_provision_users(
+        parse_json_lines(request.stream),
+        validate=bulk_provision_error,
+    )
+    return Response(
+        stream_with_context(
+            json.dumps(format_bulk_provision_result(result)) + '\n'
+            for result in results
+        ),
+        mimetype='application/x-ndjson',
+    )
+
+
+USER_DEVICE_ADD_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'user_id': {
+            'type': 'string',
+        },
+        'name': {
+            'type': 'string',
+            'description': 'Name for the device, unique for the user',
+        },
+        'key_length': {
+            'type': 'number',
+            'enum': list(auth.SUPPORTED_KEY_LENGTHS),
+        },
+        'hash_algorithm': {
+            'type': 'string',
+            'enum': list(auth.TOTP_HASH_ALGORITHMS.keys()),
+        },
+    },
+    'required': ['user_id', 'name'],
+}
+
+
+@auth_page.route('/user/device/add', methods=['POST'])
+@validate_request(USER_DEVICE_ADD_SCHEMA)
+def user_device_add(data):
+    try:
+        device = auth.add_user_device(**data)
+    except (auth.DeviceCreationException, auth.UserCreationException) as e:
+        return jsonify(
+            error_message=str(e),
+            error_code='DEVICE_ADD_FAILURE'
+        ), 400
+
+    if not device:
+        return user_not_provisioned_response(data['user_id'])
+    return jsonify(user_id=device.user_id, device=device.name)
+
+
+USER_DEVICE_REMOVE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'user_id': {
+            'type': 'string',
+        },
+        'name': {
+            'type': 'string',
+        },
+    },
+    'required': ['user_id', 'name'],
+}
+
+
+@auth_page.route('/user/device/remove', methods=['POST'])
+@validate_request(USER_DEVICE_REMOVE_SCHEMA)
+def user_device_remove(data):
+    if not auth.remove_user_device(data['user_id'], data['name']):
+        return jsonify(
+            error_message='User {} has no device named {}'.format(data['user_id'], data['name']),
+            error_code='DEVICE_NOT_FOUND'
+        ), 400
+    return jsonify()
+
+
 USER_AUTH_CODE_SCHEMA = {
     'type': 'object',
     'properties': {
         'user_id': {
             'type': 'string'
         },
+        'device': {
+            'type': 'string',
+            'description': 'Device to get a code for, defaults to the user\'s own',
+        },
     },
     'required': ['user_id'],
 }
 
 
 @auth_page.route('/user/auth_code', methods=['GET'])
-def user_auth_code():
-    try:
-        validate(request.args, USER_AUTH_CODE_SCHEMA)
-    except ValidationError as e:
-        return jsonify(error_message=str(e), error_code='INVALID_PARAMS'), 400
-
-    user = auth.load_user(request.args['user_id'])
+@validate_request(USER_AUTH_CODE_SCHEMA, source='args')
+def user_auth_code(data):
+    user = auth.load_user_params(data['user_id'])
     if not user:
-        return user_not_provisioned_response(request.args['user_id'])
+        return user_not_provisioned_response(data['user_id'])
 
+    code = auth.get_auth_code_for_user(user, data.get('device'))
+    if code is None:
+        return jsonify(
+            error_message='User {} has no device named {}'.format(data['user_id'], data['device']),
+            error_code='DEVICE_NOT_FOUND'
+        ), 400
     return jsonify({
-        'code': auth.get_auth_code_for_user(user)
+        'code': code
     })
 
 
@@ -112,6 +285,7 @@ USER_AUTHENTICATE_SCHEMA = {
         },
         'auth_code': {
             'type': 'string',
+            'pattern': '^[0-9]{6,8}$',
             'description': 'The TOTP code from the user\'s 2FA app',
         },
     },
@@ -120,22 +294,88 @@ USER_AUTHENTICATE_SCHEMA = {
 
 
 @auth_page.route('/user/authenticate', methods=['POST'])
-def user_authenticate():
-    data = request.get_json(force=True)
-    try:
-        validate(data, USER_AUTHENTICATE_SCHEMA)
-    except ValidationError as e:
-        return jsonify(error_message=str(e), error_code='INVALID_PARAMS'), 400
+@validate_request(USER_AUTHENTICATE_SCHEMA)
+def user_authenticate(data):
+    rate_limited = check_rate_limits(data['user_id'])
+    if rate_limited:
+        metrics.VERIFICATIONS.inc(outcome='rate_limited')
+        return rate_limited
 
     try:
-        auth.authorize_user(data['user_id'], data['auth_code'].encode('ASCII'))
+        device = auth.authorize_user(data['user_id'], data['auth_code'].encode('ASCII'))
     except auth.ValidationException as e:
+        metrics.VERIFICATIONS.inc(outcome=verification_outcome(e))
         return jsonify(
             error_message=e.args[0],
             error_code='VALIDATION_FAILURE'
         ), 400
 
-    return jsonify({}), 200
+    metrics.VERIFICATIONS.inc(outcome='success')
+    return jsonify({'device': device}), 200
+
+
+USER_AUTHENTICATE_BATCH_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'attempts': {
+            'type': 'array',
+            'items': USER_AUTHENTICATE_SCHEMA,
+        },
+    },
+    'required': ['attempts'],
+}
+
+
+@auth_page.route('/user/authenticate/batch', methods=['POST'])
+@validate_request(USER_AUTHENTICATE_BATCH_SCHEMA)
+def user_authenticate_batch(data):
+    config = staticconf.NamespaceReaders('adjure')
+    max_batch_size = config.read_int('auth.max_batch_size', default=100)
+    if len(data['attempts']) > max_batch_size:
+        return jsonify(
+            error_message='At most {} attempts can be authenticated at once'.format(max_batch_size),
+            error_code='BATCH_TOO_LARGE'
+        ), 400
+
+    # Charged per attempt, so batching doesn't multiply what an IP can try
+    retry_after = check_ip_rate_limit(len(data['attempts']))
+    if retry_after:
+        metrics.VERIFICATIONS.inc(len(data['attempts']), outcome='rate_limited')
+        return rate_limited_response(retry_after)
+
+    attempts = data['attempts']
+    allowed = [
+        index for index, attempt in enumerate(attempts)
+        if not rate_limit.check_user_rate_limit(attempt['user_id'])
+    ]
+    authorized = dict(zip(allowed, auth.authorize_users([
+        (attempts[index]['user_id'], attempts[index]['auth_code'].encode('ASCII'))
+        for index in allowed
+    ])))
+
+    results = []
+    for index, attempt in enumerate(attempts):
+        if index not in authorized:
+            metrics.VERIFICATIONS.inc(outcome='rate_limited')
+            results.append({
+                'user_id': attempt['user_id'],
+                'authenticated': False,
+                'error_code': 'RATE_LIMITED',
+            })
+            continue
+
+        device, error = authorized[index]
+        metrics.VERIFICATIONS.inc(outcome=verification_outcome(error))
+        result = {'user_id': attempt['user_id'], 'authenticated': error is None}
+        if error is None:
+            result['device'] = device
+        elif isinstance(error, auth.UnknownUserException):
+            result['error_code'] = 'USER_NOT_FOUND'
+        else:
+            result['error_code'] = 'VALIDATION_FAILURE'
+        results.append(result)
+
+    return jsonify(results=results)
 
 
 USER_RECOVERY_CODE_AUTHENTICATE_SCHEMA = {
@@ -154,20 +394,18 @@ USER_RECOVERY_CODE_AUTHENTICATE_SCHEMA = {
 
 
 @auth_page.route('/user/recovery/authenticate', methods=['POST'])
-def user_validate_recovery_code():
-    data = request.get_json(force=True)
-    try:
-        validate(data, USER_RECOVERY_CODE_AUTHENTICATE_SCHEMA)
-    except ValidationError as e:
-        return jsonify(error_message=str(e), error_code='INVALID_PARAMS'), 400
-
-    auth_user = auth.load_user(data['user_id'])
-    if not auth_user:
-        return user_not_provisioned_response(data['user_id'])
+@validate_request(USER_RECOVERY_CODE_AUTHENTICATE_SCHEMA)
+def user_validate_recovery_code(data):
+    rate_limited = check_rate_limits(data['user_id'])
+    if rate_limited:
+        return rate_limited
 
     try:
-        auth.consume_recovery_code(auth_user.user_id, data['recovery_code'])
-    except auth.RecoveryCodeConsumptionError as e:
+        auth.consume_recovery_code(data['user_id'], data['recovery_code'])
+    except auth.RecoveryCodeConsumptionError:
+        # Only look the user up when the code didn't match
+        if not auth.load_user(data['user_id']):
+            return user_not_provisioned_response(data['user_id'])
         return jsonify(
             error_message='The recovery code supplied is not valid for this user',
             error_code='INVALID_RECOVERY_CODE'
@@ -188,18 +426,11 @@ USER_RECOVERY_CODE_REGENERATE_SCHEMA = {
 
 
 @auth_page.route('/user/recovery/regenerate', methods=['POST'])
-def user_regenerate_recovery_codes():
-    data = request.get_json(force=True)
-    try:
-        validate(data, USER_RECOVERY_CODE_REGENERATE_SCHEMA)
-    except ValidationError as e:
-        return jsonify(error_message=str(e), error_code='INVALID_PARAMS'), 400
-
-    auth_user = auth.load_user(data['user_id'])
+@validate_request(USER_RECOVERY_CODE_REGENERATE_SCHEMA)
+def user_regenerate_recovery_codes(data):
+    auth_user = auth.regenerate_user_recovery_codes(data['user_id'])
     if not auth_user:
         return user_not_provisioned_response(data['user_id'])
-
-    auth_user = auth.regenerate_user_recovery_codes(auth_user.user_id)
     return format_auth_user_response(auth_user)
 
 
@@ -217,42 +448,71 @@ USER_QRCODE_SCHEMA = {
             'type': 'string',
             'description': 'The username to display in the user\'s auth app',
         },
+        'format': {
+            'type': 'string',
+            'enum': sorted(qr.RENDERERS),
+            'description': 'Output format, defaults to qrcode.format from config',
+        },
+        # Kept small, since image size and render time grow with the square
+        # of both, and each combination renders and caches its own image
+        'box_size': {
+            'type': 'string',
+            'pattern': '^([1-9]|1[0-9]|20)$',
+            'description': 'Pixels per QR code module, 1 to 20',
+        },
+        'border': {
+            'type': 'string',
+            'pattern': '^([0-9]|10)$',
+            'description': 'Width of the border, in modules, 0 to 10',
+        },
+        'error_correction': {
+            'type': 'string',
+            'enum': sorted(qr.ERROR_CORRECTION_LEVELS),
+        },
+        'device': {
+            'type': 'string',
+            'description': 'Device to enroll, defaults to the user\'s own credential',
+        },
     },
     'required': ['user_id', 'issuer', 'username'],
 }
 
 
-def qr_code_image_as_bytes(auth_uri):
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(auth_uri)
-    qr.make(fit=True)
-    image = qr.make_image()
-
-    data = BytesIO()
-    image.save(data)
-    data.seek(0)
-
-    return data
-
-
 @auth_page.route('/user/qrcode', methods=['GET'])
-def user_qrcode():
-    try:
-        validate(request.args, USER_QRCODE_SCHEMA)
-    except ValidationError as e:
-        return jsonify(error_message=str(e), error_code='INVALID_PARAMS'), 400
-
+@validate_request(USER_QRCODE_SCHEMA, source='args')
+def user_qrcode(data):
     auth_uri = auth.user_auth_uri(
-        issuer=request.args['issuer'],
-        username=request.args['username'],
-        user_id=request.args['user_id'],
+        issuer=data['issuer'],
+        username=data['username'],
+        user_id=data['user_id'],
+        device=data.get('device'),
     )
     if not auth_uri:
         return 'User not found', 404
 
-    return Response(qr_code_image_as_bytes(auth_uri), mimetype='image/png')
+    config = staticconf.NamespaceReaders('adjure')
+    options = qr.render_options(
+        format=data.get('format'),
+        box_size=data.get('box_size'),
+        border=data.get('border'),
+        error_correction=data.get('error_correction'),
+    )
+    etag = qr.image_cache_key(auth_uri, options)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        try:
+            image = qr.cached_qr_code_image(auth_uri, options)
+        except qr.RendererBusyException as e:
+            response = jsonify(error_message=str(e), error_code='QR_CODE_RENDERER_BUSY')
+            response.status_code = 503
+            response.headers['Retry-After'] = '1'
+            return response
+        response = Response(image, mimetype=qr.MIMETYPES[options.format])
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = config.read_string(
+        'qrcode.cache_control',
+        default='private, no-cache',
+    )
+    return response
@@ -1,15 +1,93 @@
 # -*- coding: utf-8 -*-
+import threading
+import time
+
+import staticconf
 from flask import Blueprint
 from flask import jsonify
 
-from adjure.lib.auth import load_user
+from adjure.lib import auth
+from adjure.lib import encryption
+from adjure.lib import qr
+from adjure.models.base import ping_database
+from adjure.models.base import pool_status
 
 
 healthcheck_page = Blueprint('healthcheck', __name__)
 
+# (checked_at, error message or None) of this worker's last database check
+_database_check = None
+_database_check_lock = threading.Lock()
+
+
+def check_database():
+    """Ping the database, at most once per healthcheck.readiness_interval
+    seconds per worker, so frequent load balancer probes don't turn into
+    database load.
+    :returns: None if the database is reachable, else the error message
+    """
+    global _database_check
+    config = staticconf.NamespaceReaders('adjure')
+    interval = config.read_float('healthcheck.readiness_interval', default=5.0)
+
+    with _database_check_lock:
+        now = time.monotonic()
+        if _database_check is None or now - _database_check[0] >= interval:
+            try:
+                ping_database()
+                error = None
+            except Exception as e:
+                error = str(e)
+            _database_check = (now, error)
+        return _database_check[1]
+
+
+def cache_status():
+    """How warm each per-worker cache is"""
+    caches = {
+        'user': auth.get_user_cache(),
+        'verifier': auth.get_verifier_cache(),
+        'secret': encryption.get_secret_cache(),
+        'qrcode': qr.get_image_cache(),
+    }
+    return {
+        name: {
+            'entries': len(cache),
+            'size': cache.size,
+            'max_size': cache.max_size,
+            'hit_ratio': cache.hit_ratio,
+        }
+        for name, cache in caches.items()
+    }
+
 
 @healthcheck_page.route('/healthcheck', methods=['GET'])
 def healthcheck():
-    # Make sure the DB connection is dandy
-    load_user(1)
+    if check_database():
+        return jsonify({}), 503
     return jsonify({})
+
+
+@healthcheck_page.route('/healthcheck/live', methods=['GET'])
+def healthcheck_live():
+    # The worker can serve requests. Doesn't touch the database, so a
+    # database outage doesn't get every worker restarted.
+    return jsonify({})
+
+
+@healthcheck_page.route('/healthcheck/ready', methods=['GET'])
+def healthcheck_ready():
+    database_error = check_database()
+    response = jsonify(
+        database={'ok': database_error is None, 'error': database_error},
+        engines=pool_status(),
+        caches=cache_status(),
+    )
+    if database_error:
+        response.status_code = 503
+    return response
+
+
+@healthcheck_page.route('/healthcheck/pool', methods=['GET'])
+def healthcheck_pool():
+    return jsonify(engines=pool_status())
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import time
+
+from flask import Blueprint
+from flask import g
+from flask import request
+from flask import Response
+
+from adjure.lib import metrics
+
+
+metrics_page = Blueprint('metrics', __name__)
+
+
+@metrics_page.before_app_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+@metrics_page.after_app_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    started_at = getattr(g, 'request_started_at', None)
+    if started_at is not None:
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - started_at, endpoint=endpoint)
+    metrics.flush()
+    return response
+
+
+@metrics_page.route('/metrics', methods=['GET'])
+def metrics_text():
+    return Response(
+        metrics.render_text(metrics.collect()),
+        mimetype='text/plain; version=0.0.4',
+    )
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from functools import wraps
+
+from flask import jsonify
+from flask import request
+
+# (schema, compiled validator) by id of the schema. Holding on to the schema
+# keeps its id from being reused.
+_validators = {}
+
+
+def compile_schema(schema):
+    """Check a schema once, and build the validator used for every request"""
+    # jsonschema takes longer to import than the rest of the app, so it's
+    # left until the first request that needs it
+    from jsonschema import Draft4Validator
+
+    Draft4Validator.check_schema(schema)
+    return Draft4Validator(schema)
+
+
+def get_validator(schema):
+    """The validator for schema, compiled on first use, once per worker"""
+    if id(schema) not in _validators:
+        _validators[id(schema)] = (schema, compile_schema(schema))
+    return _validators[id(schema)][1]
+
+
+def schema_error(schema, data):
+    """:returns: the first way data doesn't match schema, or None"""
+    return next(get_validator(schema).iter_errors(data), None)
+
+
+def validate_request(schema, source='json'):
+    """Validate the request against schema before calling the view, which is
+    passed the validated data as its first argument.
+    :param source: 'json' for the JSON body, or 'args' for the query string
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if source == 'args':
+                data = request.args
+            else:
+                data = request.get_json(force=True)
+
+            error = schema_error(schema, data)
+            if error is not None:
+                return jsonify(error_message=str(error), error_code='INVALID_PARAMS'), 400
+
+            return view(data, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import uuid
+
+import pytest
+
+from adjure.lib import auth
+
+
+SECRET = b'0123456789abcdef0123'
+
+
+@pytest.mark.parametrize('sliding_windows', [0, 1, 3])
+@pytest.mark.parametrize('hash_algorithm', sorted(auth.TOTP_HASH_ALGORITHMS))
+@pytest.mark.parametrize('key_length', sorted(auth.SUPPORTED_KEY_LENGTHS))
+def test_totp_verify(benchmark, key_length, hash_algorithm, sliding_windows):
+    """Verify with a new verifier each round, so every window's HMAC is
+    computed rather than read back from the candidates of the last round
+    """
+    now = auth.current_time()
+    code = auth.TOTPVerifier(SECRET, key_length, hash_algorithm, 30).generate(now)
+
+    def setup():
+        verifier = auth.TOTPVerifier(SECRET, key_length, hash_algorithm, 30)
+        return (verifier, code, now, sliding_windows), {}
+
+    benchmark.pedantic(auth.TOTPVerifier.verify, setup=setup, rounds=1000)
+
+
+@pytest.mark.parametrize('sliding_windows', [0, 1, 3])
+def test_totp_verify_cached(benchmark, sliding_windows):
+    """totp_verify for a secret verified before within the same window,
+    which reuses the cached verifier and its candidate codes
+    """
+    now = auth.current_time()
+    code = auth.TOTPVerifier(SECRET, 6, 'SHA256', 30).generate(now)
+
+    benchmark(auth.totp_verify, SECRET, 6, 'SHA256', 30, code, now, sliding_windows)
+
+
+def test_authorize_user(benchmark, provisioned_user):
+    user = auth.load_user_params(provisioned_user)
+    code = auth.get_auth_code_for_user(user).encode('ASCII')
+
+    benchmark(auth.authorize_user, provisioned_user, code)
+
+
+def test_provision_user(benchmark):
+    benchmark(lambda: auth.provision_user(uuid.uuid4().hex))
+
+
+def test_consume_recovery_code(benchmark):
+    def setup():
+        user = auth.provision_user(uuid.uuid4().hex)
+        return (user.user_id, user.recovery_codes[0].code), {}
+
+    benchmark.pedantic(auth.consume_recovery_code, setup=setup, rounds=200)
+
+
+def test_regenerate_user_recovery_codes(benchmark, provisioned_user):
+    benchmark(auth.regenerate_user_recovery_codes, provisioned_user)
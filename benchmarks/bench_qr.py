@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from adjure.lib import qr
+
+
+AUTH_URI = 'otpauth://totp/Adjure:benchmark?secret=GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ&issuer=Adjure'
+
+
+@pytest.mark.parametrize('format', sorted(qr.RENDERERS))
+def test_render_qr_code(benchmark, format):
+    options = qr.RenderOptions(format=format, box_size=10, border=4, error_correction='L')
+
+    benchmark(qr.render_qr_code, AUTH_URI, options)
+
+
+def test_cached_qr_code_image(benchmark):
+    options = qr.render_options()
+    qr.cached_qr_code_image(AUTH_URI, options)
+
+    benchmark(qr.cached_qr_code_image, AUTH_URI, options)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Whole requests through the Flask test client, including routing, schema
+validation and JSON encoding.
+"""
+import json
+import uuid
+
+import pytest
+
+from adjure.app import build_app
+from adjure.lib import auth
+
+
+@pytest.fixture
+def adjure():
+    return build_app().test_client()
+
+
+def post(adjure, route, data):
+    return adjure.post(route, data=json.dumps(data), headers={'content-type': 'application/json'})
+
+
+def test_user_authenticate(benchmark, adjure, provisioned_user):
+    code = auth.get_auth_code_for_user(auth.load_user_params(provisioned_user))
+    data = {'user_id': provisioned_user, 'auth_code': code}
+
+    resp = benchmark(post, adjure, '/user/authenticate', data)
+    assert resp.status_code == 200
+
+
+def test_user_authenticate_batch(benchmark, adjure):
+    attempts = []
+    for _ in range(50):
+        user_id = auth.provision_user(uuid.uuid4().hex).user_id
+        code = auth.get_auth_code_for_user(auth.load_user_params(user_id))
+        attempts.append({'user_id': user_id, 'auth_code': code})
+
+    resp = benchmark(post, adjure, '/user/authenticate/batch', {'attempts': attempts})
+    assert resp.status_code == 200
+
+
+def test_user_auth_code(benchmark, adjure, provisioned_user):
+    route = '/user/auth_code?user_id={}'.format(provisioned_user)
+
+    resp = benchmark(adjure.get, route)
+    assert resp.status_code == 200
+
+
+def test_user_qrcode(benchmark, adjure, provisioned_user):
+    route = '/user/qrcode?user_id={}&issuer=Adjure&username=benchmark'.format(provisioned_user)
+
+    resp = benchmark(adjure.get, route)
+    assert resp.status_code == 200
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks run against a SQLite file by default, or whatever SQLAlchemy
+URL ADJURE_BENCHMARK_DB points at:
+
+    python -m pytest benchmarks/bench_*.py --benchmark-json=results.json
+
+Rate limiting and replay protection are turned off, since benchmarks repeat
+the same attempt for the same user many times.
+"""
+import os
+import uuid
+
+import pytest
+import staticconf.testing
+
+from adjure.lib import auth
+from adjure.models import base
+from adjure.models.migrations import migrate_schema
+from load import BENCHMARK_CONFIG
+
+
+@pytest.yield_fixture(scope='session', autouse=True)
+def benchmark_database(tmpdir_factory):
+    url = os.environ.get(
+        'ADJURE_BENCHMARK_DB',
+        'sqlite:///{}'.format(tmpdir_factory.mktemp('benchmark').join('adjure.db')),
+    )
+    with staticconf.testing.MockConfiguration(BENCHMARK_CONFIG, namespace='adjure'):
+        engine = base.bind_database_engine(url)
+        migrate_schema(engine)
+        yield engine
+        base.dispose_engines()
+
+
+@pytest.fixture
+def provisioned_user():
+    """:returns: the user_id of a newly provisioned user"""
+    user_id = uuid.uuid4().hex
+    auth.provision_user(user_id)
+    return user_id
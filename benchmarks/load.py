@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Generate load against /user/authenticate and report throughput and
+latency as JSON, so runs can be diffed between commits.
+
+By default requests go through the Flask test client of an in-process app
+on a SQLite file (or ADJURE_BENCHMARK_DB), so no server is needed:
+
+    PYTHONPATH=. python benchmarks/load.py --threads 8 --duration 10 > load.json
+
+Or against a running server:
+
+    PYTHONPATH=. python benchmarks/load.py --url http://localhost:5000 > load.json
+
+In-process, rate limiting and replay protection are off, since the same
+users authenticate over and over. A real server keeps its own config.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import staticconf.testing
+
+from adjure.app import build_app
+from adjure.lib import auth
+from adjure.models import base
+from adjure.models.migrations import migrate_schema
+
+
+# Also used by the pytest-benchmark suites, through conftest.py
+BENCHMARK_CONFIG = {
+    'auth': {
+        'key_valid_duration': 30,
+        'recovery_code_pepper': 'benchmark-pepper',
+        'rate_limit': {'backend': 'none'},
+        'replay_protection': {'backend': 'none'},
+    },
+}
+
+
+class TestClientTarget(object):
+    """Posts through the Flask test client, one client per thread"""
+
+    def __init__(self):
+        self.app = build_app()
+        self.local = threading.local()
+
+    def provision(self, user_id):
+        auth.provision_user(user_id)
+        base.session.remove()
+
+    def auth_code(self, user_id):
+        return auth.get_auth_code_for_user(auth.load_user_params(user_id))
+
+    def authenticate(self, user_id, code):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        resp = self.local.client.post(
+            '/user/authenticate',
+            data=json.dumps({'user_id': user_id, 'auth_code': code}),
+            headers={'content-type': 'application/json'},
+        )
+        base.session.remove()
+        return resp.status_code
+
+
+class HTTPTarget(object):
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.local = threading.local()
+        self.requests = requests
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = self.requests.Session()
+        return self.local.session
+
+    def provision(self, user_id):
+        self.session.post('{}/user/provision'.format(self.url), json={'user_id': user_id})
+
+    def auth_code(self, user_id):
+        return self.session.get(
+            '{}/user/auth_code'.format(self.url),
+            params={'user_id': user_id},
+        ).json()['code']
+
+    def authenticate(self, user_id, code):
+        return self.session.post(
+            '{}/user/authenticate'.format(self.url),
+            json={'user_id': user_id, 'auth_code': code},
+        ).status_code
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run(target, users, threads, duration):
+    codes = {}
+    for _ in range(users):
+        user_id = uuid.uuid4().hex
+        target.provision(user_id)
+        codes[user_id] = target.auth_code(user_id)
+    user_ids = list(codes)
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset):
+        thread_latencies = []
+        thread_statuses = {}
+        i = offset
+        while time.monotonic() < deadline:
+            user_id = user_ids[i % len(user_ids)]
+            start = time.perf_counter()
+            status = target.authenticate(user_id, codes[user_id])
+            thread_latencies.append(time.perf_counter() - start)
+            thread_statuses[status] = thread_statuses.get(status, 0) + 1
+            i += threads
+        with lock:
+            latencies.extend(thread_latencies)
+            for status, count in thread_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started_at = time.monotonic()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.monotonic() - started_at
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'requests_per_second': len(latencies) / elapsed,
+        'latency_seconds': {
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test /user/authenticate')
+    parser.add_argument('--url', help='Server to load, instead of an in-process app')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run for')
+    parser.add_argument('--users', type=int, default=100, help='Users to provision')
+    args = parser.parse_args()
+
+    if args.url:
+        result = run(HTTPTarget(args.url), args.users, args.threads, args.duration)
+    else:
+        with staticconf.testing.MockConfiguration(BENCHMARK_CONFIG, namespace='adjure'):
+            url = os.environ.get(
+                'ADJURE_BENCHMARK_DB',
+                'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'adjure.db')),
+            )
+            migrate_schema(base.bind_database_engine(url))
+            result = run(TestClientTarget(), args.users, args.threads, args.duration)
+
+    result.update(
+        commit=git_commit(),
+        target=args.url or 'in-process',
+        threads=args.threads,
+        duration=args.duration,
+        users=args.users,
+    )
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
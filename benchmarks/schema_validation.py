@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Per-request cost of validating each route schema, rebuilding the validator
+with jsonschema.validate (as the routes used to) vs. a precompiled validator.
+
+    python benchmarks/schema_validation.py
+"""
+import timeit
+
+import jsonschema
+
+from adjure.routes import auth
+from adjure.routes.validation import compile_schema
+
+
+CASES = [
+    ('USER_PROVISION_SCHEMA', {'user_id': '123', 'key_length': 6, 'hash_algorithm': 'SHA256'}),
+    ('USER_AUTH_CODE_SCHEMA', {'user_id': '123'}),
+    ('USER_AUTHENTICATE_SCHEMA', {'user_id': '123', 'auth_code': '123456'}),
+    ('USER_RECOVERY_CODE_AUTHENTICATE_SCHEMA', {'user_id': '123', 'recovery_code': 'a' * 32}),
+    ('USER_RECOVERY_CODE_REGENERATE_SCHEMA', {'user_id': '123'}),
+    ('USER_QRCODE_SCHEMA', {'user_id': '123', 'issuer': 'Adjure', 'username': 'foo'}),
+]
+
+
+def per_call_microseconds(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main(number=2000):
+    print('{:<40} {:>12} {:>12} {:>8}'.format('schema', 'validate us', 'compiled us', 'speedup'))
+    for name, data in CASES:
+        schema = getattr(auth, name)
+        validator = compile_schema(schema)
+        before = per_call_microseconds(lambda: jsonschema.validate(data, schema), number)
+        after = per_call_microseconds(lambda: validator.validate(data), number)
+        print('{:<40} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
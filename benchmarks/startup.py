@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Cold start time of a worker, measured in fresh interpreters, as JSON:
+
+    PYTHONPATH=. python benchmarks/startup.py --runs 10 > startup.json
+
+Reports the time to import and build the app, and to serve its first
+authentication request, including the imports deferred until then.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+
+from adjure.models.migrations import migrate_schema
+
+
+MEASURE = '''
+import json
+import time
+
+started_at = time.perf_counter()
+import staticconf.testing
+from adjure.app import build_app
+from adjure.models.base import bind_database_engine
+
+with staticconf.testing.MockConfiguration({{}}, namespace='adjure'):
+    bind_database_engine({url!r})
+    app = build_app()
+    booted_at = time.perf_counter()
+
+    client = app.test_client()
+    client.post(
+        '/user/authenticate',
+        data=json.dumps({{'user_id': 'startup', 'auth_code': '000000'}}),
+        headers={{'content-type': 'application/json'}},
+    )
+    first_request_at = time.perf_counter()
+
+print(json.dumps({{
+    'boot': booted_at - started_at,
+    'first_request': first_request_at - booted_at,
+}}))
+'''
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure adjure cold start time')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    url = 'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'adjure.db'))
+    migrate_schema(create_engine(url))
+    runs = [
+        json.loads(subprocess.check_output([sys.executable, '-c', MEASURE.format(url=url)]).decode('utf-8'))
+        for _ in range(args.runs)
+    ]
+
+    result = {'runs': args.runs}
+    for name in ('boot', 'first_request'):
+        values = sorted(run[name] for run in runs)
+        result[name] = {
+            'min': values[0],
+            'p50': percentile(values, 0.5),
+            'max': values[-1],
+        }
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
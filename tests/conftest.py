@@ -12,6 +12,7 @@ def mock_configuration():
         {
             'auth': {
                 'key_valid_duration': 30,
+                'recovery_code_pepper': 'test-pepper',
             },
         },
         namespace='adjure',
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import sys
+
+import staticconf.testing
+
+from adjure.app import build_app
+
+
+def test_build_app_defers_heavy_imports():
+    loaded = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys\n'
+        'from adjure.app import build_app\n'
+        'build_app()\n'
+        'print(" ".join(sorted(name for name in ("qrcode", "PIL", "jsonschema") if name in sys.modules)))\n',
+    ]).decode('ascii').strip()
+
+    assert loaded == ''
+
+
+def test_query_headers():
+    with staticconf.testing.MockConfiguration(
+        {'database': {'query_headers': True}},
+        namespace='adjure',
+    ):
+        resp = build_app().test_client().get('/user/auth_code?user_id=query-headers')
+
+    assert resp.status_code == 400
+    assert int(resp.headers['X-Adjure-Query-Count']) >= 1
+    assert float(resp.headers['X-Adjure-Query-Duration']) > 0
+
+
+def test_query_headers_off_by_default():
+    resp = build_app().test_client().get('/user/auth_code?user_id=nobody')
+
+    assert 'X-Adjure-Query-Count' not in resp.headers
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from flask import jsonify
+from flask import request
+
+from adjure.app import build_app
+from adjure.asgi import build_environ
+from adjure.asgi import WSGIToASGI
+
+
+def http_scope(method='GET', path='/', query_string=b'', headers=()):
+    return {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': query_string,
+        'headers': list(headers),
+        'client': ('10.0.0.1', 51234),
+        'server': ('adjure.local', 8000),
+    }
+
+
+def call_asgi(application, scope, body_chunks=(b'',)):
+    """Run a single ASGI request to completion.
+    :returns: the messages sent by the application
+    """
+    received = [
+        {'type': 'http.request', 'body': chunk, 'more_body': i < len(body_chunks) - 1}
+        for i, chunk in enumerate(body_chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    return sent
+
+
+def response_body(messages):
+    return b''.join(message.get('body', b'') for message in messages[1:])
+
+
+@pytest.yield_fixture
+def executor():
+    executor_ = ThreadPoolExecutor(max_workers=4)
+    yield executor_
+    executor_.shutdown(wait=True)
+
+
+def echo_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps({
+        'method': environ['REQUEST_METHOD'],
+        'path': environ['PATH_INFO'],
+        'query': environ['QUERY_STRING'],
+        'body': environ['wsgi.input'].read().decode('utf-8'),
+        'remote_addr': environ['REMOTE_ADDR'],
+    }).encode('utf-8')]
+
+
+def test_build_environ_headers():
+    environ = build_environ(
+        http_scope(headers=[
+            (b'content-type', b'application/json'),
+            (b'content-length', b'2'),
+            (b'x-forwarded-for', b'1.1.1.1'),
+            (b'x-forwarded-for', b'2.2.2.2'),
+        ]),
+        b'{}',
+    )
+
+    assert environ['CONTENT_TYPE'] == 'application/json'
+    assert environ['CONTENT_LENGTH'] == '2'
+    assert environ['HTTP_X_FORWARDED_FOR'] == '1.1.1.1,2.2.2.2'
+    assert environ['SERVER_PORT'] == '8000'
+    assert environ['wsgi.input'].read() == b'{}'
+
+
+def test_build_environ_without_content_length():
+    environ = build_environ(http_scope('POST', headers=[(b'content-type', b'application/json')]), b'{"a": 1}')
+
+    assert environ['CONTENT_LENGTH'] == '8'
+
+
+def test_flask_reads_body_without_content_length(executor):
+    app = build_app()
+
+    @app.route('/test/echo', methods=['POST'])
+    def echo():
+        return jsonify(request.get_json(force=True))
+
+    messages = call_asgi(
+        WSGIToASGI(app, executor),
+        http_scope('POST', '/test/echo', headers=[(b'content-type', b'application/json')]),
+        body_chunks=(b'{"user_id":', b' 1}'),
+    )
+
+    assert messages[0]['status'] == 200
+    assert json.loads(response_body(messages).decode('utf-8')) == {'user_id': 1}
+
+
+def test_request_passed_through(executor):
+    messages = call_asgi(
+        WSGIToASGI(echo_app, executor),
+        http_scope('POST', '/user/authenticate', b'a=1'),
+        body_chunks=(b'{"user_id":', b' 1}'),
+    )
+
+    assert messages[0]['status'] == 200
+    assert (b'content-type', b'application/json') in messages[0]['headers']
+    assert json.loads(response_body(messages).decode('utf-8')) == {
+        'method': 'POST',
+        'path': '/user/authenticate',
+        'query': 'a=1',
+        'body': '{"user_id": 1}',
+        'remote_addr': '10.0.0.1',
+    }
+    assert messages[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+
+
+def test_response_streamed(executor):
+    def streaming_app(environ, start_response):
+        start_response('200 OK', [])
+        return (str(i).encode('utf-8') for i in range(50))
+
+    messages = call_asgi(WSGIToASGI(streaming_app, executor, queue_size=2), http_scope())
+
+    assert len(messages) == 52
+    assert response_body(messages) == b''.join(str(i).encode('utf-8') for i in range(50))
+
+
+def test_exception_before_response(executor):
+    def broken_app(environ, start_response):
+        raise RuntimeError()
+
+    messages = call_asgi(WSGIToASGI(broken_app, executor), http_scope())
+
+    assert messages[0]['status'] == 500
+    assert messages[-1]['more_body'] is False
+
+
+def test_start_response_replaced_with_exc_info(executor):
+    def failing_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        try:
+            raise RuntimeError()
+        except RuntimeError:
+            start_response('503 Service Unavailable', [], sys.exc_info())
+        return [b'unavailable']
+
+    messages = call_asgi(WSGIToASGI(failing_app, executor), http_scope())
+
+    assert messages[0]['status'] == 503
+    assert messages[0]['headers'] == []
+    assert response_body(messages) == b'unavailable'
+
+
+def test_exc_info_reraised_after_headers_sent(executor):
+    reraised = []
+
+    def failing_app(environ, start_response):
+        write = start_response('200 OK', [])
+        write(b'partial')
+        try:
+            raise RuntimeError()
+        except RuntimeError:
+            try:
+                start_response('500 Internal Server Error', [], sys.exc_info())
+            except RuntimeError:
+                reraised.append(True)
+                raise
+
+    with pytest.raises(RuntimeError):
+        call_asgi(WSGIToASGI(failing_app, executor), http_scope())
+
+    assert reraised == [True]
+
+
+def test_start_response_twice_without_exc_info(executor):
+    def broken_app(environ, start_response):
+        start_response('200 OK', [])
+        start_response('200 OK', [])
+        return [b'']
+
+    messages = call_asgi(WSGIToASGI(broken_app, executor), http_scope())
+
+    assert messages[0]['status'] == 500
+
+
+def test_client_disconnect_stops_worker(executor):
+    closed = threading.Event()
+
+    def streaming_app(environ, start_response):
+        start_response('200 OK', [])
+        try:
+            for i in range(1000):
+                yield str(i).encode('utf-8')
+        finally:
+            closed.set()
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            raise OSError('client disconnected')
+
+    async def serve():
+        with pytest.raises(OSError):
+            await WSGIToASGI(streaming_app, executor, queue_size=2)(http_scope(), receive, send)
+        # Keep the loop running afterwards, as a server would
+        for _ in range(100):
+            if closed.is_set():
+                return True
+            await asyncio.sleep(0.01)
+        return False
+
+    assert asyncio.run(serve())
+
+
+@pytest.mark.parametrize('headers', [
+    [(b'content-length', b'11')],
+    [],
+])
+def test_request_body_too_large(executor, headers):
+    called = []
+
+    def app(environ, start_response):
+        called.append(True)
+        return echo_app(environ, start_response)
+
+    messages = call_asgi(
+        WSGIToASGI(app, executor, max_body_size=10),
+        http_scope('POST', headers=headers),
+        body_chunks=(b'{"user_id":', b' 1}'),
+    )
+
+    assert messages[0]['status'] == 413
+    assert json.loads(response_body(messages).decode('utf-8'))['error_code'] == 'REQUEST_TOO_LARGE'
+    assert called == []
+
+
+def test_request_body_at_limit(executor):
+    messages = call_asgi(
+        WSGIToASGI(echo_app, executor, max_body_size=14),
+        http_scope('POST'),
+        body_chunks=(b'{"user_id":', b' 1}'),
+    )
+
+    assert messages[0]['status'] == 200
+
+
+def test_flask_routes(executor):
+    messages = call_asgi(WSGIToASGI(build_app(), executor), http_scope(path='/healthcheck/pool'))
+
+    assert messages[0]['status'] == 200
+    assert 'engines' in json.loads(response_body(messages).decode('utf-8'))
+
+
+def test_lifespan(executor):
+    received = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(WSGIToASGI(echo_app, executor)({'type': 'lifespan'}, receive, send))
+
+    assert sent == [
+        {'type': 'lifespan.startup.complete'},
+        {'type': 'lifespan.shutdown.complete'},
+    ]
@@ -1,13 +1,118 @@
 # -*- coding: utf-8 -*-
+import base64
 from base64 import b32encode
+from concurrent.futures import ThreadPoolExecutor
 import os
 import time
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
 
 import pytest
+import staticconf.testing
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DataError
+from sqlalchemy.exc import IntegrityError
 
+from adjure.app import build_app
 from adjure.lib import auth
+from adjure.lib import encryption
+from adjure.models import base
+from adjure.models.auth_device import AuthDevice
+from adjure.models.auth_user import AuthUser
+from adjure.models.migrations import migrate_schema
+from adjure.models.recovery_code import RecoveryCode
+
+
+CONCURRENCY = 16
+# MockConfiguration replaces the whole namespace, so this is repeated from
+# tests/conftest.py by configs that hash recovery codes
+PEPPER = 'test-pepper'
+ENCRYPTION_KEYS = {
+    'auth': {
+        'recovery_code_pepper': PEPPER,
+        'secret_encryption': {
+            'keys': [{'version': 1, 'key': base64.b64encode(b'1' * 32).decode('ascii')}],
+            'current_version': 1,
+        },
+    },
+}
+
+
+@pytest.yield_fixture
+def file_database(tmpdir):
+    """Bind the session to a SQLite file, so that every thread sees the same
+    database through its own connection.
+    """
+    original_bind = base.session.session_factory.kw['bind']
+    engine = create_engine(
+        'sqlite:///{}'.format(tmpdir.join('adjure.db')),
+        connect_args={'timeout': 30},
+    )
+    base.Base.metadata.create_all(engine)
+    base.session.remove()
+    base.session.configure(bind=engine)
+    yield engine
+    base.session.remove()
+    base.session.configure(bind=original_bind)
+
+
+@pytest.yield_fixture
+def replica_database(tmpdir, file_database, monkeypatch):
+    """A replica, in a separate SQLite file that nothing replicates to"""
+    monkeypatch.setattr(base, 'engines', [])
+    engine, = base.bind_replica_engines(['sqlite:///{}'.format(tmpdir.join('replica.db'))])
+    base.Base.metadata.create_all(engine)
+    auth.get_user_cache().clear()
+    auth.get_recent_writes().clear()
+    yield engine
+    base.bind_replica_engines([])
+    auth.get_user_cache().clear()
+
+
+@pytest.yield_fixture
+def shard_database(tmpdir, file_database, monkeypatch):
+    """Bind shards in SQLite files next to the default one. Call the
+    returned function with shard names to (re)bind them.
+    """
+    monkeypatch.setattr(base, 'engines', [])
+
+    def bind_shards(*names):
+        bound = base.bind_shard_engines([
+            {'name': name, 'url': 'sqlite:///{}'.format(tmpdir.join('{}.db'.format(name)))}
+            for name in names
+        ])
+        for shard in bound[1:]:
+            migrate_schema(shard.engine)
+        auth.get_user_cache().clear()
+        return bound
+
+    yield bind_shards
+    base.bind_shard_engines([])
+    auth.get_user_cache().clear()
+
+
+def shard_user_ids(shard):
+    return set(user_id for user_id, in shard.session.query(AuthUser.user_id))
+
+
+def unused_recovery_codes(shard, user_id):
+    return shard.session.query(RecoveryCode).filter(
+        RecoveryCode.user_id == user_id,
+        RecoveryCode.used.is_(False),
+    ).count()
+
+
+def run_concurrently(func, times):
+    def run(_):
+        try:
+            return func()
+        except Exception as e:
+            return e
+        finally:
+            base.session.remove()
+
+    with ThreadPoolExecutor(max_workers=times) as executor:
+        return list(executor.map(run, range(times)))
 
 
 def test_default_provision_user():
@@ -62,6 +167,108 @@ def test_consume_recovery_code_success():
     assert recovery_code.used is True
 
 
+def test_recovery_codes_are_stored_hashed():
+    user_id = '30'
+    auth.provision_user(user_id)
+    base.session.expire_all()
+
+    for recovery_code in auth.load_user(user_id).recovery_codes:
+        assert recovery_code.code is None
+        assert recovery_code.plaintext_code is None
+        assert len(recovery_code.code_hash) == 64
+
+
+def test_hash_recovery_code_uses_pepper():
+    code_hash = auth.hash_recovery_code('foo')
+    assert auth.hash_recovery_code('foo') == code_hash
+
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'recovery_code_pepper': 'something else'}},
+        namespace='adjure',
+    ):
+        assert auth.hash_recovery_code('foo') != code_hash
+
+
+def test_hash_recovery_code_requires_pepper():
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'recovery_code_pepper': ''}},
+        namespace='adjure',
+    ):
+        with pytest.raises(ValueError):
+            auth.hash_recovery_code('foo')
+
+
+def test_migrate_plaintext_recovery_codes():
+    user_id = '31'
+    auth.provision_user(user_id)
+    base.session.add_all([
+        RecoveryCode(user_id=user_id, plaintext_code='legacy{}'.format(i))
+        for i in range(3)
+    ])
+    base.session.commit()
+
+    assert auth.migrate_plaintext_recovery_codes(batch_size=2) == 3
+    assert auth.migrate_plaintext_recovery_codes(batch_size=2) == 0
+
+    auth.consume_recovery_code(user_id, 'legacy1')
+    with pytest.raises(auth.RecoveryCodeConsumptionError):
+        auth.consume_recovery_code(user_id, 'legacy1')
+
+
+def test_consume_recovery_code_is_committed():
+    user_id = '32'
+    auth_user = auth.provision_user(user_id)
+    code = auth_user.recovery_codes[0].code
+
+    auth.consume_recovery_code(user_id, code)
+    base.session.rollback()
+
+    with pytest.raises(auth.RecoveryCodeConsumptionError):
+        auth.consume_recovery_code(user_id, code)
+
+
+def test_consume_recovery_code_concurrently(file_database):
+    user_id = '33'
+    code = auth.provision_user(user_id).recovery_codes[0].code
+    base.session.remove()
+
+    results = run_concurrently(lambda: auth.consume_recovery_code(user_id, code), CONCURRENCY)
+
+    assert results.count(None) == 1
+    assert all(
+        isinstance(result, auth.RecoveryCodeConsumptionError)
+        for result in results if result is not None
+    )
+
+
+def test_regenerate_user_recovery_codes_concurrently(file_database):
+    user_id = '34'
+    auth.provision_user(user_id)
+    base.session.remove()
+
+    results = run_concurrently(
+        lambda: [code.code for code in auth.regenerate_user_recovery_codes(user_id).recovery_codes],
+        CONCURRENCY,
+    )
+
+    assert all(len(result) == auth.RECOVERY_CODE_COUNT for result in results)
+    recovery_codes = base.session.query(RecoveryCode).filter(RecoveryCode.user_id == user_id).all()
+    assert len(recovery_codes) == auth.RECOVERY_CODE_COUNT
+    # Only the last regeneration's codes survive, and they're all usable
+    last_codes = [
+        result for result in results
+        if set(auth.hash_recovery_code(code) for code in result) ==
+        set(recovery_code.code_hash for recovery_code in recovery_codes)
+    ]
+    assert len(last_codes) == 1
+    for code in last_codes[0]:
+        auth.consume_recovery_code(user_id, code)
+
+
+def test_regenerate_unknown_user_recovery_codes():
+    assert auth.regenerate_user_recovery_codes('not_a_user') is None
+
+
 def test_consume_recovery_code_wrong_user():
     user_id = '19'
     auth_user = auth.provision_user(user_id)
@@ -89,6 +296,102 @@ def test_consume_recovery_code_wrong_code():
         auth.consume_recovery_code(21, 'foobar')
 
 
+def test_bulk_provision_users():
+    auth.provision_user('bulk-existing')
+
+    results = list(auth.bulk_provision_users(
+        [
+            {'user_id': 'bulk-1'},
+            {'user_id': 'bulk-2', 'key_length': 8, 'hash_algorithm': 'SHA1'},
+            {'user_id': 'bulk-existing'},
+            {'user_id': 'bulk-1'},
+            {'user_id': 'bulk-3', 'key_length': 10},
+            {'user_id': 4},
+            None,
+            {'user_id': 'bulk-4'},
+        ],
+        chunk_size=3,
+    ))
+
+    assert [result.user_id for result in results] == [
+        'bulk-1', 'bulk-2', 'bulk-existing', 'bulk-1', 'bulk-3', 4, None, 'bulk-4',
+    ]
+    for index in (0, 1, 7):
+        assert results[index].error is None
+        assert len(results[index].recovery_codes) == auth.RECOVERY_CODE_COUNT
+        assert len(results[index].recovery_codes[0]) == 32
+    for index in (2, 3):
+        assert isinstance(results[index].error, auth.UserAlreadyProvisionedException)
+    for index in (4, 5, 6):
+        assert isinstance(results[index].error, auth.UserCreationException)
+        assert results[index].recovery_codes is None
+
+    user = auth.load_user('bulk-2')
+    assert user.key_length == 8
+    assert user.hash_algorithm == 'SHA1'
+    assert len(user.secret) == auth.SECRET_KEY_BYTES
+    assert set(code.code_hash for code in user.recovery_codes) == set(
+        auth.hash_recovery_code(code) for code in results[1].recovery_codes
+    )
+
+
+def test_bulk_provision_users_validates():
+    results = list(auth.bulk_provision_users(
+        [
+            {'user_id': 'bulk-invalid-1', 'hash_algorithm': ['SHA1']},
+            {'user_id': 'bulk-invalid-2', 'key_valid_duration': -5},
+            {'user_id': 'bulk-invalid-3', 'key_length': 'long'},
+            {'user_id': 'bulk-valid'},
+        ],
+        validate=lambda user: 'bad key_length' if 'key_length' in user else None,
+    ))
+
+    for result in results[:3]:
+        assert isinstance(result.error, auth.UserCreationException)
+    assert 'bad key_length' in str(results[2].error)
+    assert results[3].error is None
+
+
+def test_bulk_provision_users_insert_keeps_failing(monkeypatch):
+    def insert_users(shard, rows):
+        raise IntegrityError('INSERT', {}, Exception('conflict'))
+
+    monkeypatch.setattr(auth, '_insert_users', insert_users)
+    result, = auth.bulk_provision_users([{'user_id': 'bulk-conflict'}])
+
+    assert isinstance(result.error, auth.UserCreationException)
+    assert result.recovery_codes is None
+
+
+def test_bulk_provision_users_row_refused(monkeypatch):
+    insert_users = auth._insert_users
+
+    def refuse_long_ids(shard, rows):
+        if any(len(row['user_id']) > 128 for row in rows):
+            raise DataError('INSERT', {}, Exception('value too long'))
+        insert_users(shard, rows)
+
+    monkeypatch.setattr(auth, '_insert_users', refuse_long_ids)
+    results = list(auth.bulk_provision_users([
+        {'user_id': 'bulk-refused-1'},
+        {'user_id': 'x' * 129},
+        {'user_id': 'bulk-refused-2'},
+    ]))
+
+    assert [result.error is None for result in results] == [True, False, True]
+    assert isinstance(results[1].error, auth.UserCreationException)
+    assert results[1].recovery_codes is None
+    assert auth.load_user('bulk-refused-1') is not None
+    assert auth.load_user('bulk-refused-2') is not None
+
+
+def test_bulk_provision_users_invalidates_cache():
+    assert auth.load_user_params('bulk-5') is None
+    list(auth.bulk_provision_users([{'user_id': 'bulk-5'}]))
+
+    assert auth.load_user_params('bulk-5').user_id == 'bulk-5'
+
+
 def test_unsupported_key_length():
     with pytest.raises(auth.UserCreationException):
         auth.provision_user(1, key_length=10)
@@ -123,12 +426,95 @@ def test_authorize_user():
     assert auth.authorize_user(user_id, code_to_validate)
 
 
+def test_load_user_params_is_cached():
+    user_id = '22'
+    user = auth.provision_user(user_id)
+
+    params = auth.load_user_params(user_id)
+    assert params.secret == user.secret
+    assert params.key_length == user.key_length
+    assert auth.get_user_cache().get(user_id) is params
+
+
+def test_provision_user_invalidates_negative_cache():
+    user_id = '23'
+    assert auth.load_user_params(user_id) is None
+    assert user_id in auth.get_user_cache()
+
+    auth.provision_user(user_id)
+    assert auth.load_user_params(user_id).user_id == user_id
+
+
+def test_authorize_user_rejects_replayed_code():
+    user_id = '27'
+    user = auth.provision_user(user_id)
+    code = auth.get_auth_code_for_user(user).encode('ASCII')
+
+    assert auth.authorize_user(user_id, code)
+    with pytest.raises(auth.ReplayedCodeException):
+        auth.authorize_user(user_id, code)
+
+
+def test_authorize_user_rejects_older_code(monkeypatch):
+    user_id = '28'
+    user = auth.provision_user(user_id)
+    verifier = auth.get_verifier(user.secret, user.key_length, user.hash_algorithm, 30)
+    monkeypatch.setattr(auth, 'current_time', lambda: 400)
+
+    assert auth.authorize_user(user_id, verifier.generate(400))
+    with pytest.raises(auth.ReplayedCodeException):
+        auth.authorize_user(user_id, verifier.generate(370))
+    assert auth.authorize_user(user_id, verifier.generate(430))
+
+
+def test_replayed_code_rejected_before_loading_user(monkeypatch):
+    user_id = '29'
+    user = auth.provision_user(user_id)
+    verifier = auth.get_verifier(user.secret, user.key_length, user.hash_algorithm, 30)
+    monkeypatch.setattr(auth, 'current_time', lambda: 400)
+    auth.authorize_user(user_id, verifier.generate(430))
+
+    def fail(user_id):
+        raise AssertionError('User should not be loaded')
+
+    monkeypatch.setattr(auth, 'load_user_params', fail)
+    with pytest.raises(auth.ReplayedCodeException):
+        auth.authorize_user(user_id, verifier.generate(430))
+
+
 def test_authorize_user_not_found():
     user_id = '15'
-    with pytest.raises(auth.ValidationException):
+    with pytest.raises(auth.UnknownUserException):
         auth.authorize_user(user_id, 'foo')
 
 
+def test_load_users_params():
+    auth.provision_user('24')
+    auth.provision_user('25')
+
+    users_params = auth.load_users_params(['24', '25', '24', 'missing'])
+    assert set(users_params) == {'24', '25', 'missing'}
+    assert users_params['24'].user_id == '24'
+    assert users_params['25'].user_id == '25'
+    assert users_params['missing'] is None
+
+
+def test_authorize_users():
+    user = auth.provision_user('26')
+    code = auth.get_auth_code_for_user(user).encode('ASCII')
+
+    results = auth.authorize_users([
+        ('26', code),
+        ('26', b'999999999'),
+        ('not_a_user', code),
+    ])
+
+    assert results[0] == auth.AuthorizeResult(auth.DEFAULT_DEVICE, None)
+    assert results[1].device is None
+    assert isinstance(results[1].error, auth.ValidationException)
+    assert isinstance(results[2].error, auth.UnknownUserException)
+
+
 def test_sliding_window():
     current_time = 400
 
@@ -181,6 +567,34 @@ def test_totp_verify_60_second_window():
         auth.totp_verify(secret, key_length, hash_algorithm, 30, value, current_time, 0)
 
 
+@pytest.mark.parametrize('key_length', auth.SUPPORTED_KEY_LENGTHS)
+@pytest.mark.parametrize('hash_algorithm', sorted(auth.TOTP_HASH_ALGORITHMS))
+def test_verifier_matches_totp(key_length, hash_algorithm):
+    secret = os.urandom(20)
+    totp = auth.get_totp(secret, key_length, hash_algorithm, 30)
+    verifier = auth.TOTPVerifier(secret, key_length, hash_algorithm, 30)
+
+    for timestamp in (0, 29, 30, 400, 1234567890):
+        assert verifier.generate(timestamp) == totp.generate(timestamp)
+
+
+def test_verifier_returns_matched_step():
+    secret = os.urandom(20)
+    verifier = auth.TOTPVerifier(secret, 6, 'SHA1', 30)
+
+    assert verifier.verify(verifier.generate(370), 400, 1) == 12
+    assert verifier.verify(verifier.generate(400), 400, 1) == 13
+    assert verifier.verify(verifier.generate(340), 400, 1) is None
+
+
+def test_get_verifier_is_cached():
+    secret = os.urandom(20)
+    verifier = auth.get_verifier(secret, 6, 'SHA1', 30)
+
+    assert auth.get_verifier(secret, 6, 'SHA1', 30) is verifier
+    assert auth.get_verifier(secret, 8, 'SHA1', 30) is not verifier
+
+
 def test_auth_uri():
     user_id = '15'
     user = auth.provision_user(user_id)
@@ -199,3 +613,324 @@ def test_auth_uri():
     assert query['issuer'] == ['someissuer']
     assert query['secret'] == [b32encode(user.secret).decode('ASCII')]
     assert query['digits'] == [str(user.key_length)]
+
+
+def test_load_user_params_reads_replica(replica_database):
+    auth.provision_user('replica-1', key_length=6)
+    replica_database.execute(
+        base.Base.metadata.tables['adjure_auth_user'].insert().values(
+            user_id='replica-1',
+            secret=b'x' * 20,
+            key_length=8,
+            key_valid_duration=30,
+            hash_algorithm='SHA1',
+        )
+    )
+
+    # Just written, so the replica may be behind
+    assert auth.load_user_params('replica-1').key_length == 6
+
+    auth.get_recent_writes().clear()
+    auth.get_user_cache().clear()
+    assert auth.load_user_params('replica-1').key_length == 8
+    # Writes and write-path reads stay on the primary
+    assert auth.load_user('replica-1').key_length == 6
+
+
+def test_load_user_params_falls_back_to_primary(replica_database):
+    auth.provision_user('replica-2')
+
+    assert auth.load_user_params('replica-2').user_id == 'replica-2'
+    assert auth.load_users_params(['replica-2', 'replica-unknown']) == {
+        'replica-2': auth.load_user_params('replica-2'),
+        'replica-unknown': None,
+    }
+    assert replica_database.execute('SELECT COUNT(*) FROM adjure_auth_user').scalar() == 0
+
+
+def test_load_user_once_per_request(monkeypatch):
+    auth.provision_user('request-1')
+    queries = []
+    query = base.session.query
+
+    def counting_query(*args):
+        queries.append(args)
+        return query(*args)
+
+    monkeypatch.setattr(base.session, 'query', counting_query)
+    with build_app().app_context():
+        user = auth.load_user('request-1')
+        assert auth.load_user('request-1') is user
+        assert auth.load_user('request-unknown') is None
+        assert auth.load_user('request-unknown') is None
+    assert len(queries) == 2
+
+    auth.load_user('request-1')
+    auth.load_user('request-1')
+    assert len(queries) == 4
+
+
+def test_provision_user_remembered_for_request():
+    with build_app().app_context():
+        assert auth.load_user('request-2') is None
+        user = auth.provision_user('request-2')
+        assert auth.load_user('request-2') is user
+
+
+def test_sharded_users(shard_database):
+    shards = shard_database('shard-1', 'shard-2')
+    user_ids = ['sharded-{}'.format(index) for index in range(20)]
+    codes = {
+        user_id: auth.provision_user(user_id).recovery_codes[0].code
+        for user_id in user_ids
+    }
+    results = list(auth.bulk_provision_users(
+        [{'user_id': 'sharded-bulk-{}'.format(index)} for index in range(20)]
+    ))
+    assert all(result.error is None for result in results)
+    user_ids.extend(result.user_id for result in results)
+
+    for shard in shards:
+        assert shard_user_ids(shard) == set(
+            user_id for user_id in user_ids if base.shard_for(user_id) is shard
+        )
+        assert shard_user_ids(shard)
+
+    users_params = auth.load_users_params(user_ids)
+    assert all(users_params[user_id].user_id == user_id for user_id in user_ids)
+
+    for user_id, recovery_code in codes.items():
+        code = auth.get_auth_code_for_user(users_params[user_id]).encode('ASCII')
+        assert auth.authorize_user(user_id, code)
+        auth.consume_recovery_code(user_id, recovery_code)
+        assert auth.regenerate_user_recovery_codes(user_id).user_id == user_id
+        assert unused_recovery_codes(base.shard_for(user_id), user_id) == auth.RECOVERY_CODE_COUNT
+
+
+def test_rebalance_shards(shard_database):
+    shard_database('shard-1')
+    user_ids = ['rebalance-{}'.format(index) for index in range(30)]
+    codes = {
+        user_id: auth.provision_user(user_id).recovery_codes[0].code
+        for user_id in user_ids
+    }
+    base.session.remove()
+
+    shards = shard_database('shard-1', 'shard-2')
+    misplaced = [user_id for user_id in user_ids if base.shard_for(user_id) is shards[2]]
+    assert misplaced
+    assert auth.load_users_params(misplaced) == dict.fromkeys(misplaced)
+
+    with staticconf.testing.MockConfiguration(
+        {'database': {'rebalancing': True}, 'auth': {'recovery_code_pepper': PEPPER}},
+        namespace='adjure',
+    ):
+        auth.get_user_cache().clear()
+        assert all(auth.load_users_params(misplaced).values())
+        with pytest.raises(auth.UserAlreadyProvisionedException):
+            auth.provision_user(misplaced[0])
+        auth.consume_recovery_code(misplaced[0], codes[misplaced[0]])
+        auth.add_user_device(misplaced[0], 'token')
+
+        assert auth.rebalance_shards(batch_size=7) == len(misplaced)
+        assert auth.rebalance_shards() == 0
+
+    auth.get_user_cache().clear()
+    assert all(auth.load_users_params(user_ids).values())
+    assert shard_user_ids(shards[2]) == set(misplaced)
+    assert unused_recovery_codes(shards[2], misplaced[0]) == auth.RECOVERY_CODE_COUNT - 1
+    assert [device.name for device in auth.load_user_params(misplaced[0]).devices] == ['token']
+    with pytest.raises(auth.RecoveryCodeConsumptionError):
+        auth.consume_recovery_code(misplaced[0], codes[misplaced[0]])
+
+
+def test_move_user_keeps_existing_copy(shard_database):
+    source, target = shard_database('shard-1')[:2]
+    user_id = 'move-existing'
+    user = AuthUser(user_id=user_id, secret=b'0' * 20, key_length=6, key_valid_duration=30, hash_algorithm='SHA1')
+    for shard in (source, target):
+        shard.session.merge(user)
+        shard.session.commit()
+    target.session.execute(AuthUser.__table__.update().values(key_length=8))
+    target.session.commit()
+
+    assert auth.move_user(user_id, source, target)
+    assert user_id not in shard_user_ids(source)
+    assert target.session.query(AuthUser.key_length).filter(AuthUser.user_id == user_id).scalar() == 8
+    assert not auth.move_user(user_id, source, target)
+
+
+def test_move_user_failure_keeps_source(shard_database):
+    shards = shard_database('shard-1')
+    user_id = 'move-failure'
+    source = base.shard_for(user_id)
+    target, = [shard for shard in shards if shard is not source]
+    user = auth.provision_user(user_id)
+    code_hash = user.recovery_codes[0].code_hash
+    # A row target can't take a copy of, without target having the user
+    target.session.add(RecoveryCode(user_id=user_id, code_hash=code_hash, used=False))
+    target.session.commit()
+
+    with pytest.raises(IntegrityError):
+        auth.move_user(user_id, source, target)
+    assert user_id in shard_user_ids(source)
+    assert unused_recovery_codes(source, user_id) == auth.RECOVERY_CODE_COUNT
+    assert user_id not in shard_user_ids(target)
+
+
+def test_encrypted_secrets(file_database):
+    with staticconf.testing.MockConfiguration(ENCRYPTION_KEYS, namespace='adjure'):
+        user = auth.provision_user('encrypted-1')
+        result, = auth.bulk_provision_users([{'user_id': 'encrypted-2'}])
+        params = auth.load_users_params(['encrypted-1', 'encrypted-2'])
+        code = auth.get_auth_code_for_user(params['encrypted-1'])
+        uri = auth.user_auth_uri('encrypted-1', 'user', 'Adjure')
+
+    assert user.secret_key_version == 1
+    assert params['encrypted-2'].secret_key_version == 1
+    assert len(params['encrypted-2'].secret) > auth.SECRET_KEY_BYTES
+
+    with staticconf.testing.MockConfiguration(ENCRYPTION_KEYS, namespace='adjure'):
+        secret = encryption.decrypt_secret('encrypted-1', user.secret, 1)
+    assert b32encode(bytes(secret)).decode('ascii') == parse_qs(urlparse(uri).query)['secret'][0]
+    totp = auth.get_totp(bytes(secret), user.key_length, user.hash_algorithm, user.key_valid_duration)
+    assert code == totp.generate(auth.current_time()).decode('ascii')
+
+
+def test_rotate_secret_keys(file_database):
+    plaintext_secret = auth.provision_user('rotate-1').secret
+    with staticconf.testing.MockConfiguration(ENCRYPTION_KEYS, namespace='adjure'):
+        auth.provision_user('rotate-2')
+        auth.add_user_device('rotate-2', 'token')
+
+    rotated_keys = {
+        'auth': {
+            'recovery_code_pepper': PEPPER,
+            'secret_encryption': dict(
+                ENCRYPTION_KEYS['auth']['secret_encryption'],
+                keys=ENCRYPTION_KEYS['auth']['secret_encryption']['keys'] + [
+                    {'version': 2, 'key': base64.b64encode(b'2' * 32).decode('ascii')},
+                ],
+                current_version=2,
+            ),
+        },
+    }
+    with staticconf.testing.MockConfiguration(rotated_keys, namespace='adjure'):
+        assert auth.rotate_secret_keys(batch_size=1) == 3
+        assert auth.rotate_secret_keys() == 0
+        base.session.expire_all()
+        users = {user_id: auth.load_user(user_id) for user_id in ('rotate-1', 'rotate-2')}
+
+        assert all(user.secret_key_version == 2 for user in users.values())
+        assert users['rotate-2'].devices[0].secret_key_version == 2
+        secret = encryption.decrypt_secret('rotate-1', users['rotate-1'].secret, 2)
+    assert secret == bytearray(plaintext_secret)
+
+
+def test_user_devices(monkeypatch):
+    user_id = 'devices-1'
+    auth.provision_user(user_id)
+    device = auth.add_user_device(user_id, 'token', key_length=8, hash_algorithm='SHA1')
+    auth.add_user_device(user_id, 'phone')
+    assert device.key_length == 8
+
+    user = auth.load_user_params(user_id)
+    assert [device.name for device in user.devices] == ['phone', 'token']
+    assert all(device.key_valid_duration == user.key_valid_duration for device in user.devices)
+    monkeypatch.setattr(auth, 'current_time', lambda: 400)
+
+    assert auth.authorize_user(user_id, auth.get_auth_code_for_user(user, 'token').encode('ASCII')) == 'token'
+    # Time steps are shared by every device of the user
+    with pytest.raises(auth.ReplayedCodeException):
+        auth.authorize_user(user_id, auth.get_auth_code_for_user(user, 'phone').encode('ASCII'))
+    monkeypatch.setattr(auth, 'current_time', lambda: 430)
+    assert auth.authorize_user(user_id, auth.get_auth_code_for_user(user).encode('ASCII')) == 'default'
+
+    assert auth.get_auth_code_for_user(user, 'laptop') is None
+    assert auth.user_auth_uri(user_id, 'user', 'Adjure', device='laptop') is None
+    assert auth.user_auth_uri(user_id, 'user', 'Adjure', device='token') != auth.user_auth_uri(user_id, 'user', 'Adjure')
+
+    assert auth.remove_user_device(user_id, 'token')
+    assert not auth.remove_user_device(user_id, 'token')
+    assert [device.name for device in auth.load_user_params(user_id).devices] == ['phone']
+
+
+def test_removed_device_rejected_by_every_worker(replica_database, monkeypatch):
+    user_id = 'devices-revoked'
+    auth.provision_user(user_id)
+    auth.add_user_device(user_id, 'lost')
+    user = auth.load_user_params(user_id)
+    monkeypatch.setattr(auth, 'current_time', lambda: 400)
+    code = auth.get_auth_code_for_user(user, 'lost').encode('ASCII')
+
+    # Removed by another worker, whose cache invalidation this worker
+    # doesn't see, while the replica still has the device
+    replica_database.execute(AuthUser.__table__.insert().values(
+        user_id=user_id, secret=user.secret, key_length=6, key_valid_duration=30, hash_algorithm=user.hash_algorithm,
+    ))
+    replica_database.execute(AuthDevice.__table__.insert().values(
+        user_id=user_id, name='lost', secret=user.devices[0].secret, key_length=6, hash_algorithm=user.hash_algorithm,
+    ))
+    base.session.query(AuthDevice).filter(AuthDevice.user_id == user_id).delete()
+    base.session.commit()
+    auth.get_recent_writes().clear()
+
+    with pytest.raises(auth.ValidationException):
+        auth.authorize_user(user_id, code)
+
+
+def test_add_user_device_limit():
+    auth.provision_user('devices-limit')
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'max_devices': 2, 'recovery_code_pepper': PEPPER}},
+        namespace='adjure',
+    ):
+        auth.add_user_device('devices-limit', 'a')
+        auth.add_user_device('devices-limit', 'b')
+        with pytest.raises(auth.DeviceCreationException):
+            auth.add_user_device('devices-limit', 'c')
+
+    assert [device.name for device in auth.load_user_params('devices-limit').devices] == ['a', 'b']
+
+
+@pytest.mark.parametrize('name', ['', 'default', 'x' * 65])
+def test_add_user_device_bad_name(name):
+    auth.provision_user('devices-{}'.format(len(name)))
+    with pytest.raises(auth.DeviceCreationException):
+        auth.add_user_device('devices-{}'.format(len(name)), name)
+
+
+def test_add_user_device_twice():
+    auth.provision_user('devices-2')
+    auth.add_user_device('devices-2', 'token')
+
+    with pytest.raises(auth.DeviceCreationException):
+        auth.add_user_device('devices-2', 'token')
+
+
+def test_add_user_device_unknown_user():
+    assert auth.add_user_device('devices-unknown', 'token') is None
+
+
+def test_match_code():
+    verifiers = [
+        (name, auth.TOTPVerifier(secret, 6, 'SHA1', 30))
+        for name, secret in (('a', b'a' * 20), ('b', b'b' * 20))
+    ]
+    code = verifiers[1][1].generate(370)
+
+    assert auth.match_code(verifiers, code, 400, 1) == ('b', 12)
+    assert auth.match_code(verifiers, b'000000000', 400, 1) is None
+    # Candidates are kept until the windows move
+    candidates = verifiers[1][1].candidates(400, 1)
+    assert verifiers[1][1].candidates(401, 1) is candidates
+    assert verifiers[1][1].candidates(430, 1) is not candidates
+
+
+def test_verifier_cache_ttl_capped_at_secret_cache_ttl(monkeypatch):
+    monkeypatch.setattr(auth, '_verifier_cache', None)
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'verifier_cache': {'ttl': 3600}, 'secret_encryption': {'cache': {'ttl': 60}}}},
+        namespace='adjure',
+    ):
+        assert auth.get_verifier_cache().ttl == 60
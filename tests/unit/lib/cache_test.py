@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from adjure.lib.cache import LRUCache
+from adjure.lib.cache import SecretCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_set():
+    cache = LRUCache(max_size=2, ttl=10)
+    cache.set('a', 1)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('b', 'default') == 'default'
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+
+def test_caches_none_values():
+    cache = LRUCache(max_size=2, ttl=10)
+    cache.set('a', None)
+
+    assert 'a' in cache
+    assert 'b' not in cache
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert len(cache) == 2
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = LRUCache(max_size=2, ttl=10, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=1)
+
+    clock.now = 5
+    assert 'a' in cache
+    assert 'b' not in cache
+
+    clock.now = 10
+    assert 'a' not in cache
+
+
+def test_invalidate():
+    cache = LRUCache(max_size=2, ttl=10)
+    cache.set('a', 1)
+    cache.invalidate('a')
+    cache.invalidate('missing')
+
+    assert 'a' not in cache
+
+
+def test_zero_size_disables():
+    cache = LRUCache(max_size=0, ttl=10)
+    cache.set('a', 1)
+
+    assert 'a' not in cache
+
+
+def test_weigher_bounds_total_size():
+    cache = LRUCache(max_size=10, ttl=10, weigher=len)
+    cache.set('a', b'1234')
+    cache.set('b', b'1234')
+    cache.set('c', b'1234')
+
+    assert 'a' not in cache
+    assert cache.size == 8
+
+    cache.set('b', b'12')
+    assert cache.size == 6
+
+    cache.set('d', b'12345678901')
+    assert 'd' not in cache
+    assert cache.size == 6
+
+
+def test_secret_cache_zeroes_evicted_values():
+    clock = FakeClock()
+    cache = SecretCache(max_size=1, ttl=10, clock=clock)
+    secret = bytearray(b'secret')
+    cache.set('a', secret)
+    stored = cache._entries['a'][1]
+
+    copy = cache.get('a')
+    assert copy == secret
+    assert copy is not stored and stored is not secret
+
+    cache.set('b', b'other')
+    assert stored == bytearray(6)
+    assert copy == secret
+
+    stored = cache._entries['b'][1]
+    clock.now = 10
+    assert cache.get('b') is None
+    assert stored == bytearray(5)
+
+
+def test_secret_cache_zeroes_on_clear():
+    cache = SecretCache(max_size=2, ttl=10)
+    cache.set('a', b'secret')
+    stored = cache._entries['a'][1]
+
+    cache.clear()
+    assert stored == bytearray(6)
+    assert len(cache) == 0
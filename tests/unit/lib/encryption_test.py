@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import base64
+
+import pytest
+import staticconf.testing
+
+from adjure.lib import encryption
+
+
+KEYS = {
+    'auth': {
+        'secret_encryption': {
+            'keys': [
+                {'version': 1, 'key': base64.b64encode(b'1' * 32).decode('ascii')},
+                {'version': 2, 'key': base64.b64encode(b'2' * 16).decode('ascii')},
+            ],
+            'current_version': 2,
+        },
+    },
+}
+
+
+@pytest.yield_fixture
+def keys():
+    with staticconf.testing.MockConfiguration(KEYS, namespace='adjure'):
+        encryption.get_secret_cache().clear()
+        yield
+        encryption.get_secret_cache().clear()
+
+
+def test_unencrypted_without_current_version():
+    assert encryption.encrypt_secret('1', b'secret') == (b'secret', None)
+    assert encryption.decrypt_secret('1', b'secret', None) == bytearray(b'secret')
+
+
+def test_encrypt_decrypt(keys):
+    stored, key_version = encryption.encrypt_secret('1', b's' * 20)
+
+    assert key_version == 2
+    assert b's' * 20 not in stored
+    assert len(stored) == encryption.NONCE_BYTES + 20 + encryption.TAG_BYTES
+    assert encryption.decrypt_secret('1', stored, 2) == bytearray(b's' * 20)
+    # Every secret gets its own nonce
+    assert encryption.encrypt_secret('1', b's' * 20)[0] != stored
+
+
+def test_encrypt_with_key_version(keys):
+    stored, key_version = encryption.encrypt_secret('1', b's' * 20, key_version=1)
+
+    assert key_version == 1
+    assert encryption.decrypt_secret('1', stored, 1) == bytearray(b's' * 20)
+    with pytest.raises(encryption.SecretDecryptionException):
+        encryption.decrypt_secret('1', stored, 2)
+
+
+@pytest.mark.parametrize('user_id, key_version', [('2', 2), ('1', 3)])
+def test_decrypt_failure(keys, user_id, key_version):
+    stored, _ = encryption.encrypt_secret('1', b's' * 20)
+
+    with pytest.raises(encryption.SecretDecryptionException):
+        encryption.decrypt_secret(user_id, stored, key_version)
+
+
+def test_bad_key_size():
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'secret_encryption': {'keys': [{'version': 1, 'key': 'AAAA'}]}}},
+        namespace='adjure',
+    ):
+        with pytest.raises(ValueError):
+            encryption.read_keys()
+
+
+def test_decrypted_secret_is_cached_and_zeroed(keys, monkeypatch):
+    stored, key_version = encryption.encrypt_secret('1', b's' * 20)
+
+    with encryption.decrypted_secret('1', stored, key_version) as secret:
+        assert secret == bytearray(b's' * 20)
+    assert secret == bytearray(20)
+
+    def fail(*args):
+        raise AssertionError('Decrypted again')
+
+    monkeypatch.setattr(encryption, 'decrypt_secret', fail)
+    with encryption.decrypted_secret('1', stored, key_version) as secret:
+        assert secret == bytearray(b's' * 20)
+    assert secret == bytearray(20)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+
+from adjure.lib import entropy
+
+
+def test_read_slices_blocks(monkeypatch):
+    reads = []
+
+    def urandom(size):
+        reads.append(size)
+        return bytes(range(size))
+
+    monkeypatch.setattr(os, 'urandom', urandom)
+    pool = entropy.EntropyPool(block_size=64)
+
+    assert pool.read(20) == bytes(range(20))
+    assert pool.read(20) == bytes(range(20, 40))
+    assert pool.read(20) == bytes(range(40, 60))
+    assert reads == [64]
+
+    # Not enough left, so a new block is read
+    assert pool.read(20) == bytes(range(20))
+    assert reads == [64, 64]
+
+
+def test_read_zeroes_handed_out_bytes():
+    pool = entropy.EntropyPool(block_size=64)
+    pool.read(20)
+    assert pool._buffer[:20] == bytes(20)
+
+    buffer = pool._buffer
+    pool.after_fork()
+    assert buffer == bytes(64)
+
+
+def test_large_reads_bypass_buffer(monkeypatch):
+    pool = entropy.EntropyPool(block_size=16)
+    assert len(pool.read(100)) == 100
+
+
+def test_buffer_discarded_after_fork(monkeypatch):
+    pool = entropy.EntropyPool(block_size=64)
+    parent = pool.read(8)
+    monkeypatch.setattr(pool, '_buffer', bytearray(parent * 8))
+
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    child = pool.read(8)
+
+    assert child != parent
+    assert len(pool._buffer) == 64
+
+
+def test_after_fork(monkeypatch):
+    pool = entropy.EntropyPool(block_size=64)
+    pool.read(8)
+    pool.after_fork()
+
+    assert pool._buffer == b''
+    assert len(pool.read(8)) == 8
+
+
+def test_forked_children_differ():
+    read_fd, write_fd = os.pipe()
+    entropy.random_bytes(1)
+    pid = os.fork()
+    if pid == 0:
+        os.write(write_fd, entropy.random_bytes(16))
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 16) != entropy.random_bytes(16)
+
+
+def test_random_hex():
+    code = entropy.random_hex(16)
+
+    assert len(code) == 32
+    assert int(code, 16) >= 0
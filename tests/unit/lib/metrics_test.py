@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+
+import pytest
+import staticconf.testing
+
+from adjure.lib import metrics
+from adjure.lib.cache import LRUCache
+
+
+def sample(name, **labels):
+    return metrics.registry.samples().get((name, tuple(sorted(labels.items()))), 0)
+
+
+def dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+def archived(directory):
+    return metrics.read_samples(str(directory.join('archive.json'))) or {}
+
+
+@pytest.yield_fixture
+def multiprocess_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(metrics, '_flushed_pid', None)
+    with staticconf.testing.MockConfiguration(
+        {'metrics': {'multiprocess_dir': str(tmpdir), 'flush_interval': 60}},
+        namespace='adjure',
+    ):
+        yield tmpdir
+
+
+def test_counter():
+    before = sample('adjure_verifications_total', outcome='success')
+    metrics.VERIFICATIONS.inc(outcome='success')
+    metrics.VERIFICATIONS.inc(2, outcome='success')
+
+    assert sample('adjure_verifications_total', outcome='success') == before + 3
+
+
+def test_histogram():
+    histogram = metrics.QR_RENDER_DURATION
+    samples = metrics.registry.samples()
+    metrics.QR_RENDER_DURATION.observe(0.02, format='test')
+    metrics.QR_RENDER_DURATION.observe(100, format='test')
+    after = metrics.registry.samples()
+
+    def delta(key):
+        return after.get(key, 0) - samples.get(key, 0)
+
+    labels = (('format', 'test'),)
+    assert delta((histogram.name + '_count', labels)) == 2
+    assert delta((histogram.name + '_sum', labels)) == pytest.approx(100.02)
+    assert delta((histogram.name + '_bucket', labels + (('le', 0.025),))) == 1
+    assert delta((histogram.name + '_bucket', labels + (('le', float('inf')),))) == 1
+
+
+def test_tracked_cache():
+    cache = LRUCache(max_size=10, ttl=60)
+    metrics.registry.track_cache('test', cache)
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+
+    assert sample('adjure_cache_hits_total', cache='test') == 1
+    assert sample('adjure_cache_misses_total', cache='test') == 1
+
+
+def test_cache_counter_not_incremented():
+    with pytest.raises(TypeError):
+        metrics.CACHE_HITS.inc(cache='test')
+
+
+def test_render_text():
+    labels = (('endpoint', 'auth.user_authenticate'),)
+    text = metrics.render_text({
+        ('adjure_verifications_total', (('outcome', 'a "quoted"\nvalue'),)): 3,
+        ('adjure_http_request_duration_seconds_bucket', labels + (('le', 0.01),)): 1,
+        ('adjure_http_request_duration_seconds_bucket', labels + (('le', 0.1),)): 2,
+        ('adjure_http_request_duration_seconds_sum', labels): 0.15,
+        ('adjure_http_request_duration_seconds_count', labels): 3,
+    })
+    lines = text.splitlines()
+
+    assert '# TYPE adjure_verifications_total counter' in lines
+    assert 'adjure_verifications_total{outcome="a \\"quoted\\"\\nvalue"} 3.0' in lines
+    assert '# TYPE adjure_http_request_duration_seconds histogram' in lines
+    assert (
+        'adjure_http_request_duration_seconds_bucket'
+        '{endpoint="auth.user_authenticate",le="0.005"} 0.0'
+    ) in lines
+    assert (
+        'adjure_http_request_duration_seconds_bucket'
+        '{endpoint="auth.user_authenticate",le="0.1"} 3.0'
+    ) in lines
+    assert (
+        'adjure_http_request_duration_seconds_bucket'
+        '{endpoint="auth.user_authenticate",le="+Inf"} 3.0'
+    ) in lines
+    assert 'adjure_http_request_duration_seconds_count{endpoint="auth.user_authenticate"} 3.0' in lines
+
+
+def test_collect_multiprocess(multiprocess_dir):
+    key = ('adjure_verifications_total', (('outcome', 'success'),))
+    metrics.VERIFICATIONS.inc(outcome='success')
+    other_worker = multiprocess_dir.join('{}.json'.format(os.getpid() + 1))
+    other_worker.write(json.dumps(metrics.encode_samples({key: 5})))
+
+    samples = metrics.collect()
+
+    assert samples[key] == metrics.registry.samples()[key] + 5
+    assert multiprocess_dir.join('{}.json'.format(os.getpid())).check()
+
+
+def test_collect_archives_dead_worker(multiprocess_dir):
+    key = ('adjure_verifications_total', (('outcome', 'failure'),))
+    gauge_key = ('adjure_not_a_counter', ())
+    pid = dead_pid()
+    multiprocess_dir.join('{}.json'.format(pid)).write(
+        json.dumps(metrics.encode_samples({key: 5, gauge_key: 7}))
+    )
+    own = metrics.registry.samples().get(key, 0)
+
+    assert metrics.collect()[key] == own + 5
+    assert not multiprocess_dir.join('{}.json'.format(pid)).check()
+    assert archived(multiprocess_dir) == {key: 5}
+    # Folded in once, and no longer summed as a live process's
+    samples = metrics.collect()
+    assert samples[key] == own + 5
+    assert gauge_key not in samples
+
+
+def test_reused_pid_archived(multiprocess_dir):
+    key = ('adjure_verifications_total', (('outcome', 'failure'),))
+    multiprocess_dir.join('{}.json'.format(os.getpid())).write(
+        json.dumps(metrics.encode_samples({key: 5}))
+    )
+
+    metrics.flush()
+
+    assert archived(multiprocess_dir) == {key: 5}
+    assert metrics.collect()[key] == metrics.registry.samples().get(key, 0) + 5
+
+
+def test_shutdown_archives_last_samples(multiprocess_dir):
+    key = ('adjure_verifications_total', (('outcome', 'success'),))
+    metrics.flush()
+    # Not flushed yet, as flush_interval hasn't passed
+    metrics.VERIFICATIONS.inc(outcome='success')
+
+    metrics.shutdown()
+
+    assert not multiprocess_dir.join('{}.json'.format(os.getpid())).check()
+    assert archived(multiprocess_dir)[key] == metrics.registry.samples()[key]
+
+
+def test_clear_multiprocess_dir(multiprocess_dir):
+    multiprocess_dir.join('1.json').write('[]')
+    metrics.clear_multiprocess_dir()
+
+    assert multiprocess_dir.listdir() == []
+
+
+def test_values_reset_after_fork(monkeypatch):
+    metrics.VERIFICATIONS.inc(outcome='success')
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+
+    assert sample('adjure_verifications_total', outcome='success') == 0
+    metrics.VERIFICATIONS.inc(outcome='success')
+    assert sample('adjure_verifications_total', outcome='success') == 1
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import signal
+
+import pytest
+import staticconf
+import staticconf.testing
+
+from adjure.lib import qr
+
+
+AUTH_URI = 'otpauth://totp/issuer:username?secret=ABCDEFGH&issuer=issuer'
+PNG = qr.RenderOptions(format='png', box_size=10, border=4, error_correction='L')
+
+
+def test_render_options_defaults():
+    assert qr.render_options() == PNG
+    assert qr.render_options(format='svg', box_size='2', border='0', error_correction='H') == \
+        qr.RenderOptions(format='svg', box_size=2, border=0, error_correction='H')
+
+
+def test_render_png():
+    assert qr.render_qr_code(AUTH_URI, PNG).startswith(b'\x89PNG')
+
+
+def test_render_json():
+    options = PNG._replace(format='json', border=2)
+    matrix = json.loads(qr.render_qr_code(AUTH_URI, options).decode('utf-8'))
+
+    assert matrix['border'] == 2
+    assert matrix['modules'] == [
+        [int(module) for module in row]
+        for row in qr.make_qr_code(AUTH_URI, options).get_matrix()
+    ]
+    assert matrix['modules'][0] == [0] * len(matrix['modules'])
+    assert matrix['modules'][2][2:9] == [1] * 7
+
+
+def test_render_svg():
+    options = PNG._replace(format='svg', box_size=3, border=1)
+    size = len(qr.make_qr_code(AUTH_URI, options).get_matrix())
+    svg = qr.render_qr_code(AUTH_URI, options).decode('utf-8')
+
+    assert svg.startswith('<svg ')
+    assert 'width="{}"'.format(size * 3) in svg
+    assert 'viewBox="0 0 {0} {0}"'.format(size) in svg
+    # The top left finder pattern starts with a run of 7 dark modules
+    assert 'M1,1h7v1h-7z' in svg
+
+
+def test_image_cache_key():
+    key = qr.image_cache_key(AUTH_URI, PNG)
+
+    assert qr.image_cache_key(AUTH_URI, PNG) == key
+    assert qr.image_cache_key(AUTH_URI + 'x', PNG) != key
+    assert qr.image_cache_key(AUTH_URI, PNG._replace(format='svg')) != key
+    assert qr.image_cache_key(AUTH_URI, PNG._replace(box_size=5)) != key
+
+
+def test_cached_qr_code_image(monkeypatch):
+    image = qr.cached_qr_code_image(AUTH_URI, PNG)
+    assert qr.get_image_cache().get(qr.image_cache_key(AUTH_URI, PNG)) == image
+
+    def fail(auth_uri, options):
+        raise AssertionError('Image should not be rendered again')
+
+    monkeypatch.setattr(qr, 'render_qr_code', fail)
+    assert qr.cached_qr_code_image(AUTH_URI, PNG) == image
+
+
+@pytest.yield_fixture
+def process_renderer():
+    renderer = qr.ProcessPoolRenderer(processes=1, max_queue=1, timeout=30)
+    yield renderer
+    renderer.shutdown()
+
+
+def test_process_pool_renderer(process_renderer):
+    assert process_renderer.render(AUTH_URI, PNG) == qr.render_qr_code(AUTH_URI, PNG)
+
+
+def test_process_pool_renderer_queue_full(process_renderer):
+    process_renderer._slots.acquire()
+    process_renderer._slots.acquire()
+
+    with pytest.raises(qr.RendererBusyException):
+        process_renderer.render(AUTH_URI, PNG)
+
+
+def test_process_pool_renderer_timeout(process_renderer):
+    process_renderer.timeout = 0
+
+    with pytest.raises(qr.RendererBusyException):
+        process_renderer.render(AUTH_URI, PNG)
+
+
+def test_process_pool_renderer_recovers_from_dead_process(process_renderer):
+    process_renderer.render(AUTH_URI, PNG)
+    for process in list(process_renderer._executor._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+    with pytest.raises(qr.RendererBusyException):
+        process_renderer.render(AUTH_URI, PNG)
+    assert process_renderer.render(AUTH_URI, PNG) == qr.render_qr_code(AUTH_URI, PNG)
+
+
+def test_build_renderer():
+    with staticconf.testing.MockConfiguration(
+        {'qrcode': {'render': {'mode': 'process', 'processes': 3, 'max_queue': 0}}},
+        namespace='adjure',
+    ):
+        renderer = qr.build_renderer(staticconf.NamespaceReaders('adjure'))
+    renderer.shutdown()
+
+    assert isinstance(renderer, qr.ProcessPoolRenderer)
+    assert isinstance(qr.build_renderer(staticconf.NamespaceReaders('adjure')), qr.InlineRenderer)
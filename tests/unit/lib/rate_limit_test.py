@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import pytest
+import staticconf.testing
+
+from adjure.lib.rate_limit import client_ip
+from adjure.lib.rate_limit import InMemoryRateLimiter
+from adjure.lib.rate_limit import NullRateLimiter
+from adjure.lib.rate_limit import RateLimit
+from adjure.lib.rate_limit import RateLimiter
+from adjure.lib.rate_limit import SQLiteRateLimiter
+
+
+LIMIT = RateLimit(capacity=2, refill_rate=0.5)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def limiter(request, tmpdir):
+    if request.param == 'memory':
+        return InMemoryRateLimiter(purge_interval=10)
+    return SQLiteRateLimiter(str(tmpdir.join('rate_limit.db')), purge_interval=10)
+
+
+def test_bucket_empties_and_refills(limiter):
+    assert limiter.acquire('a', LIMIT, 1000) == 0
+    assert limiter.acquire('a', LIMIT, 1000) == 0
+    assert limiter.acquire('a', LIMIT, 1000) == 2
+    assert limiter.acquire('a', LIMIT, 1001) == 1
+    assert limiter.acquire('a', LIMIT, 1002) == 0
+    assert limiter.acquire('a', LIMIT, 1002) == 2
+
+
+def test_cost_takes_several_tokens(limiter):
+    limit = RateLimit(capacity=5, refill_rate=0.5)
+
+    assert limiter.acquire('a', limit, 1000, cost=3) == 0
+    # Refused as a whole, taking nothing
+    assert limiter.acquire('a', limit, 1000, cost=3) == 2
+    assert limiter.acquire('a', limit, 1000, cost=2) == 0
+    assert limiter.acquire('a', limit, 1000) == 2
+
+
+def test_buckets_are_per_key(limiter):
+    limiter.acquire('a', LIMIT, 1000)
+    limiter.acquire('a', LIMIT, 1000)
+
+    assert limiter.acquire('a', LIMIT, 1000)
+    assert limiter.acquire('b', LIMIT, 1000) == 0
+
+
+def test_refill_is_capped(limiter):
+    limiter.acquire('a', LIMIT, 1000)
+
+    assert limiter.acquire('a', LIMIT, 5000) == 0
+    assert limiter.acquire('a', LIMIT, 5000) == 0
+    assert limiter.acquire('a', LIMIT, 5000) == 2
+
+
+def test_memory_limiter_purges_full_buckets():
+    limiter = InMemoryRateLimiter(purge_interval=10)
+    limiter.acquire('a', LIMIT, 1000)
+    limiter.acquire('b', LIMIT, 1010)
+
+    assert len(limiter) == 1
+
+
+def test_sqlite_limiter_is_shared(tmpdir):
+    path = str(tmpdir.join('rate_limit.db'))
+    SQLiteRateLimiter(path).acquire('a', LIMIT, 1000)
+    SQLiteRateLimiter(path).acquire('a', LIMIT, 1000)
+
+    assert SQLiteRateLimiter(path).acquire('a', LIMIT, 1000) == 2
+
+
+def test_null_limiter():
+    for _ in range(5):
+        assert NullRateLimiter().acquire('a', LIMIT, 1000) == 0
+
+
+def test_incomplete_limiter_fails_on_construction():
+    class NoAcquireLimiter(RateLimiter):
+        pass
+
+    with pytest.raises(TypeError):
+        NoAcquireLimiter()
+
+
+@pytest.mark.parametrize(
+    ('trusted_proxies', 'forwarded_for', 'expected'),
+    [
+        (0, '1.1.1.1, 2.2.2.2', '10.0.0.1'),
+        (1, None, '10.0.0.1'),
+        (1, '1.1.1.1, 2.2.2.2', '2.2.2.2'),
+        (2, '1.1.1.1, 2.2.2.2', '1.1.1.1'),
+        (2, 'spoofed, 1.1.1.1, 2.2.2.2', '1.1.1.1'),
+        (3, '1.1.1.1, 2.2.2.2', '10.0.0.1'),
+    ]
+)
+def test_client_ip(trusted_proxies, forwarded_for, expected):
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'rate_limit': {'trusted_proxies': trusted_proxies}}},
+        namespace='adjure',
+    ):
+        assert client_ip('10.0.0.1', forwarded_for) == expected
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from adjure.lib.replay import InMemoryReplayLedger
+from adjure.lib.replay import NullReplayLedger
+from adjure.lib.replay import ReplayLedger
+from adjure.lib.replay import SQLiteReplayLedger
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def ledger(request, tmpdir):
+    if request.param == 'memory':
+        return InMemoryReplayLedger(purge_interval=10)
+    return SQLiteReplayLedger(str(tmpdir.join('replay.db')), purge_interval=10)
+
+
+def test_record_rejects_same_and_older_steps(ledger):
+    assert ledger.last_step('1', 1000) is None
+    assert ledger.record('1', 33, 30, 1050, 1000)
+    assert ledger.last_step('1', 1000) == (33, 30)
+    assert not ledger.record('1', 33, 30, 1050, 1000)
+    assert not ledger.record('1', 32, 30, 1050, 1000)
+    assert ledger.record('1', 34, 30, 1080, 1000)
+    assert ledger.record('2', 33, 30, 1050, 1000)
+
+
+def test_entries_expire(ledger):
+    ledger.record('1', 33, 30, 1050, 1000)
+
+    assert ledger.last_step('1', 1050) is None
+    assert ledger.record('1', 33, 30, 1080, 1050)
+
+
+def test_memory_ledger_purges_expired_entries():
+    ledger = InMemoryReplayLedger(purge_interval=10)
+    ledger.record('1', 33, 30, 1005, 1000)
+    ledger.record('2', 33, 30, 1050, 1010)
+
+    assert len(ledger) == 1
+
+
+def test_sqlite_ledger_is_shared(tmpdir):
+    path = str(tmpdir.join('replay.db'))
+    SQLiteReplayLedger(path).record('1', 33, 30, 1050, 1000)
+
+    assert not SQLiteReplayLedger(path).record('1', 33, 30, 1050, 1000)
+
+
+def test_null_ledger():
+    ledger = NullReplayLedger()
+    assert ledger.record('1', 33, 30, 1050, 1000)
+    assert ledger.record('1', 33, 30, 1050, 1000)
+    assert ledger.last_step('1', 1000) is None
+
+
+def test_incomplete_ledger_fails_on_construction():
+    class LastStepOnlyLedger(ReplayLedger):
+
+        def last_step(self, user_id, now):
+            return None
+
+    with pytest.raises(TypeError):
+        LastStepOnlyLedger()
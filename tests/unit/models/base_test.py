@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pytest
+import staticconf
+import staticconf.testing
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from adjure.models import base
+
+
+def test_engine_options_sqlite():
+    config = staticconf.NamespaceReaders('adjure')
+    assert base.engine_options('sqlite://', config) == {'convert_unicode': True}
+
+
+def test_engine_options_pool():
+    config = staticconf.NamespaceReaders('adjure')
+    options = base.engine_options('postgresql://adjure@localhost/adjure', config)
+
+    assert options['pool_size'] == 5
+    assert options['max_overflow'] == 10
+    assert options['pool_timeout'] == 30
+    assert options['pool_recycle'] == 3600
+
+
+def test_pre_ping_reconnects(tmpdir):
+    engine = create_engine('sqlite:///{}'.format(tmpdir.join('db')), poolclass=QueuePool)
+    base.install_pre_ping(engine)
+
+    connection = engine.connect()
+    connection.connection.connection.close()
+    connection.close()
+
+    assert engine.scalar('SELECT 2') == 2
+
+
+def test_pool_status(monkeypatch, tmpdir):
+    engine = create_engine(
+        'sqlite:///{}'.format(tmpdir.join('db')),
+        poolclass=QueuePool,
+        pool_size=3,
+        max_overflow=2,
+    )
+    monkeypatch.setattr(base, 'engines', [engine])
+
+    connection = engine.connect()
+    status, = base.pool_status()
+    connection.close()
+
+    assert status['pool'] == 'QueuePool'
+    assert status['size'] == 3
+    assert status['checked_out'] == 1
+    assert status['overflow'] == 0
+    assert status['max_overflow'] == 2
+    assert status['saturation'] == 0.2
+
+
+def test_ping_database():
+    base.ping_database()
+
+
+def test_bind_database_engine_leaves_schema_alone(monkeypatch, tmpdir):
+    original_bind = base.session.session_factory.kw['bind']
+    monkeypatch.setattr(base, 'engines', [])
+    engine = base.bind_database_engine('sqlite:///{}'.format(tmpdir.join('db')))
+    base.session.configure(bind=original_bind)
+
+    assert engine.table_names() == []
+
+
+def test_query_stats(caplog):
+    engine = create_engine('sqlite://')
+    base.install_query_stats(engine, slow_query_threshold=0.000001)
+
+    base.query_stats.reset()
+    with caplog.at_level(logging.WARNING, logger='adjure.models.base'):
+        engine.scalar('SELECT 2')
+        engine.scalar('SELECT 3')
+
+    assert base.query_stats.count == 2
+    assert base.query_stats.duration > 0
+    assert [record.getMessage().split(': ')[1] for record in caplog.records] == ['SELECT 2', 'SELECT 3']
+
+    base.query_stats.reset()
+    assert base.query_stats.count == 0
+
+
+def test_query_stats_skip_pre_ping(caplog, tmpdir):
+    engine = create_engine('sqlite:///{}'.format(tmpdir.join('db')), poolclass=QueuePool)
+    base.install_pre_ping(engine)
+    base.install_query_stats(engine, slow_query_threshold=0.000001)
+
+    base.query_stats.reset()
+    with caplog.at_level(logging.WARNING, logger='adjure.models.base'):
+        engine.scalar('SELECT 2')
+        # Reconnecting pings again
+        connection = engine.connect()
+        connection.connection.connection.close()
+        connection.close()
+        engine.scalar('SELECT 3')
+
+    assert base.query_stats.count == 2
+    assert [
+        record.getMessage().split(': ')[1]
+        for record in caplog.records
+        if record.name == 'adjure.models.base'
+    ] == ['SELECT 2', 'SELECT 3']
+
+
+def test_query_stats_no_slow_query_log(caplog):
+    engine = create_engine('sqlite://')
+    base.install_query_stats(engine, slow_query_threshold=0)
+
+    with caplog.at_level(logging.WARNING, logger='adjure.models.base'):
+        engine.scalar('SELECT 2')
+
+    assert caplog.records == []
+
+
+def test_shard_for_single_shard():
+    assert base.shard_for('1') is base.shards[0]
+
+
+def test_shard_for(monkeypatch):
+    shards = [base.Shard(name, None, None) for name in ('default', 'shard-1', 'shard-2')]
+    monkeypatch.setattr(base, 'shards', shards)
+    user_ids = [str(user_id) for user_id in range(300)]
+
+    placement = {user_id: base.shard_for(user_id) for user_id in user_ids}
+    assert set(placement.values()) == set(shards)
+    assert placement == {user_id: base.shard_for(user_id) for user_id in user_ids}
+
+    # Only the users that belong on an added shard move
+    shards.append(base.Shard('shard-3', None, None))
+    moved = [user_id for user_id in user_ids if base.shard_for(user_id) is not placement[user_id]]
+    assert moved
+    assert all(base.shard_for(user_id) is shards[3] for user_id in moved)
+
+    # Draining a shard only moves the users on it
+    placement = {user_id: base.shard_for(user_id) for user_id in user_ids}
+    shards[1].draining = True
+    for user_id in user_ids:
+        if placement[user_id] is shards[1]:
+            assert base.shard_for(user_id) is not shards[1]
+        else:
+            assert base.shard_for(user_id) is placement[user_id]
+
+
+def test_lookup_shards(monkeypatch):
+    shards = [base.Shard(name, None, None) for name in ('default', 'shard-1')]
+    monkeypatch.setattr(base, 'shards', shards)
+
+    assert base.lookup_shards(shards[1]) == [shards[1]]
+    with staticconf.testing.MockConfiguration(
+        {'database': {'rebalancing': True}},
+        namespace='adjure',
+    ):
+        assert base.lookup_shards(shards[1]) == [shards[1], shards[0]]
+
+
+def test_bind_shard_engines_rejects_repeated_names():
+    with pytest.raises(ValueError):
+        base.bind_shard_engines([
+            {'name': 'default', 'url': 'sqlite://'},
+        ])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy import inspect
+
+from adjure.models import migrations
+
+
+LEGACY_RECOVERY_CODE_TABLE = (
+    'CREATE TABLE adjure_recovery_code ('
+    'id INTEGER PRIMARY KEY, '
+    'user_id VARCHAR(128) NOT NULL, '
+    'code VARCHAR(32){}, '
+    'used BOOLEAN NOT NULL)'
+)
+
+
+def legacy_engine(tmpdir, code_constraint=''):
+    engine = create_engine('sqlite:///{}'.format(tmpdir.join('legacy.db')))
+    engine.execute(LEGACY_RECOVERY_CODE_TABLE.format(code_constraint))
+    engine.execute('CREATE INDEX ix_adjure_recovery_code_code ON adjure_recovery_code (code)')
+    return engine
+
+
+def test_upgrade_recovery_code_table(tmpdir):
+    engine = legacy_engine(tmpdir)
+
+    migrations.upgrade_recovery_code_table(engine)
+    migrations.upgrade_recovery_code_table(engine)
+
+    inspector = inspect(engine)
+    assert 'code_hash' in [column['name'] for column in inspector.get_columns('adjure_recovery_code')]
+    indexes = {index['name']: index for index in inspector.get_indexes('adjure_recovery_code')}
+    assert set(indexes) == {migrations.RECOVERY_CODE_HASH_INDEX}
+    assert indexes[migrations.RECOVERY_CODE_HASH_INDEX]['unique']
+    assert indexes[migrations.RECOVERY_CODE_HASH_INDEX]['column_names'] == ['user_id', 'code_hash']
+
+
+def test_upgrade_recovery_code_table_sqlite_not_null(tmpdir):
+    engine = legacy_engine(tmpdir, ' NOT NULL')
+
+    with pytest.raises(ValueError):
+        migrations.upgrade_recovery_code_table(engine)
+
+
+def test_migrate_schema(tmpdir):
+    engine = create_engine('sqlite:///{}'.format(tmpdir.join('new.db')))
+
+    migrations.migrate_schema(engine)
+    migrations.migrate_schema(engine)
+
+    assert set(inspect(engine).get_table_names()) == {'adjure_auth_user', 'adjure_auth_device', 'adjure_recovery_code'}
+
+
+def test_upgrade_auth_user_table(tmpdir):
+    engine = create_engine('sqlite:///{}'.format(tmpdir.join('legacy.db')))
+    engine.execute(
+        'CREATE TABLE adjure_auth_user ('
+        'id INTEGER PRIMARY KEY, '
+        'user_id VARCHAR(128) NOT NULL UNIQUE, '
+        'secret BLOB NOT NULL, '
+        'key_length INTEGER NOT NULL, '
+        'key_valid_duration INTEGER NOT NULL, '
+        'hash_algorithm VARCHAR(8) NOT NULL)'
+    )
+
+    migrations.upgrade_auth_user_table(engine)
+    migrations.upgrade_auth_user_table(engine)
+
+    columns = [column['name'] for column in inspect(engine).get_columns('adjure_auth_user')]
+    assert 'secret_key_version' in columns
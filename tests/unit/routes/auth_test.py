@@ -3,9 +3,13 @@ import json
 from urllib.parse import urlencode
 
 import pytest
+import staticconf.testing
+from sqlalchemy import event
 
 from adjure.app import build_app
 from adjure.lib import auth
+from adjure.lib import qr
+from adjure.models import base
 
 
 @pytest.yield_fixture
@@ -14,6 +18,21 @@ def adjure():
         yield adjure_
 
 
+@pytest.yield_fixture
+def queries():
+    """Statements run against the database, other than pool pre-pings"""
+    statements = []
+    engine = base.session.session_factory.kw['bind']
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if statement != 'SELECT 1':
+            statements.append(statement.split(None, 1)[0])
+
+    event.listen(engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', record)
+
+
 def post(adjure, route, data):
     # Not a super convenient API, so wrap it
     resp = adjure.post(
@@ -45,6 +64,7 @@ def test_user_provision(adjure):
     [
         ({},),
         ({'user_id': 2},),
+        ({'user_id': 'x' * 129},),
     ]
 )
 def test_user_provision_bad_user_data(adjure, input_data):
@@ -59,6 +79,35 @@ def test_provision_user_twice_fails(adjure):
     assert resp.status_code == 400
 
 
+def test_user_provision_bulk(adjure):
+    post(adjure, '/user/provision', {'user_id': 'route-bulk-existing'})
+    body = '\n'.join([
+        json.dumps({'user_id': 'route-bulk-1'}),
+        'not json',
+        '',
+        json.dumps({'user_id': 'route-bulk-existing'}),
+        json.dumps({'user_id': 'route-bulk-2', 'hash_algorithm': ['SHA1']}),
+        json.dumps({'user_id': 'route-bulk-3', 'key_valid_duration': -5}),
+        json.dumps({'user_id': 'x' * 129}),
+    ])
+
+    resp = adjure.post(
+        '/user/provision/bulk',
+        data=body,
+        headers={'content-type': 'application/x-ndjson'},
+    )
+    results = [json.loads(line) for line in resp.data.decode(resp.charset).splitlines()]
+
+    assert resp.status_code == 200
+    assert len(results) == 6
+    assert results[0]['user_id'] == 'route-bulk-1'
+    assert len(results[0]['recovery_codes']) == auth.RECOVERY_CODE_COUNT
+    assert results[1]['error_code'] == 'USER_PROVISION_FAILURE'
+    assert results[2]['error_code'] == 'USER_ALREADY_PROVISIONED'
+    assert [result['error_code'] for result in results[3:]] == ['USER_PROVISION_FAILURE'] * 3
+    assert auth.load_user('route-bulk-3') is None
+
+
 def test_authenticate_user(adjure):
     user_id = '3'
     post(adjure, '/user/provision', {'user_id': user_id})
@@ -71,6 +120,40 @@ def test_authenticate_user(adjure):
     )
 
     assert authenticate_response.status_code == 200
+    assert authenticate_response.json == {'device': 'default'}
+
+
+def test_user_devices(adjure, queries):
+    user_id = '13'
+    post(adjure, '/user/provision', {'user_id': user_id})
+
+    resp = post(adjure, '/user/device/add', {'user_id': user_id, 'name': 'token', 'key_length': 8})
+    assert resp.json == {'user_id': user_id, 'device': 'token'}
+    assert post(adjure, '/user/device/add', {'user_id': user_id, 'name': 'token'}).json['error_code'] == \
+        'DEVICE_ADD_FAILURE'
+    assert post(adjure, '/user/device/add', {'user_id': 'nobody', 'name': 'token'}).json['error_code'] == \
+        'USER_NOT_FOUND'
+
+    qrcode = adjure.get('/user/qrcode?{}'.format(urlencode(
+        {'user_id': user_id, 'issuer': 'Adjure', 'username': 'foo', 'device': 'token', 'format': 'json'}
+    )))
+    assert qrcode.status_code == 200
+
+    auth.get_user_cache().invalidate(user_id)
+    del queries[:]
+    code = get(adjure, '/user/auth_code', {'user_id': user_id, 'device': 'token'}).json['code']
+    # The user and its devices are loaded together
+    assert queries == ['SELECT']
+    assert len(code) == 8
+    resp = post(adjure, '/user/authenticate', {'user_id': user_id, 'auth_code': code})
+    assert resp.status_code == 200
+    assert resp.json == {'device': 'token'}
+
+    assert post(adjure, '/user/device/remove', {'user_id': user_id, 'name': 'token'}).status_code == 200
+    resp = post(adjure, '/user/device/remove', {'user_id': user_id, 'name': 'token'})
+    assert resp.json['error_code'] == 'DEVICE_NOT_FOUND'
+    resp = get(adjure, '/user/auth_code', {'user_id': user_id, 'device': 'token'})
+    assert resp.json['error_code'] == 'DEVICE_NOT_FOUND'
 
 
 def test_authenticate_user_failure(adjure):
@@ -80,42 +163,193 @@ def test_authenticate_user_failure(adjure):
     authenticate_response = post(
         adjure,
         '/user/authenticate',
-        {'user_id': user_id, 'auth_code': '99999'}
+        {'user_id': user_id, 'auth_code': '9999999'}
     )
     assert authenticate_response.status_code == 400
 
 
-def test_validate_recovery_code(adjure):
+def test_authenticate_batch(adjure):
+    user_id = '7'
+    post(adjure, '/user/provision', {'user_id': user_id})
+    code = get(adjure, '/user/auth_code', {'user_id': user_id}).json['code']
+
+    resp = post(
+        adjure,
+        '/user/authenticate/batch',
+        {'attempts': [
+            {'user_id': user_id, 'auth_code': code},
+            {'user_id': user_id, 'auth_code': '9999999'},
+            {'user_id': 'nobody', 'auth_code': code},
+        ]}
+    )
+
+    assert resp.status_code == 200
+    assert resp.json['results'] == [
+        {'user_id': user_id, 'authenticated': True, 'device': 'default'},
+        {'user_id': user_id, 'authenticated': False, 'error_code': 'VALIDATION_FAILURE'},
+        {'user_id': 'nobody', 'authenticated': False, 'error_code': 'USER_NOT_FOUND'},
+    ]
+
+
+@pytest.mark.parametrize('auth_code', ['12345', '12345é', '１２３４５６'])
+def test_authenticate_bad_code(adjure, auth_code):
+    resp = post(adjure, '/user/authenticate', {'user_id': '3', 'auth_code': auth_code})
+    assert resp.status_code == 400
+    assert resp.json['error_code'] == 'INVALID_PARAMS'
+
+    resp = post(
+        adjure,
+        '/user/authenticate/batch',
+        {'attempts': [{'user_id': '3', 'auth_code': auth_code}]},
+    )
+    assert resp.status_code == 400
+    assert resp.json['error_code'] == 'INVALID_PARAMS'
+
+
+def test_authenticate_batch_too_large(adjure):
+    attempts = [{'user_id': '7', 'auth_code': '123456'}] * 3
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'max_batch_size': 2}},
+        namespace='adjure',
+    ):
+        resp = post(adjure, '/user/authenticate/batch', {'attempts': attempts})
+
+    assert resp.status_code == 400
+    assert resp.json['error_code'] == 'BATCH_TOO_LARGE'
+
+
+def test_authenticate_rate_limited_per_user(adjure):
+    user_id = '8'
+    post(adjure, '/user/provision', {'user_id': user_id})
+
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'rate_limit': {'per_user': {'capacity': 2, 'refill_rate': 0.01}}}},
+        namespace='adjure',
+    ):
+        responses = [
+            post(adjure, '/user/authenticate', {'user_id': user_id, 'auth_code': '9999999'})
+            for _ in range(3)
+        ]
+        recovery_response = post(
+            adjure,
+            '/user/recovery/authenticate',
+            {'user_id': user_id, 'recovery_code': 'lolthisisntarealcode'},
+        )
+        batch_response = post(
+            adjure,
+            '/user/authenticate/batch',
+            {'attempts': [{'user_id': user_id, 'auth_code': '9999999'}]},
+        )
+
+    assert [resp.status_code for resp in responses] == [400, 400, 429]
+    assert responses[2].json['error_code'] == 'RATE_LIMITED'
+    assert int(responses[2].headers['Retry-After']) > 0
+    assert recovery_response.status_code == 429
+    assert batch_response.json['results'][0]['error_code'] == 'RATE_LIMITED'
+
+
+def test_authenticate_rate_limited_per_ip(adjure):
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'rate_limit': {'per_ip': {'capacity': 1, 'refill_rate': 0.01}}}},
+        namespace='adjure',
+    ):
+        responses = [
+            adjure.post(
+                '/user/authenticate',
+                data=json.dumps({'user_id': '9', 'auth_code': '9999999'}),
+                headers={'content-type': 'application/json'},
+                environ_base={'REMOTE_ADDR': '10.0.0.1'},
+            )
+            for _ in range(2)
+        ]
+
+    assert [resp.status_code for resp in responses] == [400, 429]
+
+
+def test_authenticate_batch_rate_limited_per_ip_attempt(adjure):
+    def batch(size):
+        return adjure.post(
+            '/user/authenticate/batch',
+            data=json.dumps({'attempts': [{'user_id': '9', 'auth_code': '9999999'}] * size}),
+            headers={'content-type': 'application/json'},
+            environ_base={'REMOTE_ADDR': '10.0.0.3'},
+        )
+
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'rate_limit': {'per_ip': {'capacity': 5, 'refill_rate': 0.01}}}},
+        namespace='adjure',
+    ):
+        responses = [batch(3), batch(3), batch(2)]
+
+    assert [resp.status_code for resp in responses] == [200, 429, 200]
+    assert json.loads(responses[1].data.decode('utf-8'))['error_code'] == 'RATE_LIMITED'
+
+
+def test_authenticate_rate_limited_per_forwarded_ip(adjure):
+    with staticconf.testing.MockConfiguration(
+        {'auth': {'rate_limit': {'trusted_proxies': 1, 'per_ip': {'capacity': 1, 'refill_rate': 0.01}}}},
+        namespace='adjure',
+    ):
+        responses = [
+            adjure.post(
+                '/user/authenticate',
+                data=json.dumps({'user_id': '9', 'auth_code': '9999999'}),
+                headers={'content-type': 'application/json', 'X-Forwarded-For': forwarded_for},
+                environ_base={'REMOTE_ADDR': '10.0.0.2'},
+            )
+            for forwarded_for in ('1.1.1.1', '2.2.2.2', '1.1.1.1')
+        ]
+
+    assert [resp.status_code for resp in responses] == [400, 400, 429]
+
+
+def test_validate_recovery_code(adjure, queries):
     user_id = '4'
     resp = post(adjure, '/user/provision', {'user_id': user_id})
 
     recovery_code = resp.json['recovery_codes'][0]
 
+    del queries[:]
     recovery_authenticate_response = post(
         adjure,
         '/user/recovery/authenticate',
         {'user_id': user_id, 'recovery_code': recovery_code}
     )
     assert recovery_authenticate_response.status_code == 200
+    assert queries == ['UPDATE']
 
 
-def test_failed_validate_recovery_code(adjure):
+def test_failed_validate_recovery_code(adjure, queries):
     user_id = '5'
     post(adjure, '/user/provision', {'user_id': user_id})
 
+    del queries[:]
     recovery_authenticate_response = post(
         adjure,
         '/user/recovery/authenticate',
         {'user_id': user_id, 'recovery_code': 'lolthisisntarealcode'}
     )
     assert recovery_authenticate_response.status_code == 400
+    assert recovery_authenticate_response.json['error_code'] == 'INVALID_RECOVERY_CODE'
+    assert queries == ['UPDATE', 'SELECT']
 
 
-def test_regenerate_recovery_codes(adjure):
+def test_validate_recovery_code_unknown_user(adjure):
+    resp = post(
+        adjure,
+        '/user/recovery/authenticate',
+        {'user_id': 'nobody', 'recovery_code': 'lolthisisntarealcode'}
+    )
+    assert resp.status_code == 400
+    assert resp.json['error_code'] == 'USER_NOT_FOUND'
+
+
+def test_regenerate_recovery_codes(adjure, queries):
     user_id = '6'
     resp = post(adjure, '/user/provision', {'user_id': user_id})
     recovery_codes = set(resp.json['recovery_codes'])
 
+    del queries[:]
     regenerated_code_response = post(
         adjure,
         '/user/recovery/regenerate',
@@ -123,6 +357,107 @@ def test_regenerate_recovery_codes(adjure):
     )
     regenerated_codes = set(regenerated_code_response.json['recovery_codes'])
 
+    # Lock the user, replace the codes, and load the user for the response
+    assert queries == ['UPDATE', 'DELETE', 'INSERT', 'SELECT']
+
     assert recovery_codes != regenerated_codes
     assert len(recovery_codes) == 10
     assert len(regenerated_codes) == 10
+
+
+def test_regenerate_recovery_codes_unknown_user(adjure, queries):
+    resp = post(adjure, '/user/recovery/regenerate', {'user_id': 'nobody'})
+
+    assert resp.status_code == 400
+    assert resp.json['error_code'] == 'USER_NOT_FOUND'
+    assert queries == ['UPDATE']
+
+
+def test_auth_code_queries(adjure, queries):
+    user_id = '7'
+    post(adjure, '/user/provision', {'user_id': user_id})
+    auth.get_user_cache().invalidate(user_id)
+
+    del queries[:]
+    assert get(adjure, '/user/auth_code', {'user_id': user_id}).status_code == 200
+    assert get(adjure, '/user/auth_code', {'user_id': user_id}).status_code == 200
+    # The second request is served from the user cache
+    assert queries == ['SELECT']
+
+
+def test_qrcode(adjure):
+    user_id = '10'
+    post(adjure, '/user/provision', {'user_id': user_id})
+    route = '/user/qrcode?{}'.format(urlencode(
+        {'user_id': user_id, 'issuer': 'Adjure', 'username': 'foo'}
+    ))
+
+    resp = adjure.get(route)
+    assert resp.status_code == 200
+    assert resp.mimetype == 'image/png'
+    assert resp.headers['Cache-Control'] == 'private, no-cache'
+    etag = resp.headers['ETag']
+
+    cached_resp = adjure.get(route, headers={'If-None-Match': etag})
+    assert cached_resp.status_code == 304
+    assert cached_resp.headers['ETag'] == etag
+    assert cached_resp.data == b''
+
+
+@pytest.mark.parametrize(
+    ('params', 'mimetype'),
+    [
+        ({'format': 'svg', 'box_size': '4', 'border': '1'}, 'image/svg+xml'),
+        ({'format': 'json', 'error_correction': 'H'}, 'application/json'),
+        ({'format': 'png', 'box_size': '2'}, 'image/png'),
+    ]
+)
+def test_qrcode_formats(adjure, params, mimetype):
+    user_id = '11'
+    post(adjure, '/user/provision', {'user_id': user_id})
+    params = dict(params, user_id=user_id, issuer='Adjure', username='foo')
+
+    resp = adjure.get('/user/qrcode?{}'.format(urlencode(params)))
+    assert resp.status_code == 200
+    assert resp.mimetype == mimetype
+
+
+@pytest.mark.parametrize(
+    'params',
+    [
+        {'format': 'gif'},
+        {'box_size': '0'},
+        {'box_size': '21'},
+        {'border': 'wide'},
+        {'border': '11'},
+        {'error_correction': 'Z'},
+    ]
+)
+def test_qrcode_bad_params(adjure, params):
+    params = dict(params, user_id='11', issuer='Adjure', username='foo')
+    resp = get(adjure, '/user/qrcode', params)
+
+    assert resp.status_code == 400
+    assert resp.json['error_code'] == 'INVALID_PARAMS'
+
+
+def test_qrcode_user_not_found(adjure):
+    resp = adjure.get('/user/qrcode?{}'.format(urlencode(
+        {'user_id': 'nobody', 'issuer': 'Adjure', 'username': 'foo'}
+    )))
+    assert resp.status_code == 404
+
+
+def test_qrcode_renderer_busy(adjure, monkeypatch):
+    class BusyRenderer(object):
+        def render(self, auth_uri, options):
+            raise qr.RendererBusyException('QR code render queue is full')
+
+    monkeypatch.setattr(qr, 'get_renderer', BusyRenderer)
+    user_id = '12'
+    post(adjure, '/user/provision', {'user_id': user_id})
+
+    resp = get(adjure, '/user/qrcode', {'user_id': user_id, 'issuer': 'Adjure', 'username': 'busy'})
+    assert resp.status_code == 503
+    assert resp.json['error_code'] == 'QR_CODE_RENDERER_BUSY'
+    assert resp.headers['Retry-After'] == '1'
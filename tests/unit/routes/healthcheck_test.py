@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+import staticconf.testing
+
+from adjure.app import build_app
+from adjure.routes import healthcheck as healthcheck_routes
+
+
+@pytest.yield_fixture
+def adjure(monkeypatch):
+    monkeypatch.setattr(healthcheck_routes, '_database_check', None)
+    with build_app().test_client() as adjure_:
+        yield adjure_
+
+
+@pytest.fixture
+def database_pings(monkeypatch):
+    pings = []
+    monkeypatch.setattr(healthcheck_routes, 'ping_database', lambda: pings.append(1))
+    return pings
+
+
+def test_healthcheck(adjure):
+    assert adjure.get('/healthcheck').status_code == 200
+
+
+def test_healthcheck_live(adjure, database_pings):
+    assert adjure.get('/healthcheck/live').status_code == 200
+    assert database_pings == []
+
+
+def test_healthcheck_ready(adjure):
+    resp = adjure.get('/healthcheck/ready')
+    body = json.loads(resp.data.decode(resp.charset))
+
+    assert resp.status_code == 200
+    assert body['database'] == {'ok': True, 'error': None}
+    assert body['engines'][-1]['url'] == 'sqlite://'
+    assert set(body['caches']) == {'user', 'verifier', 'secret', 'qrcode'}
+    assert 'hit_ratio' in body['caches']['user']
+
+
+def test_healthcheck_ready_cached(adjure, database_pings):
+    adjure.get('/healthcheck/ready')
+    adjure.get('/healthcheck/ready')
+    adjure.get('/healthcheck')
+    assert database_pings == [1]
+
+    with staticconf.testing.MockConfiguration(
+        {'healthcheck': {'readiness_interval': 0}},
+        namespace='adjure',
+    ):
+        adjure.get('/healthcheck/ready')
+    assert database_pings == [1, 1]
+
+
+def test_healthcheck_ready_database_down(adjure, monkeypatch):
+    def fail():
+        raise RuntimeError('database is down')
+
+    monkeypatch.setattr(healthcheck_routes, 'ping_database', fail)
+    resp = adjure.get('/healthcheck/ready')
+    body = json.loads(resp.data.decode(resp.charset))
+
+    assert resp.status_code == 503
+    assert body['database'] == {'ok': False, 'error': 'database is down'}
+    assert adjure.get('/healthcheck').status_code == 503
+
+
+def test_healthcheck_pool(adjure):
+    resp = adjure.get('/healthcheck/pool')
+    engines = json.loads(resp.data.decode(resp.charset))['engines']
+
+    assert resp.status_code == 200
+    assert engines[-1]['url'] == 'sqlite://'
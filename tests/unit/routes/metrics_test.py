@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from adjure.app import build_app
+
+
+@pytest.yield_fixture
+def adjure():
+    with build_app().test_client() as adjure_:
+        yield adjure_
+
+
+def test_metrics(adjure):
+    adjure.get('/healthcheck/pool')
+    resp = adjure.get('/metrics')
+    text = resp.data.decode('utf-8')
+
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/plain'
+    assert 'adjure_http_requests_total{endpoint="healthcheck.healthcheck_pool",method="GET",status="200"}' in text
+    assert 'adjure_http_request_duration_seconds_count{endpoint="healthcheck.healthcheck_pool"}' in text
+
+
+def test_verification_outcomes(adjure):
+    adjure.post(
+        '/user/authenticate',
+        data='{"user_id": "nobody-metrics", "auth_code": "123456"}',
+        content_type='application/json',
+    )
+    text = adjure.get('/metrics').data.decode('utf-8')
+
+    assert 'adjure_verifications_total{outcome="unknown_user"}' in text
+    assert 'adjure_load_user_duration_seconds_count' in text
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import pytest
+from flask import Flask
+from jsonschema import SchemaError
+
+from adjure.routes.validation import compile_schema
+from adjure.routes.validation import validate_request
+
+
+SCHEMA = {
+    'type': 'object',
+    'properties': {'user_id': {'type': 'string'}},
+    'required': ['user_id'],
+}
+
+
+def test_compile_schema_checks_schema():
+    with pytest.raises(SchemaError):
+        compile_schema({'type': 'not a type'})
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+
+    @app.route('/json', methods=['POST'])
+    @validate_request(SCHEMA)
+    def json_view(data):
+        return data['user_id']
+
+    @app.route('/args', methods=['GET'])
+    @validate_request(SCHEMA, source='args')
+    def args_view(data):
+        return data['user_id']
+
+    with app.test_client() as client_:
+        yield client_
+
+
+def test_validate_request_json(client):
+    assert client.post('/json', data='{"user_id": "1"}').data == b'1'
+
+    resp = client.post('/json', data='{"user_id": 1}')
+    assert resp.status_code == 400
+    assert b'INVALID_PARAMS' in resp.data
+
+
+def test_validate_request_args(client):
+    assert client.get('/args?user_id=1').data == b'1'
+    assert client.get('/args').status_code == 400
@@ -1,13 +1,25 @@
 # -*- coding: utf-8 -*-
 import argparse
-import os
 
 from adjure.app import build_app
+from adjure.app import get_database_url
+from adjure.app import get_replica_database_urls
+from adjure.app import get_shard_configs
 from adjure.app import register_app_config
 from adjure.app import setup_logging
+from adjure.lib.auth import read_recovery_code_pepper
+from adjure.lib.metrics import clear_multiprocess_dir
+from adjure.lib.metrics import install_exit_hook
 from adjure.models.base import bind_database_engine
+from adjure.models.base import bind_replica_engines
+from adjure.models.base import bind_shard_engines
+from adjure.models.base import dispose_engines
 
-DB_HOST_ENV_VAR = 'ADJURE_DB_HOST'
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    # Not running under uWSGI
+    postfork = None
 
 
 parser = argparse.ArgumentParser(description='Run the adjure server')
@@ -15,12 +27,21 @@ parser.add_argument('--config', dest='config_path', default='config.example.yaml
 
 args = parser.parse_args()
 config = register_app_config(args.config_path)
+# Fail now, rather than on the first request that hashes a recovery code
+read_recovery_code_pepper()
 
-if not os.environ.get(DB_HOST_ENV_VAR, None):
-    raise ValueError(
-        '{} is required for Adjure to connect to a database.'.format(DB_HOST_ENV_VAR)
-    )
-
-bind_database_engine(os.environ[DB_HOST_ENV_VAR])
+bind_database_engine(get_database_url())
+bind_replica_engines(get_replica_database_urls())
+bind_shard_engines(get_shard_configs(config))
 application = build_app()
 setup_logging(application, config)
+
+# Workers are forked from this process, and must not inherit its connections
+dispose_engines()
+if postfork:
+    postfork(dispose_engines)
+
+# Metrics of a previous run's workers would otherwise be counted again
+clear_multiprocess_dir()
+# Inherited by every worker, and run by uWSGI when one exits or is reloaded
+install_exit_hook()
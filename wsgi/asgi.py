@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""ASGI entry point, e.g.
+
+    ADJURE_DB_HOST=... uvicorn --app-dir wsgi asgi:application
+
+The config path comes from ADJURE_CONFIG, since ASGI servers import this
+module rather than running it.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from adjure.app import build_app
+from adjure.app import get_database_url
+from adjure.app import get_replica_database_urls
+from adjure.app import get_shard_configs
+from adjure.app import register_app_config
+from adjure.app import setup_logging
+from adjure.asgi import WSGIToASGI
+from adjure.lib.auth import read_recovery_code_pepper
+from adjure.models.base import bind_database_engine
+from adjure.models.base import bind_replica_engines
+from adjure.models.base import bind_shard_engines
+
+
+config = register_app_config(os.environ.get('ADJURE_CONFIG', 'config.example.yaml'))
+# Fail now, rather than on the first request that hashes a recovery code
+read_recovery_code_pepper()
+
+bind_database_engine(get_database_url())
+bind_replica_engines(get_replica_database_urls())
+bind_shard_engines(get_shard_configs(config))
+app = build_app()
+setup_logging(app, config)
+
+application = WSGIToASGI(
+    app,
+    ThreadPoolExecutor(max_workers=config.read_int('asgi.executor_threads', default=32)),
+    max_body_size=config.read_int('asgi.max_body_size', default=10 * 1024 * 1024),
+)
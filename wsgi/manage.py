@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Administrative commands for adjure, run against the database in
+ADJURE_DB_HOST and every shard in database.shards
+
+    python wsgi/manage.py --config config.yaml migrate
+    python wsgi/manage.py --config config.yaml bulk-provision < users.jsonl
+    python wsgi/manage.py --config config.yaml hash-recovery-codes
+    python wsgi/manage.py --config config.yaml rebalance-shards
+    python wsgi/manage.py --config config.yaml rotate-secret-keys
+"""
+import argparse
+import json
+import sys
+
+from adjure.app import get_database_url
+from adjure.app import get_shard_configs
+from adjure.app import register_app_config
+from adjure.lib import auth
+from adjure.models.base import bind_database_engine
+from adjure.models.base import bind_shard_engines
+from adjure.models.migrations import migrate_schema
+from adjure.models.migrations import upgrade_recovery_code_table
+from adjure.routes.auth import bulk_provision_error
+from adjure.routes.auth import format_bulk_provision_result
+from adjure.routes.auth import parse_json_lines
+
+
+def migrate(args):
+    """Create or upgrade adjure's tables on every shard. Run before deploying
+    a release, and before adding a shard.
+    """
+    for shard in args.shards:
+        migrate_schema(shard.engine)
+        sys.stderr.write('Schema of shard {} is up to date\n'.format(shard.name))
+
+
+def bulk_provision(args):
+    """Provision users from JSON lines, one provision request per line,
+    writing a JSON line result per user to stdout.
+    """
+    auth.read_recovery_code_pepper()
+    provisioned = failed = 0
+    users = parse_json_lines(args.input)
+    results = auth.bulk_provision_users(
+        users,
+        chunk_size=args.chunk_size,
+        validate=bulk_provision_error,
+    )
+    for result in results:
+        if result.error:
+            failed += 1
+        else:
+            provisioned += 1
+        args.output.write(json.dumps(format_bulk_provision_result(result)) + '\n')
+
+    sys.stderr.write('Provisioned {} users, {} failed\n'.format(provisioned, failed))
+
+
+def hash_recovery_codes(args):
+    """Upgrade the recovery code table, and hash any plaintext recovery codes
+    stored before codes were hashed.
+    """
+    auth.read_recovery_code_pepper()
+    for shard in args.shards:
+        upgrade_recovery_code_table(shard.engine)
+    migrated = auth.migrate_plaintext_recovery_codes(batch_size=args.batch_size)
+    sys.stderr.write('Hashed {} recovery codes\n'.format(migrated))
+
+
+def rebalance_shards(args):
+    """Move users that aren't on the shard they belong on, after shards are
+    added or set to draining. Set database.rebalancing on the servers until
+    this is done, so users are found wherever they are.
+    """
+    moved = auth.rebalance_shards(batch_size=args.batch_size)
+    sys.stderr.write('Moved {} users\n'.format(moved))
+
+
+def rotate_secret_keys(args):
+    """Encrypt every TOTP secret with the current key version, including
+    secrets stored before encryption was configured.
+    """
+    rotated = auth.rotate_secret_keys(batch_size=args.batch_size)
+    sys.stderr.write('Re-encrypted {} secrets\n'.format(rotated))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage an adjure database')
+    parser.add_argument('--config', dest='config_path', default='config.example.yaml')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    migrate_parser = subparsers.add_parser(
+        'migrate',
+        help='Create or upgrade the database schema',
+    )
+    migrate_parser.set_defaults(func=migrate)
+
+    bulk_provision_parser = subparsers.add_parser(
+        'bulk-provision',
+        help='Provision users from a JSON lines file',
+    )
+    bulk_provision_parser.add_argument(
+        'input',
+        nargs='?',
+        type=argparse.FileType('r'),
+        default=sys.stdin,
+    )
+    bulk_provision_parser.add_argument(
+        '--output',
+        type=argparse.FileType('w'),
+        default=sys.stdout,
+    )
+    bulk_provision_parser.add_argument('--chunk-size', type=int, default=None)
+    bulk_provision_parser.set_defaults(func=bulk_provision)
+
+    hash_recovery_codes_parser = subparsers.add_parser(
+        'hash-recovery-codes',
+        help='Hash recovery codes stored in plaintext',
+    )
+    hash_recovery_codes_parser.add_argument('--batch-size', type=int, default=1000)
+    hash_recovery_codes_parser.set_defaults(func=hash_recovery_codes)
+
+    rebalance_shards_parser = subparsers.add_parser(
+        'rebalance-shards',
+        help='Move users onto the shards they belong on',
+    )
+    rebalance_shards_parser.add_argument('--batch-size', type=int, default=1000)
+    rebalance_shards_parser.set_defaults(func=rebalance_shards)
+
+    rotate_secret_keys_parser = subparsers.add_parser(
+        'rotate-secret-keys',
+        help='Re-encrypt TOTP secrets with the current key version',
+    )
+    rotate_secret_keys_parser.add_argument('--batch-size', type=int, default=1000)
+    rotate_secret_keys_parser.set_defaults(func=rotate_secret_keys)
+
+    args = parser.parse_args(argv)
+    config = register_app_config(args.config_path)
+    bind_database_engine(get_database_url())
+    args.shards = bind_shard_engines(get_shard_configs(config))
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()